@@ -0,0 +1,170 @@
+import datetime
+import queue
+import threading
+import time
+from flask import current_app
+from sqlalchemy import func, select, update
+from crm.extensions import app_service, db
+from crm.models import AutomationRule, Contact, Task
+from crm.changes import log_changes
+from crm.writes import insert_logged
+from crm.mail import enqueue_emails, get_mail_dispatcher, mail_configured, render_mail_template
+
+# --- AUTOMATION RULES ---
+# Routes only emit events after they commit. A background dispatcher drains them in
+# batches, matches them against each user's rules (compiled once and indexed by trigger
+# and condition) and writes the resulting tasks and queued emails in bulk. It also scans
+# for newly overdue tasks with an indexed range query.
+AUTOMATION_TRIGGERS = {'stage_change': 'Deal moves to stage', 'interaction': 'Interaction is logged', 'task_overdue': 'Task becomes overdue'}
+AUTOMATION_ACTIONS = {'create_task': 'Create a task', 'queue_email': 'Queue an email'}
+# Used for users who have not set up any rules of their own
+DEFAULT_AUTOMATION_RULES = [
+    {'name': 'Proposal follow-up', 'trigger': 'stage_change', 'condition': 'Proposal Sent', 'action': 'create_task', 'delay_days': 7,
+     'title': 'Follow up on proposal for {deal}', 'body': None},
+]
+AUTOMATION_BATCH_SIZE = 500
+
+class RuleCache:
+    TTL = 60 # Seconds; other workers pick up rule edits within this time
+
+    def __init__(self):
+        self._rules = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        # Returns {trigger: {condition or None: [rule, ...]}}
+        with self._lock:
+            cached = self._rules.get(user_id)
+            if cached and cached[0] > time.monotonic(): return cached[1]
+        rows = [{column: getattr(rule, column) for column in ('name', 'trigger', 'condition', 'action', 'delay_days', 'title', 'body', 'enabled')}
+                for rule in AutomationRule.query.filter_by(user_id=user_id)]
+        compiled = {}
+        for rule in rows or DEFAULT_AUTOMATION_RULES:
+            if rule.get('enabled', True):
+                compiled.setdefault(rule['trigger'], {}).setdefault(rule['condition'] or None, []).append(rule)
+        with self._lock:
+            self._rules[user_id] = (time.monotonic() + self.TTL, compiled)
+        return compiled
+
+    def invalidate(self, user_id):
+        with self._lock: self._rules.pop(user_id, None)
+
+class AutomationDispatcher:
+    def __init__(self, scan_interval, queue_size):
+        self.scan_interval = scan_interval
+        self.app = current_app._get_current_object()
+        self.rules = RuleCache()
+        self._events = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='automation-dispatcher', daemon=True)
+                self._thread.start()
+
+    def emit(self, trigger, user_id, condition, values, contact_id=None, organization_id=None):
+        self.start()
+        try:
+            self._events.put_nowait({'trigger': trigger, 'user_id': user_id, 'condition': condition, 'values': values,
+                                     'contact_id': contact_id, 'organization_id': organization_id})
+        except queue.Full:
+            current_app.logger.warning('Automation queue full; dropped %s event for user %s', trigger, user_id)
+
+    def _run(self):
+        next_scan = time.monotonic()
+        while True:
+            batch = []
+            try:
+                batch.append(self._events.get(timeout=max(0.0, next_scan - time.monotonic())))
+                while len(batch) < AUTOMATION_BATCH_SIZE:
+                    batch.append(self._events.get_nowait())
+            except queue.Empty:
+                pass
+            with self.app.app_context():
+                try:
+                    if batch: self.process(batch)
+                    if time.monotonic() >= next_scan:
+                        self.scan_overdue_tasks()
+                        next_scan = time.monotonic() + self.scan_interval
+                except Exception:
+                    db.session.rollback()
+                    current_app.logger.exception('Automation dispatch failed')
+
+    def drain(self):
+        # Processes everything queued so far on the calling thread (CLI and tests)
+        batch = []
+        while True:
+            try:
+                batch.append(self._events.get_nowait())
+            except queue.Empty:
+                break
+        if batch: self.process(batch)
+        return len(batch)
+
+    def process(self, events):
+        tasks, emails = self.apply(events)
+        db.session.commit()
+        if emails and mail_configured(): get_mail_dispatcher().wake()
+        return tasks + emails
+
+    def apply(self, events):
+        # Writes the tasks and emails the events' rules call for without committing, so callers can make them part of their own
+        # transaction; returns (tasks, emails)
+        matches = []
+        for automation_event in events:
+            by_condition = self.rules.get(automation_event['user_id']).get(automation_event['trigger'], {})
+            rules = by_condition.get(None, [])
+            if automation_event['condition'] is not None: rules = rules + by_condition.get(automation_event['condition'], [])
+            for rule in rules:
+                matches.append((rule, automation_event))
+        if not matches: return 0, 0
+        # Deal events name an org, not a contact: use each org's first contact, found in one grouped query
+        org_ids = {e['organization_id'] for _, e in matches if e['contact_id'] is None and e['organization_id']}
+        first_contact = dict(db.session.query(Contact.org_id, func.min(Contact.id)).filter(Contact.org_id.in_(org_ids)).group_by(Contact.org_id).all()) if org_ids else {}
+        contact_ids = {e['contact_id'] or first_contact.get(e['organization_id']) for _, e in matches} - {None}
+        emails = dict(db.session.query(Contact.id, Contact.email).filter(Contact.id.in_(contact_ids)).all()) if contact_ids else {}
+        now = datetime.datetime.utcnow()
+        tasks, outbound = [], []
+        for rule, automation_event in matches:
+            contact_id = automation_event['contact_id'] or first_contact.get(automation_event['organization_id'])
+            if not contact_id: continue
+            values = automation_event['values']
+            if rule['action'] == 'create_task':
+                tasks.append({'title': render_mail_template(rule['title'], values)[:200], 'due_date': now + datetime.timedelta(days=rule['delay_days']),
+                              'status': 'Pending', 'overdue_fired': False, 'contact_id': contact_id, 'user_id': automation_event['user_id']})
+            elif rule['action'] == 'queue_email' and emails.get(contact_id):
+                outbound.append({'recipient': emails[contact_id], 'subject': render_mail_template(rule['title'], values),
+                                 'body': render_mail_template(rule['body'] or '', values), 'campaign': f"Automation: {rule['name']}",
+                                 'contact_id': contact_id, 'user_id': automation_event['user_id']})
+        insert_logged(Task, tasks)
+        enqueue_emails(outbound)
+        return len(tasks), len(outbound)
+
+    def scan_overdue_tasks(self, limit=AUTOMATION_BATCH_SIZE):
+        # Range scan over ix_task_overdue_scan. Every worker scans, so rows are claimed with a guarded
+        # UPDATE ... RETURNING and only the claimed ones fire, in the same transaction as their actions.
+        total = 0
+        while True:
+            now = datetime.datetime.utcnow()
+            due = select(Task.id).where(Task.status=='Pending', Task.overdue_fired==False, Task.due_date < now).order_by(Task.due_date).limit(limit)
+            rows = db.session.execute(update(Task).where(Task.id.in_(due), Task.overdue_fired==False).values(overdue_fired=True).returning(
+                Task.id, Task.title, Task.due_date, Task.contact_id, Task.user_id).execution_options(synchronize_session=False)).all()
+            if not rows:
+                db.session.rollback(); return total
+            log_changes(Task.__table__, 'upsert', [(row.user_id, row.id) for row in rows])
+            _, emails = self.apply([{'trigger': 'task_overdue', 'user_id': row.user_id, 'condition': None, 'contact_id': row.contact_id, 'organization_id': None,
+                         'values': {'task': row.title, 'due_date': row.due_date.strftime('%d %b %Y')}} for row in rows])
+            db.session.commit()
+            if emails and mail_configured(): get_mail_dispatcher().wake()
+            total += len(rows)
+            if len(rows) < limit: return total
+
+def get_automation_dispatcher():
+    return app_service('automation_dispatcher', lambda config: AutomationDispatcher(config['AUTOMATION_SCAN_INTERVAL'], config['AUTOMATION_QUEUE_SIZE']))
+
+def stage_change_event(deal):
+    # Built before commit so emitting afterwards does not reload the expired deal
+    return {'trigger': 'stage_change', 'user_id': deal.user_id, 'condition': deal.stage, 'values': {'deal': deal.name, 'stage': deal.stage},
+            'organization_id': deal.organization_id}
@@ -0,0 +1,344 @@
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+import click
+from flask import current_app
+from werkzeug.security import generate_password_hash
+from sqlalchemy import func, event
+from sqlalchemy.engine import Engine
+from crm.extensions import db, HEAVY_MODULES
+from crm.models import Attendee, Contact, Deal, DEAL_STAGES, Event, Interaction, Organization, PipelineStage, Task, User
+from crm.rollups import rebuild_rollups
+from crm.forecast import mark_deals_changed
+from crm.writes import insert_logged
+from crm.migrations import current_schema_version, upgrade_schema
+
+def explain_route_queries(user, routes):
+    # Drives each route through the test client and returns [(route, statement, plan rows)] for every distinct SELECT
+    captured = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'WITH')): captured.append((statement, parameters))
+    client = current_app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+    results = []
+    for route in routes:
+        captured.clear()
+        event.listen(Engine, 'before_cursor_execute', capture)
+        try:
+            client.get(route)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', capture)
+        seen = set()
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for statement, parameters in captured:
+                if statement in seen: continue
+                seen.add(statement)
+                cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+                results.append((route, statement, [row[-1] for row in cursor.fetchall()]))
+        finally:
+            connection.close()
+    return results
+
+# --- SYNTHETIC DATA & BENCHMARKS ---
+# seed-synthetic fills the database with realistic volumes through bulk inserts, and
+# bench drives the real routes through the test client at growing data sizes.
+SEED_BATCH_SIZE = 5000
+SYNTHETIC_PASSWORD = 'password'
+_SEED_COUNTRIES = ['Ireland', 'Germany', 'France', 'Spain', 'Italy', 'Türkiye', 'Brazil', 'India', 'Japan', 'Kenya', 'Mexico', 'Norway', 'Poland', 'Canada', 'Egypt']
+_SEED_ORG_PREFIXES = ['Bank of', 'Central Bank of', 'National Mint of', 'Royal Mint of', 'Payments Council of', 'Treasury of', 'Monetary Authority of']
+_SEED_FIRST_NAMES = ['Anna', 'Brian', 'Carla', 'Dmitri', 'Elena', 'Farid', 'Grace', 'Hiro', 'Ines', 'Jonas', 'Kemal', 'Lucia', 'Marta', 'Niall', 'Olga', 'Priya']
+_SEED_LAST_NAMES = ['Murphy', 'Schmidt', 'Dubois', 'Garcia', 'Rossi', 'Yilmaz', 'Silva', 'Sharma', 'Tanaka', 'Otieno', 'Hernandez', 'Berg', 'Nowak', 'Smith']
+_SEED_TITLES = ['Governor', 'Deputy Governor', 'Head of Currency', 'Head of Payments', 'Chief Cashier', 'Director of Operations', 'Procurement Manager']
+_SEED_WORDS = ['banknote', 'polymer', 'cash', 'cycle', 'sponsorship', 'conference', 'proposal', 'pricing', 'security', 'feature', 'tender', 'renewal', 'delegates', 'budget']
+
+def _bulk_insert(model, rows):
+    for start in range(0, len(rows), SEED_BATCH_SIZE):
+        insert_logged(model, rows[start:start + SEED_BATCH_SIZE])
+
+def _new_ids(model, user_id, after_id):
+    return [row_id for (row_id,) in db.session.query(model.id).filter(model.user_id==user_id, model.id > after_id).order_by(model.id)]
+
+def seed_user_data(user, rng, orgs, contacts_per_org, deals_per_org, interactions_per_contact, tasks_per_contact):
+    # Adds orgs (and their contacts, deals, interactions and tasks) to an existing user
+    now = datetime.datetime.utcnow()
+    stage_ids = dict(db.session.query(PipelineStage.name, PipelineStage.id).filter_by(user_id=user.id).all())
+    if not stage_ids:
+        _bulk_insert(PipelineStage, [{'name': name, 'order': order, 'user_id': user.id} for order, name in enumerate(DEAL_STAGES, 1)])
+        stage_ids = dict(db.session.query(PipelineStage.name, PipelineStage.id).filter_by(user_id=user.id).all())
+    last_org = db.session.query(func.coalesce(func.max(Organization.id), 0)).scalar()
+    _bulk_insert(Organization, [{'name': f'{rng.choice(_SEED_ORG_PREFIXES)} {rng.choice(_SEED_COUNTRIES)} {rng.randrange(10**6)}', 'country': rng.choice(_SEED_COUNTRIES),
+                                 'sponsorship_potential': rng.choice(['High (Sponsor Target)', 'Low (Delegate Only)']), 'strategic_notes': ' '.join(rng.choices(_SEED_WORDS, k=12)),
+                                 'user_id': user.id} for _ in range(orgs)])
+    org_ids = _new_ids(Organization, user.id, last_org)
+    last_contact = db.session.query(func.coalesce(func.max(Contact.id), 0)).scalar()
+    contacts = []
+    for org_id in org_ids:
+        for _ in range(contacts_per_org):
+            first, last = rng.choice(_SEED_FIRST_NAMES), rng.choice(_SEED_LAST_NAMES)
+            contacts.append({'name': f'{first} {last}', 'title': rng.choice(_SEED_TITLES), 'email': f'{first}.{last}.{rng.randrange(10**7)}@example.com'.lower(),
+                             'org_id': org_id, 'user_id': user.id})
+    _bulk_insert(Contact, contacts)
+    contact_ids = _new_ids(Contact, user.id, last_contact)
+    deals = []
+    weights = [30, 20, 15, 10, 15, 10][:len(DEAL_STAGES)]
+    for org_id in org_ids:
+        for _ in range(deals_per_org):
+            created_at = now - datetime.timedelta(days=rng.randrange(730), seconds=rng.randrange(86400))
+            stage = rng.choices(DEAL_STAGES, weights)[0]
+            deal = {'name': f'{rng.choice(["Sponsorship", "Delegate Pack", "Exhibition", "Report Licence"])} {created_at.year}-{rng.randrange(1000)}',
+                    'value': rng.randrange(1, 200) * 500, 'stage': stage, 'stage_id': stage_ids.get(stage),
+                    'closing_date': (created_at + datetime.timedelta(days=rng.randrange(10, 200))).date(),
+                    'created_at': created_at, 'updated_at': created_at + datetime.timedelta(days=rng.randrange(30)),
+                    'organization_id': org_id, 'user_id': user.id}
+            deals.append(dict(deal, stage_entered_at=deal['updated_at'])) # Seeded deals have been in their stage since their last update
+    _bulk_insert(Deal, deals)
+    mark_deals_changed(user.id)
+    interactions, tasks = [], []
+    for contact_id in contact_ids:
+        for _ in range(interactions_per_contact):
+            interactions.append({'interaction_type': rng.choice(['Email Sent', 'Call', 'Meeting', 'Note']), 'notes': ' '.join(rng.choices(_SEED_WORDS, k=20)),
+                                 'date': now - datetime.timedelta(days=rng.randrange(730), seconds=rng.randrange(86400)), 'contact_id': contact_id, 'user_id': user.id})
+        for _ in range(tasks_per_contact):
+            tasks.append({'title': f'Follow up: {rng.choice(_SEED_WORDS)}', 'status': rng.choice(['Pending', 'Completed']),
+                          'due_date': now + datetime.timedelta(days=rng.randrange(-365, 90)), 'contact_id': contact_id, 'user_id': user.id})
+    _bulk_insert(Interaction, interactions)
+    _bulk_insert(Task, tasks)
+    db.session.commit()
+    return {'organizations': len(org_ids), 'contacts': len(contact_ids), 'deals': len(deals), 'interactions': len(interactions), 'tasks': len(tasks)}
+
+def seed_synthetic(users, orgs_per_user, contacts_per_org=3, deals_per_org=2, interactions_per_contact=5, tasks_per_contact=2,
+                   events=5, attendees_per_event=50, seed=1, progress=None):
+    rng = random.Random(seed)
+    password_hash = generate_password_hash(SYNTHETIC_PASSWORD) # Hashing is slow, so every synthetic user shares one
+    totals = Counter()
+    seeded_users = []
+    for n in range(1, users + 1):
+        user = User.query.filter_by(username=f'synth{n}').first()
+        if not user:
+            user = User(username=f'synth{n}', email=f'synth{n}@example.com', password_hash=password_hash)
+            db.session.add(user); db.session.commit()
+        totals.update(seed_user_data(user, rng, orgs_per_user, contacts_per_org, deals_per_org, interactions_per_contact, tasks_per_contact))
+        seeded_users.append(user)
+        if progress: progress(n, totals)
+    if events:
+        last_event = db.session.query(func.coalesce(func.max(Event.id), 0)).scalar()
+        _bulk_insert(Event, [{'name': f'{rng.choice(["Currency Conference", "Payments Summit", "Cash Cycle Forum"])} {2024 + i % 3} #{rng.randrange(1000)}',
+                              'date': datetime.date.today() + datetime.timedelta(days=rng.randrange(-365, 365)), 'location': rng.choice(_SEED_COUNTRIES)} for i in range(events)])
+        event_ids = [event_id for (event_id,) in db.session.query(Event.id).filter(Event.id > last_event)]
+        attendees = []
+        for event_id in event_ids:
+            for user in seeded_users:
+                org_ids = [org_id for (org_id,) in db.session.query(Organization.id).filter_by(user_id=user.id)]
+                for org_id in rng.sample(org_ids, min(attendees_per_event, len(org_ids))):
+                    attendees.append({'registration_type': rng.choice(['Sponsor', 'Delegate']), 'value': rng.randrange(1, 100) * 1000,
+                                      'event_id': event_id, 'organization_id': org_id, 'user_id': user.id})
+        _bulk_insert(Attendee, attendees)
+        totals.update({'events': len(event_ids), 'attendees': len(attendees)})
+    db.session.commit()
+    rebuild_rollups()
+    return totals
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def bench_routes(user, requests_per_route, rng):
+    # Times each route with the test client; returns {route name: stats}
+    org_ids = [org_id for (org_id,) in db.session.query(Organization.id).filter_by(user_id=user.id).limit(500)]
+    contact_ids = [contact_id for (contact_id,) in db.session.query(Contact.id).filter_by(user_id=user.id).limit(500)]
+    import_counter = iter(range(10**9))
+    def import_request(client):
+        batch = next(import_counter)
+        csv_data = 'Org,Country,Sponsorship Potential\n' + ''.join(f'Bench Import {uuid.uuid4().hex[:8]} {batch}-{i},Ireland,High (Sponsor Target)\n' for i in range(100))
+        return client.post('/import', data={'kind': 'organizations', 'file': (io.BytesIO(csv_data.encode()), 'bench.csv')})
+    routes = {
+        'dashboard': lambda client: client.get('/dashboard'),
+        'pipeline': lambda client: client.get('/pipeline'),
+        'org_detail': lambda client: client.get(f'/org/{rng.choice(org_ids)}'),
+        'contact_detail': lambda client: client.get(f'/contact/{rng.choice(contact_ids)}'),
+        'reporting': lambda client: client.get('/reporting'),
+        'import_data': import_request,
+    }
+    client = current_app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+    query_count = [0]
+    def count_query(*args): query_count[0] += 1
+    results = {}
+    event.listen(Engine, 'before_cursor_execute', count_query)
+    try:
+        for name, call in routes.items():
+            call(client) # Warm caches and compiled statements
+            timings, queries = [], []
+            for _ in range(requests_per_route):
+                query_count[0] = 0
+                start = time.perf_counter()
+                response = call(client)
+                timings.append((time.perf_counter() - start) * 1000)
+                queries.append(query_count[0])
+                if response.status_code >= 400: raise click.ClickException(f'{name} returned {response.status_code}')
+            results[name] = {'p50_ms': round(_percentile(timings, 50), 2), 'p95_ms': round(_percentile(timings, 95), 2), 'p99_ms': round(_percentile(timings, 99), 2),
+                             'mean_ms': round(statistics.mean(timings), 2), 'queries': max(queries)}
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count_query)
+    return results
+
+def stress_writes(user_id, mode, threads, writes):
+    # Concurrent clients alternate logging interactions and moving deals; returns (latencies in ms, failures by status)
+    contact_ids = [contact_id for (contact_id,) in db.session.query(Contact.id).filter_by(user_id=user_id).limit(500)]
+    deal_ids = [deal_id for (deal_id,) in db.session.query(Deal.id).filter_by(user_id=user_id).limit(500)]
+    previous_mode, current_app.config['SQLITE_WRITE_MODE'] = current_app.config['SQLITE_WRITE_MODE'], mode
+    timings, failures = [], Counter()
+    lock = threading.Lock()
+    app = current_app._get_current_object() # Client threads have no app context of their own
+    def worker(n):
+        rng = random.Random(f'{os.getpid()}-{n}')
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+        for i in range(writes // threads):
+            start = time.perf_counter()
+            if i % 2: response = client.post(f'/api/deal/{rng.choice(deal_ids)}/update_stage', json={'new_stage': rng.choice(DEAL_STAGES)})
+            else: response = client.post(f'/contact/{rng.choice(contact_ids)}/add_interaction', data={'interaction_type': 'Call', 'notes': 'Stress test'})
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                timings.append(elapsed)
+                if response.status_code >= 400: failures[response.status_code] += 1
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    try:
+        for thread in workers: thread.start()
+        for thread in workers: thread.join()
+    finally:
+        current_app.config['SQLITE_WRITE_MODE'] = previous_mode
+    return timings, failures
+
+def _stress_worker_process(app, user_id, mode, threads, writes, results):
+    # Runs in a forked child standing in for one gunicorn worker
+    with app.app_context():
+        timings, failures = stress_writes(user_id, mode, threads, writes)
+    results.put((timings, dict(failures)))
+
+def run_write_stress(user_id, mode, processes, threads, writes):
+    # Splits the writes across processes and returns throughput, latency and failure stats for the mode
+    db.session.remove()
+    db.engine.dispose() # Children must open their own SQLite connections
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    children = [context.Process(target=_stress_worker_process, args=(current_app._get_current_object(), user_id, mode, threads, writes // processes, results)) for _ in range(processes)]
+    start = time.perf_counter()
+    for child in children: child.start()
+    timings, failures = [], Counter()
+    for _ in children:
+        child_timings, child_failures = results.get()
+        timings.extend(child_timings); failures.update(child_failures)
+    for child in children: child.join()
+    seconds = time.perf_counter() - start
+    return {'mode': mode, 'writes': len(timings), 'seconds': round(seconds, 2), 'writes_per_s': round(len(timings) / seconds, 1),
+            'p50_ms': round(_percentile(timings, 50), 2), 'p95_ms': round(_percentile(timings, 95), 2), 'p99_ms': round(_percentile(timings, 99), 2),
+            'failed': sum(failures.values()), 'failures': dict(failures)}
+
+def compare_bench(baseline, current):
+    # Yields (size, route, metric, old, new, change %) for every p95 and query count present in both runs
+    for size, routes in current['results'].items():
+        for route, stats in routes.items():
+            old = baseline.get('results', {}).get(size, {}).get(route)
+            if not old: continue
+            for metric in ('p95_ms', 'queries'):
+                change = ((stats[metric] - old[metric]) / old[metric] * 100) if old[metric] else 0.0
+                yield size, route, metric, old[metric], stats[metric], change
+
+def get_stress_user():
+    # A small seeded account shared by the write and user loading benchmarks
+    db.create_all()
+    upgrade_schema(mark_only=not current_schema_version())
+    user = User.query.filter_by(username='stress').first()
+    if not user:
+        user = User(username='stress', email='stress@example.com', password_hash=generate_password_hash(SYNTHETIC_PASSWORD))
+        db.session.add(user); db.session.commit()
+        seed_user_data(user, random.Random(1), 100, contacts_per_org=2, deals_per_org=2, interactions_per_contact=0, tasks_per_contact=0)
+        rebuild_rollups()
+    return user
+
+USER_LOAD_MODES = {
+    'uncached': {'USER_CACHE_SIZE': 0, 'USER_SESSION_PAYLOAD': False},
+    'cache': {'USER_CACHE_SIZE': 10000, 'USER_SESSION_PAYLOAD': False},
+    'session': {'USER_CACHE_SIZE': 10000, 'USER_SESSION_PAYLOAD': True},
+}
+
+def bench_user_loads(user_id, mode, requests_per_route, rng):
+    # Returns {route name: stats} for one USER_LOAD_MODES entry, counting user lookups apart from other queries.
+    # Requests go to a second app so each gets its own app context, database session and user cache, as in production.
+    from app import create_app # app.py imports the CLI commands, which import this module
+    bench_app = create_app(dict(current_app.config, **USER_LOAD_MODES[mode]))
+    deal_ids = [deal_id for (deal_id,) in db.session.query(Deal.id).filter_by(user_id=user_id).limit(500)]
+    routes = {
+        'update_stage': lambda client: client.post(f'/api/deal/{rng.choice(deal_ids)}/update_stage', json={'new_stage': rng.choice(DEAL_STAGES)}),
+        'pipeline_summary': lambda client: client.get('/api/pipeline/summary'),
+        'dashboard': lambda client: client.get('/dashboard'),
+    }
+    counts = Counter()
+    def count_query(conn, cursor, statement, *args):
+        counts['queries'] += 1
+        if statement.lstrip().startswith('SELECT') and 'FROM user' in statement: counts['user'] += 1
+    results = {}
+    event.listen(Engine, 'before_cursor_execute', count_query)
+    try:
+        for name, call in routes.items():
+            client = bench_app.test_client()
+            with client.session_transaction() as client_session:
+                client_session['_user_id'] = str(user_id)
+            counts.clear()
+            timings = []
+            for _ in range(requests_per_route):
+                start = time.perf_counter()
+                response = call(client)
+                timings.append((time.perf_counter() - start) * 1000)
+                if response.status_code >= 400: raise click.ClickException(f'{name} returned {response.status_code}')
+            results[name] = {'queries': round(counts['queries'] / requests_per_route, 2), 'user_queries': round(counts['user'] / requests_per_route, 3),
+                             'p50_ms': round(_percentile(timings, 50), 2)}
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count_query)
+    return results
+
+# --- STARTUP BENCHMARK ---
+STARTUP_PROBE = """
+import importlib, json, os, sys, time
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'): return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        import resource
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+start = time.perf_counter()
+module = importlib.import_module(sys.argv[1])
+imported = time.perf_counter()
+module.app.test_client().get('/login')
+served = time.perf_counter()
+result = {'import_ms': round((imported - start) * 1000, 1), 'first_request_ms': round((served - imported) * 1000, 1), 'rss_mb': rss_mb(),
+          'heavy_loaded': [name for name in sys.argv[2:] if name in sys.modules]}
+for name in sys.argv[2:]: importlib.import_module(name)
+result['rss_with_heavy_mb'] = rss_mb()
+print(json.dumps(result))
+"""
+
+def probe_startup(preload):
+    # Each probe is a fresh interpreter so nothing is already imported or cached
+    env = dict(os.environ, PRELOAD_HEAVY_MODULES='1' if preload else '0')
+    output = subprocess.run([sys.executable, '-W', 'ignore', '-c', STARTUP_PROBE, current_app.import_name, *HEAVY_MODULES], env=env, capture_output=True, text=True,
+                            check=True, cwd=current_app.root_path).stdout
+    return json.loads(output.strip().splitlines()[-1])
@@ -0,0 +1,39 @@
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session
+from flask_login import login_user, logout_user, login_required, current_user
+from crm.extensions import db
+from crm.models import User
+from crm.writes import run_write
+
+auth_bp = Blueprint('auth', __name__)
+
+# --- AUTHENTICATION ROUTES ---
+@auth_bp.route('/login', methods=['GET', 'POST'])
+def login():
+    if current_user.is_authenticated: return redirect(url_for('main.dashboard'))
+    if request.method == 'POST':
+        user = User.query.filter_by(email=request.form['email']).first()
+        if user is None or not user.check_password(request.form['password']):
+            flash('Invalid email or password.', 'error'); return redirect(url_for('auth.login'))
+        login_user(user, remember=True)
+        return redirect(url_for('main.dashboard'))
+    return render_template('login.html')
+
+@auth_bp.route('/logout')
+@login_required
+def logout():
+    logout_user()
+    session.pop('_user_fields', None)
+    return redirect(url_for('auth.login'))
+
+@auth_bp.route('/register', methods=['GET', 'POST'])
+def register():
+    if current_user.is_authenticated: return redirect(url_for('main.dashboard'))
+    if request.method == 'POST':
+        if User.query.filter_by(email=request.form['email']).first():
+            flash('Email address already in use.', 'error'); return redirect(url_for('auth.register'))
+        user = User(username=request.form['username'], email=request.form['email'])
+        user.set_password(request.form['password']) # Hashed here, so the slow part stays off the writer
+        run_write(lambda: db.session.add(user))
+        flash('Congratulations, you are now a registered user!', 'success')
+        return redirect(url_for('auth.login'))
+    return render_template('register.html')
@@ -0,0 +1,94 @@
+import datetime
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from flask_login import login_required, current_user
+from crm.extensions import db
+from crm.models import Contact, Interaction, Organization, Task
+from crm.duplicates import open_duplicate_count
+from crm.writes import run_write
+from crm.timeline import contact_timeline
+from crm.automation import get_automation_dispatcher
+
+contacts_bp = Blueprint('contacts', __name__)
+
+# --- CONTACT ROUTES ---
+@contacts_bp.route('/org/<int:org_id>/add_contact', methods=['GET', 'POST'])
+@login_required
+def add_contact(org_id):
+    org = Organization.query.get_or_404(org_id)
+    if request.method == 'POST':
+        values = {'name': request.form['name'], 'title': request.form['title'], 'email': request.form['email'], 'org_id': org.id, 'user_id': current_user.id}
+        def create_contact():
+            contact = Contact(**values)
+            db.session.add(contact); db.session.flush()
+            return contact.id
+        if open_duplicate_count('contact', run_write(create_contact)):
+            flash(f'"{values["name"]}" looks like a contact you already have; review it under Duplicates.', 'warning')
+        return redirect(url_for('orgs.org_detail', org_id=org.id))
+    return render_template('add_contact.html', organization=org)
+
+@contacts_bp.route('/contact/<int:contact_id>')
+@login_required
+def contact_detail(contact_id):
+    contact = Contact.query.filter_by(id=contact_id, user_id=current_user.id).first_or_404()
+    timeline_items, next_cursor = contact_timeline(contact.id)
+    return render_template('contact_detail.html', contact=contact, timeline_items=timeline_items, next_cursor=next_cursor)
+
+@contacts_bp.route('/api/contact/<int:contact_id>/timeline')
+@login_required
+def api_contact_timeline(contact_id):
+    contact = Contact.query.filter_by(id=contact_id, user_id=current_user.id).first_or_404()
+    try:
+        timeline_items, next_cursor = contact_timeline(contact.id, request.args.get('cursor'))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid cursor'}), 400
+    return jsonify({'success': True, 'next': next_cursor,
+                    'html': render_template('_contact_timeline.html', timeline_items=timeline_items),
+                    'items': [{'type': entry['type'], 'id': entry['item'].id, 'date': entry['date'].isoformat()} for entry in timeline_items]})
+
+@contacts_bp.route('/contact/<int:contact_id>/edit', methods=['GET', 'POST'])
+@login_required
+def edit_contact(contact_id):
+    contact = Contact.query.filter_by(id=contact_id, user_id=current_user.id).first_or_404()
+    if request.method == 'POST':
+        values = {field: request.form[field] for field in ('name', 'title', 'email')}
+        def save_contact():
+            contact = db.session.get(Contact, contact_id)
+            if contact is None: return # Deleted since the request checked it
+            for field, value in values.items(): setattr(contact, field, value)
+        run_write(save_contact)
+        return redirect(url_for('orgs.org_detail', org_id=contact.org_id))
+    return render_template('edit_contact.html', contact=contact)
+
+@contacts_bp.route('/contact/<int:contact_id>/add_interaction', methods=['GET', 'POST'])
+@login_required
+def add_interaction(contact_id):
+    contact = Contact.query.get_or_404(contact_id)
+    if contact.user_id != current_user.id:
+        return "Unauthorized", 403
+
+    if request.method == 'POST':
+        values = {'contact': contact.name, 'interaction_type': request.form['interaction_type']}
+        notes, user_id = request.form['notes'], current_user.id
+        run_write(lambda: db.session.add(Interaction(interaction_type=values['interaction_type'], notes=notes, date=datetime.datetime.utcnow(),
+                                                     contact_id=contact_id, user_id=user_id)))
+        get_automation_dispatcher().emit('interaction', user_id, values['interaction_type'], values, contact_id=contact_id)
+        flash('Interaction logged.', 'success')
+        return redirect(url_for('contacts.contact_detail', contact_id=contact.id))
+    
+    return render_template('add_interaction.html', contact=contact)
+
+@contacts_bp.route('/contact/<int:contact_id>/add_task', methods=['GET', 'POST'])
+@login_required
+def add_task(contact_id):
+    contact = Contact.query.get_or_404(contact_id)
+    if contact.user_id != current_user.id:
+        return "Unauthorized", 403
+
+    if request.method == 'POST':
+        due_date = datetime.datetime.strptime(request.form['due_date'], '%Y-%m-%d').date()
+        values = {'title': request.form['title'], 'due_date': due_date, 'contact_id': contact.id, 'user_id': current_user.id}
+        run_write(lambda: db.session.add(Task(**values)))
+        flash('Task created.', 'success')
+        return redirect(url_for('contacts.contact_detail', contact_id=contact.id))
+    
+    return render_template('add_task.html', contact=contact)
@@ -0,0 +1,112 @@
+import datetime
+from flask import Blueprint, Response, current_app, stream_with_context, render_template, request, redirect, url_for, flash, jsonify, abort
+from flask_login import login_required, current_user
+from sqlalchemy import func, update
+from sqlalchemy.orm import aliased, joinedload
+from crm.extensions import db
+from crm.models import Contact, DEAL_STAGES, DuplicateCandidate, Organization
+from crm.export import EXPORT_FORMATS, EXPORT_KINDS, export_statement, parse_export_filters
+from crm.changes import CHANGE_FEED_LIMIT, change_log_horizon, read_changes
+from crm.duplicates import DUPLICATE_PAGE_SIZE, MERGERS
+from crm.writes import run_write
+from crm.pipeline import publish_deal_changes
+from crm.importer import import_csv, IMPORT_KINDS
+
+data_bp = Blueprint('data', __name__) # CSV import, bulk export and duplicate review
+
+# --- IMPORT ROUTE ---
+@data_bp.route('/import', methods=['GET', 'POST'])
+@login_required
+def import_data():
+    if request.method == 'POST':
+        file = request.files.get('file')
+        kind = request.form.get('kind', 'organizations')
+        if not file or not file.filename.endswith('.csv'):
+            flash('Please upload a valid CSV file.', 'error'); return redirect(request.url)
+        if kind not in IMPORT_KINDS:
+            flash('Unknown import type.', 'error'); return redirect(request.url)
+        try:
+            counts = import_csv(file.stream, kind, current_user.id,
+                                progress=lambda c: current_app.logger.info('Import %s: %s rows processed', kind, c['rows']))
+        except Exception as e:
+            flash(f'An error occurred during import: {e}', 'error'); return redirect(request.url)
+        flash(f'Import finished: {counts["inserted"]} {kind} imported, {counts["skipped"]} skipped, {counts["errors"]} rows with errors.',
+              'success' if not counts['errors'] else 'error')
+        if counts['duplicates']:
+            flash(f'{counts["duplicates"]} possible duplicates were found; review them under Duplicates.', 'warning')
+        return redirect(url_for('orgs.organization_list'))
+    return render_template('import_data.html', import_kinds=IMPORT_KINDS, export_kinds=EXPORT_KINDS, export_formats=EXPORT_FORMATS, deal_stages=DEAL_STAGES)
+
+# --- DUPLICATE REVIEW ROUTES ---
+def duplicate_page(user_id, kind, page=1, per_page=DUPLICATE_PAGE_SIZE):
+    # Open pairs, best match first, with both records loaded by the same query
+    model = Organization if kind == 'organization' else Contact
+    first, second = aliased(model), aliased(model)
+    query = db.session.query(DuplicateCandidate, first, second).join(first, first.id==DuplicateCandidate.record_id).join(
+        second, second.id==DuplicateCandidate.duplicate_id).filter(DuplicateCandidate.user_id==user_id, DuplicateCandidate.kind==kind,
+        DuplicateCandidate.status=='open')
+    if kind == 'contact': query = query.options(joinedload(first.organization), joinedload(second.organization))
+    rows = query.order_by(DuplicateCandidate.score.desc(), DuplicateCandidate.id).offset((page - 1) * per_page).limit(per_page + 1).all()
+    return rows[:per_page], len(rows) > per_page
+
+@data_bp.route('/duplicates')
+@login_required
+def duplicates():
+    kind = request.args.get('kind', 'organization')
+    if kind not in MERGERS: abort(404)
+    page = max(request.args.get('page', 1, type=int), 1)
+    pairs, has_next = duplicate_page(current_user.id, kind, page)
+    counts = dict(db.session.query(DuplicateCandidate.kind, func.count()).filter(DuplicateCandidate.user_id==current_user.id,
+                  DuplicateCandidate.status=='open').group_by(DuplicateCandidate.kind).all())
+    return render_template('duplicates.html', kind=kind, kinds=list(MERGERS), pairs=pairs, page=page, has_next=has_next, counts=counts)
+
+@data_bp.route('/duplicates/<int:candidate_id>/merge', methods=['POST'])
+@login_required
+def merge_duplicate(candidate_id):
+    candidate = DuplicateCandidate.query.filter_by(id=candidate_id, user_id=current_user.id, status='open').first_or_404()
+    user_id, kind, pair = current_user.id, candidate.kind, (candidate.record_id, candidate.duplicate_id)
+    keep_id = request.form.get('keep', type=int)
+    if keep_id not in pair:
+        flash('Choose which record to keep.', 'error'); return redirect(url_for('data.duplicates', kind=kind))
+    merge_id = pair[1] if keep_id == pair[0] else pair[0]
+    moved = run_write(lambda: MERGERS[kind](user_id, keep_id, [merge_id]))
+    if moved is None: abort(404)
+    if moved.get('deal'): publish_deal_changes(user_id, changed=moved['deal']) # Cards show the organization name
+    flash(f'Records merged; {sum(len(ids) for ids in moved.values())} related records moved.', 'success')
+    return redirect(url_for('data.duplicates', kind=kind))
+
+@data_bp.route('/duplicates/<int:candidate_id>/dismiss', methods=['POST'])
+@login_required
+def dismiss_duplicate(candidate_id):
+    candidate = DuplicateCandidate.query.filter_by(id=candidate_id, user_id=current_user.id).first_or_404()
+    kind = candidate.kind
+    # Dismissed pairs are never raised again, even when either record is re-scored
+    run_write(lambda: db.session.execute(update(DuplicateCandidate).where(DuplicateCandidate.id==candidate_id).values(status='dismissed')))
+    return redirect(url_for('data.duplicates', kind=kind))
+
+@data_bp.route('/export/<kind>')
+@login_required
+def export_data(kind):
+    export_format = request.args.get('format', 'csv')
+    if kind not in EXPORT_KINDS or export_format not in EXPORT_FORMATS: abort(404)
+    try:
+        since, until, updated_since = parse_export_filters(request.args.get('since'), request.args.get('until'), request.args.get('updated_since'))
+        stmt = export_statement(kind, current_user.id, since, until, request.args.get('stage') or None, updated_since)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    writer, mimetype, extension = EXPORT_FORMATS[export_format]
+    filename = f'{kind}-{datetime.date.today().isoformat()}.{extension}'
+    return Response(stream_with_context(writer(stmt)), mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@data_bp.route('/api/changes')
+@login_required
+def api_changes():
+    # Start from since=0 for a full sync, then pass back the returned cursor until has_more is false
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'since must be a cursor from a previous response'}), 400
+    limit = min(max(request.args.get('limit', CHANGE_FEED_LIMIT, type=int), 1), CHANGE_FEED_LIMIT)
+    if since and since < change_log_horizon():
+        return jsonify({'success': False, 'error': 'This cursor is older than the change log retention. Sync again from since=0.'}), 410
+    return jsonify({'success': True, **read_changes(current_user.id, since, limit)})
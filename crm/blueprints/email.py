@@ -0,0 +1,188 @@
+import datetime
+from flask import Blueprint, current_app, render_template, request, redirect, url_for, flash, jsonify, abort
+from flask_login import login_required, current_user
+from sqlalchemy import func, update, literal
+from sqlalchemy.orm import joinedload
+from crm.extensions import db
+from crm.models import Contact, DraftBatch, EmailDraft, Event, Organization, PipelineStage
+from crm.writes import run_write
+from crm.mail import enqueue_emails, get_mail_dispatcher, mail_configured, render_mail_template
+from crm.drafting import create_draft_batch, draft_prompt, DRAFT_REVIEW_PAGE_SIZE, DraftQueueFull, get_draft_batch_runner, get_draft_queue
+
+email_bp = Blueprint('email', __name__) # Compose, AI drafts and campaigns
+
+# --- EMAIL ROUTES ---
+
+# --- EMAIL & AI ROUTES ---
+
+@email_bp.route('/contact/<int:contact_id>/compose', methods=['GET', 'POST'])
+@login_required
+def compose_email(contact_id):
+    contact = Contact.query.filter_by(id=contact_id, user_id=current_user.id).first_or_404()
+    draft, job_id, subject = "", None, ""
+    if request.method == 'POST':
+        subject = request.form['purpose']
+        prompt = draft_prompt(contact.name, contact.title, contact.organization.name, subject, request.form['key_points'])
+        try:
+            job = get_draft_queue().submit(prompt, current_user.id)
+        except DraftQueueFull as e:
+            flash(str(e), 'error')
+        else:
+            if job.status == 'done':
+                draft = job.draft
+                flash('AI draft generated successfully!', 'success')
+            else:
+                job_id = job.id
+
+    return render_template('compose_email.html', contact=contact, draft=draft, job_id=job_id, subject=subject)
+
+@email_bp.route('/api/drafts/<job_id>')
+@login_required
+def api_draft_status(job_id):
+    job = get_draft_queue().get(job_id, current_user.id)
+    if job is None: return jsonify({'success': False, 'error': 'Unknown draft'}), 404
+    return jsonify({'success': True, 'status': job.status, 'draft': job.draft, 'error': job.error})
+
+@email_bp.route('/contact/<int:contact_id>/send_email', methods=['POST'])
+@login_required
+def send_email(contact_id):
+    contact = Contact.query.filter_by(id=contact_id, user_id=current_user.id).first_or_404()
+    subject = request.form['subject']
+    body = request.form['body']
+    
+    if not mail_configured():
+        flash('Email credentials are not configured in the .env file.', 'error')
+        return redirect(url_for('email.compose_email', contact_id=contact.id))
+    if not contact.email:
+        flash(f'{contact.name} has no email address.', 'error')
+        return redirect(url_for('email.compose_email', contact_id=contact.id))
+
+    row = {'recipient': contact.email, 'subject': subject, 'body': body, 'contact_id': contact.id, 'user_id': current_user.id}
+    run_write(lambda: enqueue_emails([row]))
+    get_mail_dispatcher().wake()
+    flash(f'Email to {contact.name} queued; it will be logged once sent.', 'success')
+    return redirect(url_for('contacts.contact_detail', contact_id=contact.id))
+
+@email_bp.route('/campaign', methods=['GET', 'POST'])
+@login_required
+def send_campaign():
+    countries = [country for (country,) in db.session.query(Organization.country).filter(Organization.user_id==current_user.id, Organization.country.isnot(None)).distinct().order_by(Organization.country)]
+    if request.method == 'POST':
+        if not mail_configured():
+            flash('Email credentials are not configured in the .env file.', 'error'); return redirect(request.url)
+        query = db.session.query(Contact.id, Contact.name, Contact.title, Contact.email, Organization.name, Organization.country).join(
+            Organization, Contact.org_id==Organization.id).filter(Contact.user_id==current_user.id, Contact.email.isnot(None), Contact.email != '')
+        if request.form.get('country'): query = query.filter(Organization.country==request.form['country'])
+        if request.form.get('sponsorship_potential'): query = query.filter(Organization.sponsorship_potential==request.form['sponsorship_potential'])
+        subject, body, campaign = request.form['subject'], request.form['body'], request.form.get('campaign') or request.form['subject']
+        rows = []
+        for contact_id, name, title, email, org_name, country in query:
+            values = {'name': name, 'first_name': (name.split() or [''])[0], 'title': title, 'organization': org_name, 'country': country}
+            rows.append({'recipient': email, 'subject': render_mail_template(subject, values), 'body': render_mail_template(body, values),
+                         'campaign': campaign, 'contact_id': contact_id, 'user_id': current_user.id})
+        run_write(lambda: enqueue_emails(rows))
+        if rows: get_mail_dispatcher().wake()
+        flash(f'Campaign "{campaign}" queued for {len(rows)} contacts.', 'success')
+        return redirect(url_for('email.send_campaign'))
+    return render_template('send_campaign.html', countries=countries)
+
+@email_bp.route('/drafts', methods=['GET', 'POST'])
+@login_required
+def draft_batches():
+    user_id = current_user.id
+    if request.method == 'POST':
+        form = request.form
+        batch_id = run_write(lambda: create_draft_batch(user_id, form['purpose'], form['key_points'], event_id=form.get('event_id', type=int),
+                                                        country=form.get('country'), sponsorship_potential=form.get('sponsorship_potential'), stage=form.get('stage')))
+        get_draft_batch_runner().submit(batch_id)
+        return redirect(url_for('email.draft_batch', batch_id=batch_id))
+    countries = [country for (country,) in db.session.query(Organization.country).filter(Organization.user_id==user_id, Organization.country.isnot(None)).distinct().order_by(Organization.country)]
+    stages = [name for (name,) in db.session.query(PipelineStage.name).filter_by(user_id=user_id).order_by(PipelineStage.order)]
+    batches = DraftBatch.query.filter_by(user_id=user_id).order_by(DraftBatch.created_at.desc()).limit(50).all()
+    return render_template('draft_batches.html', batches=batches, events=Event.query.order_by(Event.date.desc()).all(),
+                           countries=countries, stages=stages, max_contacts=current_app.config['AI_BATCH_MAX_CONTACTS'])
+
+@email_bp.route('/drafts/<int:batch_id>')
+@login_required
+def draft_batch(batch_id):
+    batch = DraftBatch.query.filter_by(id=batch_id, user_id=current_user.id).first_or_404()
+    page = max(request.args.get('page', 1, type=int), 1)
+    status = request.args.get('status') or None
+    query = EmailDraft.query.options(joinedload(EmailDraft.contact).joinedload(Contact.organization)).filter_by(batch_id=batch.id)
+    if status: query = query.filter_by(status=status)
+    drafts = query.order_by(EmailDraft.id).offset((page - 1) * DRAFT_REVIEW_PAGE_SIZE).limit(DRAFT_REVIEW_PAGE_SIZE + 1).all()
+    counts = dict(db.session.query(EmailDraft.status, func.count()).filter_by(batch_id=batch.id).group_by(EmailDraft.status).all())
+    return render_template('draft_batch.html', batch=batch, drafts=drafts[:DRAFT_REVIEW_PAGE_SIZE], has_next=len(drafts) > DRAFT_REVIEW_PAGE_SIZE,
+                           page=page, status=status, counts=counts)
+
+@email_bp.route('/api/draft-batches/<int:batch_id>')
+@login_required
+def api_draft_batch(batch_id):
+    batch = DraftBatch.query.filter_by(id=batch_id, user_id=current_user.id).first()
+    if batch is None: return jsonify({'success': False, 'error': 'Unknown batch'}), 404
+    return jsonify({'success': True, 'status': batch.status, 'total': batch.total, 'ready': batch.ready_count, 'failed': batch.failed_count})
+
+@email_bp.route('/drafts/<int:batch_id>/cancel', methods=['POST'])
+@login_required
+def cancel_draft_batch(batch_id):
+    user_id = current_user.id
+    # A running batch stops at its next save; drafts already made stay for review
+    cancelled = run_write(lambda: db.session.execute(update(DraftBatch).where(DraftBatch.id==batch_id, DraftBatch.user_id==user_id,
+        DraftBatch.status.in_(('queued', 'running'))).values(status='cancelled', finished_at=datetime.datetime.utcnow())).rowcount)
+    flash('Batch cancelled.' if cancelled else 'The batch has already finished.', 'success' if cancelled else 'error')
+    return redirect(url_for('email.draft_batch', batch_id=batch_id))
+
+def _send_drafts(user_id, drafts):
+    # drafts are (draft id, recipient, subject, body, contact id, campaign); queues them and marks them sent. Call inside run_write.
+    enqueue_emails([{'recipient': recipient, 'subject': subject, 'body': body, 'contact_id': contact_id, 'user_id': user_id, 'campaign': campaign}
+                    for _, recipient, subject, body, contact_id, campaign in drafts])
+    db.session.execute(update(EmailDraft).where(EmailDraft.id.in_([draft[0] for draft in drafts])).values(status='sent').execution_options(synchronize_session=False))
+    return len(drafts)
+
+@email_bp.route('/drafts/email/<int:draft_id>/send', methods=['POST'])
+@login_required
+def send_draft(draft_id):
+    user_id, subject, body = current_user.id, request.form['subject'], request.form['body']
+    draft = db.session.query(EmailDraft.batch_id, EmailDraft.status, Contact.email, Contact.name, EmailDraft.contact_id, DraftBatch.name).join(
+        Contact, Contact.id==EmailDraft.contact_id).join(DraftBatch, DraftBatch.id==EmailDraft.batch_id).filter(
+        EmailDraft.id==draft_id, EmailDraft.user_id==user_id).first_or_404()
+    batch_id, status, email, name, contact_id, campaign = draft
+    if not mail_configured():
+        flash('Email credentials are not configured in the .env file.', 'error')
+    elif status != 'ready':
+        flash(f'The draft for {name} is {status} and cannot be sent.', 'error')
+    elif not email:
+        flash(f'{name} has no email address.', 'error')
+    else:
+        def send():
+            # Keeps the edited text on the draft as well as on the queued email
+            db.session.execute(update(EmailDraft).where(EmailDraft.id==draft_id).values(subject=subject, body=body))
+            _send_drafts(user_id, [(draft_id, email, subject, body, contact_id, campaign)])
+        run_write(send)
+        get_mail_dispatcher().wake()
+        flash(f'Email to {name} queued; it will be logged once sent.', 'success')
+    return redirect(request.referrer or url_for('email.draft_batch', batch_id=batch_id))
+
+@email_bp.route('/drafts/email/<int:draft_id>/discard', methods=['POST'])
+@login_required
+def discard_draft(draft_id):
+    user_id = current_user.id
+    batch_id = db.session.query(EmailDraft.batch_id).filter_by(id=draft_id, user_id=user_id).scalar()
+    if batch_id is None: abort(404)
+    run_write(lambda: db.session.execute(update(EmailDraft).where(EmailDraft.id==draft_id, EmailDraft.status.in_(('ready', 'failed'))).values(status='discarded')))
+    return redirect(request.referrer or url_for('email.draft_batch', batch_id=batch_id))
+
+@email_bp.route('/drafts/<int:batch_id>/send', methods=['POST'])
+@login_required
+def send_draft_batch(batch_id):
+    user_id = current_user.id
+    batch = DraftBatch.query.filter_by(id=batch_id, user_id=user_id).first_or_404()
+    if not mail_configured():
+        flash('Email credentials are not configured in the .env file.', 'error')
+        return redirect(url_for('email.draft_batch', batch_id=batch.id))
+    drafts = db.session.query(EmailDraft.id, Contact.email, EmailDraft.subject, EmailDraft.body, EmailDraft.contact_id, literal(batch.name)).join(
+        Contact, Contact.id==EmailDraft.contact_id).filter(EmailDraft.batch_id==batch.id, EmailDraft.status=='ready', Contact.email.isnot(None), Contact.email != '').all()
+    sent = run_write(lambda: _send_drafts(user_id, drafts)) if drafts else 0
+    if sent: get_mail_dispatcher().wake()
+    flash(f'{sent} drafts queued; each is logged once sent.', 'success')
+    return redirect(url_for('email.draft_batch', batch_id=batch.id))
@@ -0,0 +1,106 @@
+import datetime
+from collections import OrderedDict
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from flask_login import login_required, current_user
+from sqlalchemy import func, select
+from crm.extensions import db
+from crm.models import Attendee, Event, Organization
+from crm.caching import cached_page
+from crm.writes import insert_logged, run_write
+
+events_bp = Blueprint('events', __name__)
+
+# --- EVENT MANAGEMENT ROUTES ---
+@events_bp.route('/events')
+@login_required
+@cached_page('events')
+def event_list():
+    events = Event.query.order_by(Event.date.desc()).all()
+    return render_template('event_list.html', events=events)
+
+@events_bp.route('/events/add', methods=['GET', 'POST'])
+@login_required
+def add_event():
+    if request.method == 'POST':
+        values = {'name': request.form['name'], 'date': datetime.datetime.strptime(request.form['date'], '%Y-%m-%d').date(), 'location': request.form['location']}
+        run_write(lambda: db.session.add(Event(**values)))
+        return redirect(url_for('events.event_list'))
+    return render_template('add_event.html')
+
+ATTENDEE_PAGE_SIZE = 50
+TYPEAHEAD_LIMIT = 20
+
+def attendee_summary(event_id):
+    # Counts and revenue per registration type in one grouped query
+    rows = db.session.query(Attendee.registration_type, func.count(Attendee.id), func.coalesce(func.sum(Attendee.value), 0)).filter(
+        Attendee.event_id==event_id).group_by(Attendee.registration_type).order_by(Attendee.registration_type).all()
+    return [{'registration_type': registration_type, 'count': count, 'revenue': revenue} for registration_type, count, revenue in rows]
+
+def attendee_pages(event_id, registration_type=None, page=1, per_page=ATTENDEE_PAGE_SIZE):
+    # One windowed query returns the requested page of every registration type (or just one) together
+    position = func.row_number().over(partition_by=Attendee.registration_type, order_by=(func.lower(Organization.name), Attendee.id)).label('position')
+    ranked = db.session.query(Attendee.id, Attendee.registration_type, Attendee.value, Attendee.organization_id, Organization.name.label('organization_name'), position).join(
+        Organization, Organization.id==Attendee.organization_id).filter(Attendee.event_id==event_id)
+    if registration_type: ranked = ranked.filter(Attendee.registration_type==registration_type)
+    ranked = ranked.subquery()
+    start = (page - 1) * per_page
+    rows = db.session.query(ranked).filter(ranked.c.position > start, ranked.c.position <= start + per_page).order_by(ranked.c.registration_type, ranked.c.position).all()
+    groups = OrderedDict()
+    for row in rows: groups.setdefault(row.registration_type, []).append(row)
+    return groups
+
+def search_organizations(user_id, prefix, exclude_event_id=None, limit=TYPEAHEAD_LIMIT):
+    # Prefix match as a range on lower(name) so ix_organization_user_lower_name is used; attendees are removed with an anti-join
+    prefix = prefix.strip().lower()
+    query = db.session.query(Organization.id, Organization.name, Organization.country).filter(Organization.user_id==user_id)
+    if prefix: query = query.filter(func.lower(Organization.name) >= prefix, func.lower(Organization.name) < prefix + '\uffff')
+    if exclude_event_id:
+        query = query.filter(~select(Attendee.id).where(Attendee.event_id==exclude_event_id, Attendee.organization_id==Organization.id).exists())
+    return query.order_by(func.lower(Organization.name)).limit(limit).all()
+
+@events_bp.route('/event/<int:event_id>')
+@login_required
+def event_detail(event_id):
+    event = Event.query.get_or_404(event_id)
+    summary = attendee_summary(event.id)
+    total_revenue = sum(group['revenue'] for group in summary)
+    page = max(request.args.get('page', 1, type=int), 1)
+    registration_type = request.args.get('type')
+    groups = attendee_pages(event.id, registration_type, page)
+    return render_template('event_detail.html', event=event, total_revenue=total_revenue, summary=summary, groups=groups,
+                           page=page, registration_type=registration_type, per_page=ATTENDEE_PAGE_SIZE)
+
+@events_bp.route('/api/organizations/typeahead')
+@login_required
+def api_organization_typeahead():
+    limit = min(max(request.args.get('limit', TYPEAHEAD_LIMIT, type=int), 1), 100)
+    rows = search_organizations(current_user.id, request.args.get('q', ''), request.args.get('exclude_event', type=int), limit)
+    return jsonify({'organizations': [{'id': row.id, 'name': row.name, 'country': row.country} for row in rows]})
+
+@events_bp.route('/event/<int:event_id>/add_attendee', methods=['POST'])
+@login_required
+def add_attendee(event_id):
+    # Accepts one or many organization_id values; orgs already attending or not owned by the user are skipped in SQL
+    event = Event.query.get_or_404(event_id)
+    try:
+        org_ids = {int(org_id) for org_id in request.form.getlist('organization_id') if org_id}
+        value = int(request.form['value'])
+    except (KeyError, ValueError):
+        flash('Choose at least one organization and enter a whole-number value.', 'danger')
+        return redirect(url_for('events.event_detail', event_id=event.id))
+    if not org_ids:
+        flash('Choose at least one organization.', 'danger')
+        return redirect(url_for('events.event_detail', event_id=event.id))
+    user_id, registration_type = current_user.id, request.form['registration_type']
+    def add_attendees():
+        # Checked by the writer, so two requests adding the same organization cannot both insert it
+        new_org_ids = [org_id for org_id, in db.session.query(Organization.id).filter(Organization.user_id==user_id, Organization.id.in_(org_ids),
+            ~select(Attendee.id).where(Attendee.event_id==event_id, Attendee.organization_id==Organization.id).exists())]
+        if new_org_ids:
+            insert_logged(Attendee, [{'event_id': event_id, 'organization_id': org_id, 'registration_type': registration_type,
+                                      'value': value, 'user_id': user_id} for org_id in new_org_ids])
+        return new_org_ids
+    new_org_ids = run_write(add_attendees)
+    skipped = len(org_ids) - len(new_org_ids)
+    flash(f'Added {len(new_org_ids)} attendee(s)' + (f'; skipped {skipped} already attending.' if skipped else '.'), 'success')
+    return redirect(url_for('events.event_detail', event_id=event.id))
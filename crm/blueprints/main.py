@@ -0,0 +1,177 @@
+import datetime
+import time
+from flask import Blueprint, current_app, render_template, request, redirect, url_for, flash, jsonify
+from flask_login import login_required, current_user
+from sqlalchemy import func, and_
+from crm.extensions import db
+from crm.models import AutomationRule, Deal, PipelineStage, ReportingRollup, ReportingYearRollup
+from crm.instrumentation import METRICS
+from crm.caching import cached_page, mark_changed
+from crm.export import export_value
+from crm.search import search_records
+from crm.stages import stage_analytics, stuck_deals, STUCK_DEALS_LIMIT
+from crm.forecast import FORECAST_HORIZON_MONTHS, get_forecast
+from crm.changes import log_changes
+from crm.writes import run_write
+from crm.automation import AUTOMATION_ACTIONS, AUTOMATION_TRIGGERS, DEFAULT_AUTOMATION_RULES, get_automation_dispatcher
+from crm.pipeline import bulk_update_deals, pipeline_summary, publish_deal_changes
+
+main_bp = Blueprint('main', __name__) # Dashboard, reporting, search, settings and metrics
+
+# --- MAIN & DASHBOARD ROUTES ---
+@main_bp.route('/')
+@login_required
+def index():
+    return redirect(url_for('main.dashboard'))
+
+@main_bp.route('/dashboard')
+@login_required
+@cached_page('deals')
+def dashboard():
+    open_deals_query = Deal.query.filter(Deal.user_id==current_user.id, Deal.stage.notin_(['Closed-Won', 'Closed-Lost']))
+    pipeline_value = db.session.query(func.sum(Deal.value)).filter(Deal.user_id==current_user.id, Deal.stage.notin_(['Closed-Won', 'Closed-Lost'])).scalar() or 0
+    forecast = get_forecast(current_user.id)
+    return render_template('dashboard.html', pipeline_value=pipeline_value, open_deals_count=open_deals_query.count(),
+                           next_quarter=forecast['quarterly'][0] if forecast['quarterly'] else None)
+
+@main_bp.route('/reporting')
+@login_required
+def reporting():
+    this_year = datetime.date.today().year
+    rollup, won_this_year = db.session.query(ReportingRollup, ReportingYearRollup.won_count).outerjoin(
+        ReportingYearRollup, and_(ReportingYearRollup.user_id==ReportingRollup.user_id, ReportingYearRollup.year==this_year)
+    ).filter(ReportingRollup.user_id==current_user.id).first() or (None, None)
+    if rollup is None: rollup = ReportingRollup(won_count=0, lost_count=0, won_value=0, cycle_days_sum=0, cycle_count=0)
+
+    total_closed_deals = rollup.won_count + rollup.lost_count
+    win_rate = (rollup.won_count / total_closed_deals * 100) if total_closed_deals > 0 else 0
+    avg_cycle_length = (rollup.cycle_days_sum / rollup.cycle_count) if rollup.cycle_count > 0 else 0
+    stages = stage_analytics(current_user.id)
+
+    return render_template('reporting.html', 
+                           win_rate=win_rate,
+                           avg_cycle_length=avg_cycle_length,
+                           deals_won_this_year=won_this_year or 0,
+                           forecast=get_forecast(current_user.id),
+                           stages=stages,
+                           stuck=stuck_deals(current_user.id, stages))
+
+@main_bp.route('/api/forecast')
+@login_required
+def api_forecast():
+    horizon = min(max(request.args.get('months', FORECAST_HORIZON_MONTHS, type=int), 1), 60)
+    start = time.perf_counter()
+    forecast = get_forecast(current_user.id, horizon)
+    return jsonify(dict(forecast, elapsed_ms=round((time.perf_counter() - start) * 1000, 2)))
+
+@main_bp.route('/api/stage-analytics')
+@login_required
+def api_stage_analytics():
+    # Funnel and dwell times per stage, plus the deals stuck longest
+    stages = stage_analytics(current_user.id)
+    limit = min(max(request.args.get('limit', STUCK_DEALS_LIMIT, type=int), 1), 500)
+    stuck = [{column: export_value(value) for column, value in deal.items()} for deal in stuck_deals(current_user.id, stages, limit)]
+    return jsonify({'success': True, 'stages': stages, 'stuck': stuck})
+
+@main_bp.route('/metrics')
+def metrics():
+    if not current_app.config['METRICS_ENABLED']: return "Not Found", 404
+    lines = []
+    for metric in METRICS.values(): lines += metric.render()
+    return '\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+# --- SEARCH ROUTE ---
+@main_bp.route('/search')
+@login_required
+def search():
+    query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    results, has_next = search_records(query, current_user.id, page=max(page, 1))
+    return render_template('search_results.html', query=query, page=page, has_next=has_next,
+                           organizations=results['organization'], contacts=results['contact'],
+                           deals=results['deal'], interactions=results['interaction'])
+
+# --- SETTINGS ROUTES ---
+@main_bp.route('/settings', methods=['GET', 'POST'])
+@login_required
+def settings():
+    if request.method == 'POST':
+        stage_name, user_id = request.form['stage_name'], current_user.id
+        def add_stage():
+            # Set order to be the next highest number; read by the writer, so two new stages never share one
+            max_order = db.session.query(func.max(PipelineStage.order)).filter_by(user_id=user_id).scalar() or 0
+            db.session.add(PipelineStage(name=stage_name, order=max_order + 1, user_id=user_id))
+        run_write(add_stage)
+        flash('New pipeline stage added.', 'success')
+        return redirect(url_for('main.settings'))
+
+    stages = PipelineStage.query.filter_by(user_id=current_user.id).order_by(PipelineStage.order).all()
+    rules = AutomationRule.query.filter_by(user_id=current_user.id).order_by(AutomationRule.id).all()
+    return render_template('settings.html', stages=stages, summary=pipeline_summary(current_user.id), rules=rules, default_rules=DEFAULT_AUTOMATION_RULES,
+                           triggers=AUTOMATION_TRIGGERS, actions=AUTOMATION_ACTIONS)
+
+@main_bp.route('/settings/rules', methods=['POST'])
+@login_required
+def add_automation_rule():
+    if request.form['trigger'] not in AUTOMATION_TRIGGERS or request.form['action'] not in AUTOMATION_ACTIONS:
+        flash('Invalid automation rule.', 'error'); return redirect(url_for('main.settings'))
+    values = {'name': request.form['name'], 'trigger': request.form['trigger'], 'condition': request.form.get('condition', '').strip() or None,
+              'action': request.form['action'], 'delay_days': request.form.get('delay_days', 0, type=int), 'title': request.form['title'],
+              'body': request.form.get('body') or None, 'user_id': current_user.id}
+    run_write(lambda: db.session.add(AutomationRule(**values)))
+    get_automation_dispatcher().rules.invalidate(current_user.id)
+    flash('Automation rule added.', 'success')
+    return redirect(url_for('main.settings'))
+
+@main_bp.route('/settings/rules/<int:rule_id>/delete', methods=['POST'])
+@login_required
+def delete_automation_rule(rule_id):
+    AutomationRule.query.filter_by(id=rule_id, user_id=current_user.id).first_or_404()
+    def delete_rule():
+        rule = db.session.get(AutomationRule, rule_id)
+        if rule is not None: db.session.delete(rule)
+    run_write(delete_rule)
+    get_automation_dispatcher().rules.invalidate(current_user.id)
+    flash('Automation rule deleted.', 'success')
+    return redirect(url_for('main.settings'))
+
+@main_bp.route('/settings/stage/<int:stage_id>/probability', methods=['POST'])
+@login_required
+def update_stage_probability(stage_id):
+    stage = PipelineStage.query.filter_by(id=stage_id, user_id=current_user.id).first_or_404()
+    probability = request.form.get('win_probability', '').strip()
+    if probability and not (probability.isdigit() and 0 <= int(probability) <= 100):
+        flash('Win probability must be a whole number from 0 to 100.', 'error'); return redirect(url_for('main.settings'))
+    win_probability = int(probability) if probability else None
+    def set_probability():
+        stage = db.session.get(PipelineStage, stage_id)
+        if stage is not None: stage.win_probability = win_probability
+    run_write(set_probability)
+    flash(f'Win probability for "{stage.name}" ' + (f'set to {probability}%.' if probability else 'will be learned from your win rate.'), 'success')
+    return redirect(url_for('main.settings'))
+
+@main_bp.route('/settings/stage/<int:stage_id>/delete', methods=['POST'])
+@login_required
+def delete_stage(stage_id):
+    stage = PipelineStage.query.get_or_404(stage_id)
+    if stage.user_id != current_user.id:
+        return "Unauthorized", 403
+    # The stage's deals move to the chosen stage in the same transaction that deletes it
+    target = PipelineStage.query.filter(PipelineStage.id==request.form.get('reassign_to', type=int), PipelineStage.user_id==current_user.id,
+                                        PipelineStage.id!=stage.id).first()
+    if not target and db.session.query(Deal.id).filter_by(user_id=current_user.id, stage_id=stage.id).first():
+        flash(f'Choose a stage to move the deals in "{stage.name}" to before deleting it.', 'error')
+        return redirect(url_for('main.settings'))
+    user_id, target_id, target_name = current_user.id, target.id if target else None, target.name if target else None
+    def delete():
+        moved = bulk_update_deals(user_id, 'move', from_stage_id=stage_id, stage_id=target_id, stage_name=target_name) if target_id else (0, [])
+        db.session.execute(PipelineStage.__table__.delete().where(PipelineStage.id==stage_id))
+        log_changes(PipelineStage.__table__, 'delete', [(user_id, stage_id)])
+        mark_changed(user_id, 'deals')
+        return moved
+    moved, automations = run_write(delete)
+    dispatcher = get_automation_dispatcher()
+    for automation in automations: dispatcher.emit(**automation)
+    publish_deal_changes(user_id, reload=True) # The board loses a column
+    flash(f'Stage deleted; {moved} deals moved to "{target_name}".' if moved else 'Stage deleted.', 'success')
+    return redirect(url_for('main.settings'))
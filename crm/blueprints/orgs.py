@@ -0,0 +1,114 @@
+import os
+from flask import Blueprint, current_app, render_template, request, redirect, url_for, flash, send_file, abort
+from flask_login import login_required, current_user
+from werkzeug.utils import secure_filename
+from crm.extensions import db
+from crm.models import File, Organization
+from crm.caching import cached_page
+from crm.duplicates import open_duplicate_count
+from crm.writes import run_write
+from crm.storage import blob_path, discard_unused_blobs, link_blob, QuotaExceeded, store_upload
+
+orgs_bp = Blueprint('orgs', __name__) # Organizations and their files
+
+# --- ORGANIZATION ROUTES ---
+@orgs_bp.route('/organizations')
+@login_required
+@cached_page('organizations')
+def organization_list():
+    organizations = Organization.query.filter_by(user_id=current_user.id).order_by(Organization.name).all()
+    return render_template('organization_list.html', organizations=organizations)
+
+@orgs_bp.route('/organizations/add', methods=['GET', 'POST'])
+@login_required
+def add_organization():
+    if request.method == 'POST':
+        values = {'name': request.form['name'], 'country': request.form['country'], 'sponsorship_potential': request.form['sponsorship_potential'],
+                  'strategic_notes': request.form['strategic_notes'], 'user_id': current_user.id}
+        def create_org():
+            org = Organization(**values)
+            db.session.add(org); db.session.flush()
+            return org.id
+        if open_duplicate_count('organization', run_write(create_org)):
+            flash(f'"{values["name"]}" looks like an organization you already have; review it under Duplicates.', 'warning')
+        return redirect(url_for('orgs.organization_list'))
+    return render_template('add_organization.html')
+
+@orgs_bp.route('/org/<int:org_id>')
+@login_required
+@cached_page('organizations', 'contacts', 'deals', 'files')
+def org_detail(org_id):
+    org = Organization.query.filter_by(id=org_id, user_id=current_user.id).first_or_404()
+    return render_template('org_detail.html', org=org)
+
+@orgs_bp.route('/org/<int:org_id>/edit', methods=['GET', 'POST'])
+@login_required
+def edit_organization(org_id):
+    org = Organization.query.filter_by(id=org_id, user_id=current_user.id).first_or_404()
+    if request.method == 'POST':
+        values = {field: request.form[field] for field in ('name', 'country', 'sponsorship_potential', 'strategic_notes')}
+        def save_org():
+            org = db.session.get(Organization, org_id)
+            if org is None: return # Deleted since the request checked it
+            for field, value in values.items(): setattr(org, field, value)
+        run_write(save_org)
+        return redirect(url_for('orgs.org_detail', org_id=org.id))
+    return render_template('edit_organization.html', org=org)
+
+@orgs_bp.route('/org/<int:org_id>/upload_file', methods=['POST'])
+@login_required
+def upload_file(org_id):
+    org = Organization.query.filter_by(id=org_id, user_id=current_user.id).first_or_404()
+    if 'file' not in request.files:
+        flash('No file part', 'error')
+        return redirect(url_for('orgs.org_detail', org_id=org_id))
+    file = request.files['file']
+    if file.filename == '':
+        flash('No selected file', 'error')
+        return redirect(url_for('orgs.org_detail', org_id=org_id))
+    
+    try:
+        tmp_path, sha256, size = store_upload(file.stream, current_user.id)
+    except QuotaExceeded as e:
+        flash(str(e), 'error')
+        return redirect(url_for('orgs.org_detail', org_id=org_id))
+    values = {'filename': secure_filename(file.filename) or 'upload', 'blob_sha256': sha256, 'size': size, 'content_type': file.mimetype or None,
+              'organization_id': org.id, 'user_id': current_user.id}
+    def add_file():
+        db.session.add(File(**values))
+        db.session.flush() # Takes the write lock and the blob reference before the bytes go in place
+        link_blob(tmp_path, sha256)
+    try:
+        run_write(add_file)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        discard_unused_blobs([sha256]) # The blob may have been linked before the commit failed
+        raise
+
+    flash('File uploaded successfully', 'success')
+    return redirect(url_for('orgs.org_detail', org_id=org_id))
+
+@orgs_bp.route('/file/<int:file_id>/download')
+@login_required
+def download_file(file_id):
+    stored = File.query.filter_by(id=file_id, user_id=current_user.id).first_or_404()
+    if stored.blob_sha256:
+        path, etag = blob_path(stored.blob_sha256), stored.blob_sha256
+    else:
+        path, etag = os.path.join(current_app.config['UPLOAD_FOLDER'], stored.filename), True
+    if not os.path.exists(path): abort(404)
+    # conditional=True answers Range and If-None-Match requests; the body is streamed from disk
+    return send_file(os.path.abspath(path), mimetype=stored.content_type, as_attachment=True, download_name=stored.filename,
+                     conditional=True, etag=etag, max_age=3600)
+
+@orgs_bp.route('/file/<int:file_id>/delete', methods=['POST'])
+@login_required
+def delete_file(file_id):
+    stored = File.query.filter_by(id=file_id, user_id=current_user.id).first_or_404()
+    org_id, filename = stored.organization_id, stored.filename
+    def remove_file():
+        stored = db.session.get(File, file_id)
+        if stored is not None: db.session.delete(stored) # The blob goes after the commit if this was its last reference
+    run_write(remove_file)
+    flash(f'File "{filename}" deleted.', 'success')
+    return redirect(url_for('orgs.org_detail', org_id=org_id))
@@ -0,0 +1,194 @@
+import datetime
+import json
+import time
+from flask import Blueprint, Response, current_app, render_template, request, redirect, url_for, flash, jsonify
+from flask_login import login_required, current_user
+from sqlalchemy import func
+from crm.extensions import db
+from crm.models import Deal, DEAL_STAGES, Organization, PipelineStage
+from crm.rollups import rollup_snapshot, update_rollups
+from crm.stages import resolve_stage_ids
+from crm.writes import run_write
+from crm.automation import get_automation_dispatcher, stage_change_event
+from crm.pipeline import (
+    BULK_DEAL_ACTIONS, BULK_DEAL_LIMIT, bulk_update_deals, get_pipeline_broker, pipeline_channel, PIPELINE_PAGE_SIZE, pipeline_stage_page,
+    pipeline_summary, publish_deal_changes)
+
+pipeline_bp = Blueprint('pipeline', __name__) # Pipeline board and deals
+
+# --- PIPELINE & API ROUTES ---
+@pipeline_bp.route('/pipeline')
+@login_required
+def pipeline():
+    stages = PipelineStage.query.filter_by(user_id=current_user.id).order_by(PipelineStage.order).all()
+    return render_template('pipeline.html', stages=stages, summary=pipeline_summary(current_user.id), page_size=PIPELINE_PAGE_SIZE)
+
+@pipeline_bp.route('/api/pipeline/summary')
+@login_required
+def api_pipeline_summary():
+    summary = pipeline_summary(current_user.id)
+    stages = PipelineStage.query.filter_by(user_id=current_user.id).order_by(PipelineStage.order).all()
+    return jsonify({'stages': [{'id': stage.id, 'name': stage.name, **summary.get(stage.id, {'count': 0, 'value': 0})} for stage in stages]})
+
+@pipeline_bp.route('/api/pipeline/stage/<int:stage_id>/deals')
+@login_required
+def api_pipeline_stage_deals(stage_id):
+    limit = min(max(request.args.get('limit', PIPELINE_PAGE_SIZE, type=int), 1), 200)
+    deals, next_cursor = pipeline_stage_page(current_user.id, stage_id, request.args.get('before', type=int), limit)
+    return jsonify({'deals': deals, 'next': next_cursor})
+
+@pipeline_bp.route('/api/pipeline/stream')
+@login_required
+def api_pipeline_stream():
+    # Server-sent events: each message is {"patches": [...], "summary": {stage id: totals}} or {"reload": true}
+    broker = get_pipeline_broker()
+    if broker.subscriber_count() >= current_app.config['PIPELINE_STREAM_MAX']:
+        return jsonify({'success': False, 'error': 'Too many live boards open; updates are paused.'}), 503
+    channel = pipeline_channel(current_user.id)
+    subscription = broker.subscribe(channel)
+    coalesce = current_app.config['PIPELINE_EVENTS_COALESCE_MS'] / 1000
+    heartbeat, lifetime = current_app.config['PIPELINE_STREAM_HEARTBEAT'], current_app.config['PIPELINE_STREAM_LIFETIME']
+    def stream():
+        # Runs after the request context is gone, so it holds no database connection
+        try:
+            yield 'retry: 3000\n\n'
+            deadline = time.monotonic() + lifetime
+            while time.monotonic() < deadline:
+                if not subscription.wait(heartbeat):
+                    yield ': keepalive\n\n'; continue
+                time.sleep(coalesce) # Let a burst of writes collapse into one message
+                yield f'data: {json.dumps(subscription.drain())}\n\n'
+        finally:
+            broker.unsubscribe(channel, subscription)
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@pipeline_bp.route('/api/deal/<int:deal_id>/update_stage', methods=['POST'])
+@login_required
+def api_update_deal_stage(deal_id):
+    deal = Deal.query.get_or_404(deal_id)
+    if deal.user_id != current_user.id: return jsonify({'success': False, 'error': 'Unauthorized'}), 403
+    new_stage_id = request.json.get('new_stage_id')
+    if new_stage_id is not None:
+        # The pipeline board moves deals between the user's custom stages by id
+        stage = PipelineStage.query.filter_by(id=new_stage_id, user_id=current_user.id).first()
+        if not stage: return jsonify({'success': False, 'error': 'Invalid stage'}), 400
+        new_stage, new_stage_id = stage.name, stage.id
+    else:
+        # Older clients send the stage name: one of the user's stages, or any of DEAL_STAGES, which the user gets a stage for
+        new_stage = request.json.get('new_stage')
+        new_stage_id = db.session.query(func.min(PipelineStage.id)).filter_by(user_id=current_user.id, name=new_stage).scalar()
+        if new_stage_id is None and new_stage not in DEAL_STAGES: return jsonify({'success': False, 'error': 'Invalid stage'}), 400
+    user_id, adds_stage = current_user.id, new_stage_id is None
+    def move_deal():
+        deal = db.session.get(Deal, deal_id)
+        if deal is None: return None # Deleted since the request checked it
+        before = rollup_snapshot(deal)
+        stage_changed = deal.stage != new_stage
+        deal.stage_id = new_stage_id or resolve_stage_ids(user_id, [new_stage])[new_stage]
+        deal.updated_at = datetime.datetime.utcnow()
+        db.session.flush() # Derives deal.stage from the new stage_id
+        update_rollups(deal.user_id, [before], [rollup_snapshot(deal)])
+        return stage_change_event(deal) if stage_changed else None
+    automation = run_write(move_deal)
+    if automation: get_automation_dispatcher().emit(**automation)
+    if adds_stage: publish_deal_changes(user_id, reload=True) # The board gains a column
+    else: publish_deal_changes(user_id, changed=[deal_id])
+    return jsonify({'success': True, 'message': 'Deal stage updated.'})
+
+@pipeline_bp.route('/api/deals/bulk', methods=['POST'])
+@login_required
+def api_bulk_deals():
+    # {"action": "move"|"revalue"|"delete", "deal_ids": [...] or "from_stage_id": id, "stage_id": id, "value": n or "value_percent": n}
+    payload = request.get_json(silent=True) or {}
+    action, deal_ids, from_stage_id = payload.get('action'), payload.get('deal_ids'), payload.get('from_stage_id')
+    if action not in BULK_DEAL_ACTIONS: return jsonify({'success': False, 'error': 'Unknown action'}), 400
+    if (deal_ids is None) == (from_stage_id is None): return jsonify({'success': False, 'error': 'Give either deal_ids or from_stage_id'}), 400
+    try:
+        if deal_ids is not None: deal_ids = sorted({int(deal_id) for deal_id in deal_ids})
+        if from_stage_id is not None: from_stage_id = int(from_stage_id)
+        value = int(payload['value']) if payload.get('value') is not None else None
+        value_percent = int(payload['value_percent']) if payload.get('value_percent') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Ids and values must be whole numbers'}), 400
+    if deal_ids is not None and len(deal_ids) > BULK_DEAL_LIMIT:
+        return jsonify({'success': False, 'error': f'At most {BULK_DEAL_LIMIT} deals per request'}), 400
+    stage_id = stage_name = None
+    if action == 'move':
+        stage = PipelineStage.query.filter_by(id=payload.get('stage_id'), user_id=current_user.id).first()
+        if not stage: return jsonify({'success': False, 'error': 'Invalid stage'}), 400
+        stage_id, stage_name = stage.id, stage.name
+    if action == 'revalue' and (value is None) == (value_percent is None):
+        return jsonify({'success': False, 'error': 'Give either value or value_percent'}), 400
+    user_id = current_user.id
+    count, automations = run_write(lambda: bulk_update_deals(user_id, action, deal_ids, from_stage_id, stage_id, stage_name, value, value_percent))
+    dispatcher = get_automation_dispatcher()
+    for automation in automations: dispatcher.emit(**automation)
+    if count:
+        if deal_ids is None: publish_deal_changes(user_id, reload=True) # A whole column moved
+        elif action == 'delete': publish_deal_changes(user_id, deleted=deal_ids)
+        else: publish_deal_changes(user_id, changed=deal_ids)
+    return jsonify({'success': True, 'updated': count})
+
+# --- DEAL ROUTES ---
+@pipeline_bp.route('/deal/<int:deal_id>')
+@login_required
+def deal_detail(deal_id):
+    deal = Deal.query.filter_by(id=deal_id, user_id=current_user.id).first_or_404()
+    return render_template('deal_detail.html', deal=deal)
+
+@pipeline_bp.route('/org/<int:org_id>/add_deal', methods=['GET', 'POST'])
+@login_required
+def add_deal(org_id):
+    org = Organization.query.get_or_404(org_id)
+    stages = PipelineStage.query.filter_by(user_id=current_user.id).order_by(PipelineStage.order).all()
+    if request.method == 'POST':
+        stage = PipelineStage.query.filter_by(id=request.form.get('stage_id', type=int), user_id=current_user.id).first_or_404()
+        values = {'name': request.form['name'], 'value': int(request.form['value']), 'stage_id': stage.id,
+                  'closing_date': datetime.datetime.strptime(request.form['closing_date'], '%Y-%m-%d').date(), 'organization_id': org.id, 'user_id': current_user.id}
+        def create_deal():
+            deal = Deal(**values)
+            db.session.add(deal); db.session.flush() # Derives deal.stage from stage_id
+            update_rollups(deal.user_id, added=[rollup_snapshot(deal)])
+            return deal.id
+        deal_id = run_write(create_deal)
+        publish_deal_changes(current_user.id, changed=[deal_id])
+        return redirect(url_for('orgs.org_detail', org_id=org.id))
+    return render_template('add_deal.html', org=org, stages=stages)
+
+@pipeline_bp.route('/deal/<int:deal_id>/edit', methods=['GET', 'POST'])
+@login_required
+def edit_deal(deal_id):
+    deal = Deal.query.filter_by(id=deal_id, user_id=current_user.id).first_or_404()
+    if request.method == 'POST':
+        stage = PipelineStage.query.filter_by(id=request.form.get('stage_id', type=int), user_id=current_user.id).first_or_404()
+        values = {'name': request.form['name'], 'value': int(request.form['value']), 'stage_id': stage.id,
+                  'closing_date': datetime.datetime.strptime(request.form['closing_date'], '%Y-%m-%d').date()}
+        def save_deal():
+            deal = db.session.get(Deal, deal_id)
+            if deal is None: return None # Deleted since the request checked it
+            before = rollup_snapshot(deal)
+            for field, value in values.items(): setattr(deal, field, value)
+            db.session.flush() # Derives deal.stage from stage_id
+            update_rollups(deal.user_id, [before], [rollup_snapshot(deal)])
+            return stage_change_event(deal) if before[0] != deal.stage else None
+        automation = run_write(save_deal)
+        if automation: get_automation_dispatcher().emit(**automation)
+        publish_deal_changes(current_user.id, changed=[deal_id])
+        return redirect(url_for('pipeline.deal_detail', deal_id=deal.id))
+    stages = PipelineStage.query.filter_by(user_id=current_user.id).order_by(PipelineStage.order).all()
+    return render_template('edit_deal.html', deal=deal, stages=stages)
+
+@pipeline_bp.route('/deal/<int:deal_id>/delete', methods=['POST'])
+@login_required
+def delete_deal(deal_id):
+    deal = Deal.query.filter_by(id=deal_id, user_id=current_user.id).first_or_404()
+    org_id, name = deal.organization_id, deal.name
+    def remove_deal():
+        deal = db.session.get(Deal, deal_id)
+        if deal is None: return
+        update_rollups(deal.user_id, removed=[rollup_snapshot(deal)])
+        db.session.delete(deal)
+    run_write(remove_deal)
+    publish_deal_changes(current_user.id, deleted=[deal_id])
+    flash(f'Deal "{name}" has been deleted.', 'success')
+    return redirect(url_for('orgs.org_detail', org_id=org_id))
@@ -0,0 +1,182 @@
+import datetime
+import functools
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from flask import Response, current_app, request, session
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session as OrmSession
+from crm.extensions import app_service, db
+from crm.models import DataVersion
+from crm.instrumentation import METRICS
+
+# --- PAGE CACHING ---
+# Writes bump a per-user version for each entity they touch, in the same transaction.
+# Cached pages build their ETag from the versions they depend on, so a repeat view costs
+# one version lookup: a 304 if the browser has the page, else the rendered HTML from an
+# in-memory LRU with an optional disk tier shared by the workers on one host.
+VERSIONED_MODELS = {'Organization': 'organizations', 'CustomField': 'organizations', 'Contact': 'contacts', 'Deal': 'deals', 'PipelineStage': 'deals',
+                    'File': 'files', 'Interaction': 'activities', 'Task': 'activities', 'Attendee': 'attendees', 'Event': 'events'}
+SHARED_ENTITIES = {'events', 'users'} # Not owned by a user; versioned under user_id 0
+
+def mark_changed(user_id, *entities):
+    # For Core statements that bypass the ORM; versions are bumped before the session commits
+    marks = db.session.info.setdefault('version_marks', set())
+    marks.update((0 if entity in SHARED_ENTITIES else user_id, entity) for entity in entities)
+
+def _bump_versions(orm_session):
+    marks = orm_session.info.pop('version_marks', None)
+    if not marks: return
+    statement = sqlite_insert(DataVersion).values([{'user_id': user_id, 'entity': entity, 'version': 1} for user_id, entity in sorted(marks)])
+    orm_session.connection().execute(statement.on_conflict_do_update(index_elements=['user_id', 'entity'], set_={'version': DataVersion.version + 1}))
+
+@event.listens_for(OrmSession, 'after_flush')
+def _track_versioned_changes(orm_session, flush_context):
+    marks = orm_session.info.setdefault('version_marks', set())
+    for obj in (*orm_session.new, *orm_session.dirty, *orm_session.deleted):
+        entity = VERSIONED_MODELS.get(type(obj).__name__)
+        if entity: marks.add((0 if entity in SHARED_ENTITIES else obj.user_id, entity))
+    _bump_versions(orm_session)
+
+@event.listens_for(OrmSession, 'before_commit')
+def _bump_marked_versions(orm_session):
+    _bump_versions(orm_session)
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_version_marks(orm_session):
+    orm_session.info.pop('version_marks', None)
+
+def data_versions(user_id):
+    return {entity: version for entity, version in db.session.query(DataVersion.entity, DataVersion.version).filter(DataVersion.user_id.in_((0, user_id)))}
+
+class FragmentCache:
+    def __init__(self, max_bytes, directory=None, max_disk_bytes=0):
+        self.max_bytes, self.directory, self.max_disk_bytes = max_bytes, directory, max_disk_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._items.get(key)
+            if body is not None:
+                self._items.move_to_end(key); return body, 'memory'
+        if not self.directory: return None, None
+        try:
+            with open(self._path(key), 'rb') as f: body = f.read()
+        except OSError:
+            return None, None
+        self._remember(key, body)
+        return body, 'disk'
+
+    def set(self, key, body):
+        self._remember(key, body)
+        if not self.directory: return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f: f.write(body)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % 100 == 0
+        if prune: self._prune_disk()
+
+    def _remember(self, key, body):
+        with self._lock:
+            if key in self._items: self._size -= len(self._items.pop(key))
+            self._items[key] = body
+            self._size += len(body)
+            while self._size > self.max_bytes and self._items:
+                self._size -= len(self._items.popitem(last=False)[1])
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _prune_disk(self):
+        # Oldest first; entries for old versions are never read again, so they age out here
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                try: stat = os.stat(os.path.join(root, name))
+                except OSError: continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes: break
+            try: os.remove(path)
+            except OSError: pass
+            total -= size
+
+def get_fragment_cache():
+    return app_service('fragment_cache', lambda config: FragmentCache(config['PAGE_CACHE_BYTES'], config['PAGE_CACHE_DIR'], config['PAGE_CACHE_DISK_BYTES']))
+
+def source_fingerprint(root):
+    # Changes whenever the code or templates do, so a deploy never serves pages rendered by the old version
+    paths = [os.path.join(root, 'app.py')]
+    for folder in ('crm', 'templates'):
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, folder)):
+            dirnames[:] = sorted(name for name in dirnames if name != '__pycache__')
+            paths += [os.path.join(dirpath, name) for name in sorted(filenames) if not name.endswith('.pyc')]
+    return hashlib.sha256(repr([(path, os.stat(path).st_mtime_ns) for path in paths]).encode()).hexdigest()[:16]
+
+def cached_page(*entities):
+    # For GET views whose HTML depends only on the user, the URL, today's date and these entities
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # Pending flash messages are rendered into the page, so it cannot be reused
+            if not current_app.config['PAGE_CACHE_ENABLED'] or '_flashes' in session: return view(*args, **kwargs)
+            versions = data_versions(current_user.id)
+            key = hashlib.sha256(repr((current_app.config['PAGE_CACHE_BUILD_ID'], current_user.id, current_user.username, request.full_path,
+                                       datetime.date.today().isoformat(), [versions.get(entity, 0) for entity in entities])).encode()).hexdigest()
+            if key in request.if_none_match:
+                METRICS['page_cache'].inc('not_modified')
+                response = Response(status=304)
+            else:
+                cache = get_fragment_cache()
+                body, source = cache.get(key)
+                if body is None:
+                    response = current_app.make_response(view(*args, **kwargs))
+                    if response.status_code != 200 or response.mimetype != 'text/html': return response
+                    body, source = response.get_data(), 'rendered'
+                    cache.set(key, body)
+                METRICS['page_cache'].inc(source)
+                response = Response(body, mimetype='text/html')
+            response.set_etag(key)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+class TTLCache:
+    def __init__(self, ttl, max_size):
+        self.ttl, self.max_size = ttl, max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None: return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._items[key]; return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock: self._items.pop(key, None)
@@ -0,0 +1,115 @@
+import datetime
+from sqlalchemy import func, event, inspect, and_, select, literal, tuple_
+from sqlalchemy.orm import Session as OrmSession
+from crm.extensions import db
+from crm.models import (
+    Attendee, AutomationRule, ChangeLog, ChangeLogPurge, Contact, CustomField, Deal, deal_contact_association, Event, File, Interaction,
+    Organization, PipelineStage, Task)
+from crm.export import export_value
+
+# --- CHANGE FEED ---
+# Every write to a synced table appends (entity, row, upsert|delete) to change_log in the
+# same transaction: ORM flushes are logged from session events, Core bulk statements through
+# insert_logged() and log_changes(). /api/changes returns the latest state of each row changed
+# after a cursor, so a sync costs what changed. `flask compact-changes` drops superseded
+# entries and, after CHANGE_LOG_RETENTION_DAYS, delete tombstones.
+CHANGE_LOGGED_TABLES = {table.name: table for table in (Organization.__table__, Contact.__table__, Interaction.__table__, Task.__table__, Event.__table__,
+                                                        Attendee.__table__, Deal.__table__, PipelineStage.__table__, File.__table__, CustomField.__table__,
+                                                        AutomationRule.__table__, deal_contact_association)}
+CHANGE_FEED_LIMIT = 1000 # Rows per /api/changes response
+CHANGE_LOG_RETENTION_DAYS = 30
+
+def log_changes(table, op, rows):
+    # For Core statements that bypass the ORM; rows are (user_id, row id) pairs
+    now = datetime.datetime.utcnow()
+    entries = [{'user_id': user_id or 0, 'entity': table.name, 'row_key': str(row_id), 'op': op, 'changed_at': now} for user_id, row_id in rows]
+    if entries: db.session.execute(ChangeLog.__table__.insert(), entries)
+
+def _association_changes(deal, contacts, op):
+    return [(deal.user_id, 'deal_contact_association', f'{deal.id}:{contact.id}', op) for contact in contacts]
+
+@event.listens_for(OrmSession, 'after_flush')
+def _log_orm_changes(orm_session, flush_context):
+    changes = []
+    for obj in (*orm_session.new, *orm_session.dirty, *orm_session.deleted):
+        table = getattr(obj, '__table__', None)
+        if table is None or table.name not in CHANGE_LOGGED_TABLES: continue
+        deleted = obj in orm_session.deleted
+        if deleted or obj in orm_session.new or orm_session.is_modified(obj):
+            changes.append((getattr(obj, 'user_id', 0), table.name, str(obj.id), 'delete' if deleted else 'upsert'))
+        # Association rows change through either side's collection
+        if isinstance(obj, Deal):
+            history = inspect(obj).attrs.contacts.history
+            changes += _association_changes(obj, history.added, 'upsert')
+            changes += _association_changes(obj, (*history.deleted, *history.unchanged) if deleted else history.deleted, 'delete')
+        elif isinstance(obj, Contact):
+            history = inspect(obj).attrs.deals.history
+            for deal in history.added: changes += _association_changes(deal, [obj], 'upsert')
+            for deal in ((*history.deleted, *history.unchanged) if deleted else history.deleted): changes += _association_changes(deal, [obj], 'delete')
+    if changes:
+        now = datetime.datetime.utcnow()
+        orm_session.connection().execute(ChangeLog.__table__.insert(), [{'user_id': user_id or 0, 'entity': entity, 'row_key': row_key, 'op': op, 'changed_at': now}
+                                                                        for user_id, entity, row_key, op in changes])
+
+def change_log_horizon():
+    return db.session.query(func.max(ChangeLogPurge.purged_through)).scalar() or 0
+
+def _fetch_rows(entity, keys):
+    table = CHANGE_LOGGED_TABLES[entity]
+    if entity == 'deal_contact_association':
+        pairs = [tuple(int(part) for part in key.split(':')) for key in keys]
+        rows = db.session.execute(table.select().where(tuple_(table.c.deal_id, table.c.contact_id).in_(pairs))).mappings()
+        return {f"{row['deal_id']}:{row['contact_id']}": row for row in rows}
+    return {str(row['id']): row for row in db.session.execute(table.select().where(table.c.id.in_([int(key) for key in keys]))).mappings()}
+
+def _change_key(entity, row_key):
+    return [int(part) for part in row_key.split(':')] if entity == 'deal_contact_association' else int(row_key)
+
+def read_changes(user_id, since=0, limit=CHANGE_FEED_LIMIT):
+    # One entry per changed row, ordered by its latest change; SQLite takes the bare op column
+    # from the row holding max(id), so each row reports its latest operation
+    last_id = func.max(ChangeLog.id).label('last_id')
+    entries = db.session.query(ChangeLog.entity, ChangeLog.row_key, ChangeLog.op, last_id).filter(
+        ChangeLog.user_id.in_((0, user_id)), ChangeLog.id > since).group_by(ChangeLog.entity, ChangeLog.row_key).order_by(last_id).limit(limit + 1).all()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    changes, upserts = {}, {}
+    for entity, row_key, op, _ in entries:
+        delta = changes.setdefault(entity, {'upserts': [], 'deletes': []})
+        if op == 'delete': delta['deletes'].append(_change_key(entity, row_key))
+        else: upserts.setdefault(entity, []).append(row_key)
+    for entity, keys in upserts.items():
+        rows = _fetch_rows(entity, keys)
+        for key in keys:
+            # A row deleted after this read started is reported as deleted
+            if key in rows: changes[entity]['upserts'].append({column: export_value(value) for column, value in rows[key].items()})
+            else: changes[entity]['deletes'].append(_change_key(entity, key))
+    return {'cursor': str(entries[-1].last_id if entries else since), 'has_more': has_more, 'changes': changes}
+
+def compact_change_log(retention_days=CHANGE_LOG_RETENTION_DAYS):
+    # Superseded entries never change what a cursor returns, so they can go at any time.
+    # Old tombstones are dropped too; cursors from before them must sync again from 0.
+    superseded = db.session.execute(ChangeLog.__table__.delete().where(
+        ChangeLog.id.notin_(select(func.max(ChangeLog.id)).group_by(ChangeLog.entity, ChangeLog.row_key)))).rowcount
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)
+    expired_filter = and_(ChangeLog.op=='delete', ChangeLog.changed_at < cutoff)
+    purged_through = db.session.query(func.max(ChangeLog.id)).filter(expired_filter).scalar()
+    expired = 0
+    if purged_through:
+        expired = db.session.execute(ChangeLog.__table__.delete().where(expired_filter)).rowcount
+        db.session.add(ChangeLogPurge(purged_through=purged_through))
+    db.session.commit()
+    return superseded, expired
+
+def backfill_change_log():
+    # Existing rows enter the feed as upserts so a sync from 0 returns everything
+    if db.session.query(ChangeLog.id).first(): return
+    now = datetime.datetime.utcnow()
+    columns = ['user_id', 'entity', 'row_key', 'op', 'changed_at']
+    for name, table in CHANGE_LOGGED_TABLES.items():
+        if name == 'deal_contact_association':
+            rows = select(Deal.user_id, literal(name), table.c.deal_id.concat(':').concat(table.c.contact_id), literal('upsert'), literal(now)).join(
+                Deal, Deal.id==table.c.deal_id)
+        else:
+            rows = select(table.c.user_id if 'user_id' in table.c else literal(0), literal(name), func.cast(table.c.id, db.String), literal('upsert'), literal(now))
+        db.session.execute(ChangeLog.__table__.insert().from_select(columns, rows))
@@ -0,0 +1,408 @@
+import datetime
+import itertools
+import json
+import os
+import random
+import socket
+import statistics
+import tempfile
+import time
+from collections import Counter
+import click
+from flask import Blueprint, current_app
+from werkzeug.security import generate_password_hash
+from sqlalchemy import func, select, update
+from crm.extensions import db
+from crm.models import Contact, Deal, DraftBatch, Event, Interaction, Organization, OutboundEmail, PipelineStage, User
+from crm.export import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, EXPORT_KINDS, export_statement, parse_export_filters
+from crm.search import rebuild_search_index
+from crm.rollups import rebuild_rollups
+from crm.stages import rebuild_stage_analytics
+from crm.changes import CHANGE_LOG_RETENTION_DAYS, compact_change_log
+from crm.duplicates import find_all_duplicates, MERGERS
+from crm.writes import run_write
+from crm.mail import enqueue_emails, get_mail_dispatcher, MailDispatcher, SMTPPool
+from crm.drafting import AI_BACKENDS, create_draft_batch, draft_batch_options, draft_prompt, run_draft_batch, StubBackend
+from crm.storage import collect_unused_blobs
+from crm.automation import get_automation_dispatcher
+from crm.importer import IMPORT_CHUNK_SIZE, import_csv, IMPORT_KINDS
+from crm.migrations import current_schema_version, upgrade_schema
+from crm.benchmarks import (
+    bench_routes, bench_user_loads, compare_bench, explain_route_queries, get_stress_user, probe_startup, run_write_stress, seed_synthetic,
+    seed_user_data, SYNTHETIC_PASSWORD, USER_LOAD_MODES)
+
+commands_bp = Blueprint('commands', __name__, cli_group=None) # flask CLI commands, registered at the top level
+    
+# --- DATABASE SETUP COMMAND ---
+@commands_bp.cli.command('init-db')
+def init_db_command():
+    db.create_all()
+    # A new database already has the current schema, so its migrations are only recorded
+    upgrade_schema(mark_only=not current_schema_version() and not Organization.query.first())
+    if not User.query.filter_by(username='hamish').first():
+        user = User(username='hamish', email='hamish@example.com')
+        user.set_password('password')
+        db.session.add(user); db.session.commit()
+        print("Default user created.")
+    print('Initialized the database.')
+
+@commands_bp.cli.command('import-csv')
+@click.argument('kind', type=click.Choice(list(IMPORT_KINDS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', 'username', default='hamish', help='Username that will own the imported rows.')
+@click.option('--chunk-size', default=IMPORT_CHUNK_SIZE, show_default=True)
+def import_csv_command(kind, path, username, chunk_size):
+    user = User.query.filter_by(username=username).first()
+    if not user: raise click.ClickException(f'No user named {username}.')
+    def report(counts):
+        print(f"chunk {counts['chunks']}: {counts['rows']} rows, {counts['inserted']} inserted, {counts['skipped']} skipped, {counts['errors']} errors")
+    with open(path, newline='') as f:
+        counts = import_csv(f, kind, user.id, chunk_size=chunk_size, progress=report)
+    print(f"Imported {counts['inserted']} {kind} ({counts['skipped']} skipped, {counts['errors']} errors, {counts['duplicates']} possible duplicates).")
+
+@commands_bp.cli.command('export')
+@click.argument('kind', type=click.Choice(list(EXPORT_KINDS)))
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'export_format', type=click.Choice(list(EXPORT_FORMATS)), default='csv', show_default=True)
+@click.option('--user', 'username', default=None, help='Only export rows owned by this user (default: all users).')
+@click.option('--since', default=None, help='Earliest date (YYYY-MM-DD) on the record\'s date column.')
+@click.option('--until', default=None, help='Latest date (YYYY-MM-DD) on the record\'s date column.')
+@click.option('--stage', default=None, help='Only deals in this stage.')
+@click.option('--updated-since', default=None, help='Only deals updated after this ISO timestamp, for incremental exports.')
+@click.option('--chunk-size', default=EXPORT_CHUNK_SIZE, show_default=True)
+def export_command(kind, path, export_format, username, since, until, stage, updated_since, chunk_size):
+    user_id = None
+    if username:
+        user = User.query.filter_by(username=username).first()
+        if not user: raise click.ClickException(f'No user named {username}.')
+        user_id = user.id
+    try:
+        since, until, updated_since = parse_export_filters(since, until, updated_since)
+        stmt = export_statement(kind, user_id, since, until, stage, updated_since)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    watermark = None
+    if kind == 'deals':
+        # Cap the export at the current high-water mark so the next incremental run starts exactly where this one ends
+        watermark = db.session.execute(select(func.max(Deal.updated_at)).where(Deal.user_id==user_id if user_id else True)).scalar()
+        if watermark: stmt = stmt.where(Deal.updated_at <= watermark)
+    size = 0
+    with open(path, 'wb') as f:
+        for chunk in EXPORT_FORMATS[export_format][0](stmt, chunk_size):
+            f.write(chunk); size += len(chunk)
+    print(f'Wrote {size} bytes of {kind} to {path}.')
+    if watermark: print(f'Next incremental export: --updated-since {watermark.isoformat()}')
+
+@commands_bp.cli.command('compact-changes')
+@click.option('--retention-days', default=CHANGE_LOG_RETENTION_DAYS, show_default=True, help='Keep delete tombstones this long.')
+def compact_changes_command(retention_days):
+    # For cron, e.g. nightly
+    superseded, expired = compact_change_log(retention_days)
+    print(f'Removed {superseded} superseded and {expired} expired change log entries.')
+
+@commands_bp.cli.command('find-duplicates')
+@click.option('--user', 'username', default=None, help='Only this user\'s records (default: all users).')
+@click.option('--kind', 'kinds', type=click.Choice(list(MERGERS)), multiple=True, help='Record type to scan; repeatable (default: all).')
+def find_duplicates_command(username, kinds):
+    # Rebuilds the blocking index and re-scores every record; new writes are indexed as they happen, so this is for backfills
+    user_id = None
+    if username:
+        user = User.query.filter_by(username=username).first()
+        if not user: raise click.ClickException(f'No user named {username}.')
+        user_id = user.id
+    found = find_all_duplicates(user_id, kinds or tuple(MERGERS), progress=lambda kind, last_id: print(f'{kind}: indexed through id {last_id}'))
+    for kind in kinds or MERGERS: print(f'{kind}: {found.get(kind, 0)} open duplicate pairs')
+
+@commands_bp.cli.command('gc-blobs')
+def gc_blobs_command():
+    # Safe while the app is running; blobs are only removed once nothing references them
+    print(f'Removed {collect_unused_blobs()} unused blobs.')
+
+@commands_bp.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    rebuild_search_index()
+    print('Search index rebuilt.')
+
+@commands_bp.cli.command('rebuild-reporting-rollups')
+def rebuild_reporting_rollups_command():
+    rebuild_rollups()
+    print('Reporting rollups rebuilt from deals.')
+
+@commands_bp.cli.command('rebuild-stage-analytics')
+def rebuild_stage_analytics_command():
+    rebuild_stage_analytics()
+    print('Stage analytics rebuilt from the stage history.')
+
+@commands_bp.cli.command('send-queued-mail')
+def send_queued_mail_command():
+    dispatcher = get_mail_dispatcher()
+    total = 0
+    while True:
+        sent = dispatcher.dispatch_once()
+        if not sent: break
+        total += sent
+    dispatcher.pool.close()
+    print(f'Processed {total} queued emails.')
+
+def check_mail_delivery(messages, port):
+    # Queues the messages plus one the server refuses, delivers them with a MailDispatcher on a
+    # small pool and returns the problems found; the local server must be listening on port.
+    user_id = get_stress_user().id
+    contact_ids = [contact_id for (contact_id,) in db.session.query(Contact.id).filter_by(user_id=user_id).limit(messages + 1)]
+    recipients = [f'check-{i}@example.com' for i in range(messages)] + ['refused@example.com']
+    enqueue_emails([{'recipient': recipient, 'subject': f'Check {i}', 'body': 'Delivery check', 'contact_id': contact_id, 'user_id': user_id}
+                    for i, (recipient, contact_id) in enumerate(zip(recipients, itertools.cycle(contact_ids)))])
+    db.session.commit()
+    pool = SMTPPool('127.0.0.1', port, False, None, None, size=2, timeout=10)
+    dispatcher = MailDispatcher(pool, batch_size=10, max_attempts=2, backoff=0)
+    try:
+        while dispatcher.dispatch_once(): pass
+    finally:
+        pool.close()
+    statuses = dict(db.session.query(OutboundEmail.recipient, OutboundEmail.status).all())
+    logged = Interaction.query.filter_by(user_id=user_id, interaction_type='Email Sent').count()
+    problems = [f'{recipient} is {status}' for recipient, status in statuses.items() if status != ('failed' if recipient.startswith('refused') else 'sent')]
+    if logged != messages: problems.append(f'{logged} interactions logged for {messages} sent messages')
+    return problems
+
+@commands_bp.cli.command('check-mail')
+@click.option('--messages', default=25, show_default=True, help='Messages to deliver.')
+def check_mail_command(messages):
+    # Runs the outbound mail path end to end against a local aiosmtpd server and a throwaway database; needs `pip install aiosmtpd`
+    try:
+        from aiosmtpd.controller import Controller
+    except ImportError:
+        raise click.ClickException('check-mail needs aiosmtpd (pip install aiosmtpd).')
+    received, stats = Counter(), Counter()
+    class Handler:
+        async def handle_EHLO(self, server, session, envelope, hostname, responses):
+            session.host_name = hostname
+            stats['connections'] += 1
+            return responses
+        async def handle_NOOP(self, server, session, envelope, arg):
+            stats['noops'] += 1
+            return '250 OK'
+        async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+            if address.startswith('refused'): return '550 No such user here'
+            envelope.rcpt_tos.append(address)
+            return '250 OK'
+        async def handle_DATA(self, server, session, envelope):
+            received.update(envelope.rcpt_tos)
+            return '250 Message accepted for delivery'
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0)); port = probe.getsockname()[1]
+    controller = Controller(Handler(), hostname='127.0.0.1', port=port)
+    controller.start()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            from app import create_app # app.py imports this module
+            check_app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'check.db')}", 'EMAIL_ADDRESS': 'crm@example.com'})
+            with check_app.app_context():
+                problems = check_mail_delivery(messages, port)
+                db.session.remove()
+                db.engine.dispose()
+    finally:
+        controller.stop()
+    problems += [f'{recipient} received {count} times' for recipient, count in received.items() if count != 1]
+    if len(received) != messages: problems.append(f'{len(received)} of {messages} messages arrived')
+    print(f"{len(received)} delivered over {stats['connections']} connections with {stats['noops']} NOOPs.")
+    if problems: raise click.ClickException('; '.join(problems))
+    print('Mail delivery OK.')
+
+@commands_bp.cli.command('draft-batch')
+@click.option('--user', 'username', help='Owner of the contacts; required for a new batch.')
+@click.option('--purpose', help='Purpose of the email, also its subject.')
+@click.option('--key-points', default='', help='Talking points, one per line.')
+@click.option('--event-id', type=int, help='Only contacts at organizations attending this event.')
+@click.option('--country')
+@click.option('--stage', help='Only contacts at organizations with a deal in this stage.')
+@click.option('--resume', 'batch_id', type=int, help='Draft the pending emails of an existing batch instead, e.g. after a restart.')
+def draft_batch_command(username, purpose, key_points, event_id, country, stage, batch_id):
+    # Runs in the foreground with the configured AI backend and batch limits
+    if batch_id is None:
+        user = User.query.filter_by(username=username).first() if username else None
+        if not user or not purpose: raise click.ClickException('A new batch needs --user and --purpose.')
+        batch_id = run_write(lambda: create_draft_batch(user.id, purpose, key_points, event_id=event_id, country=country, stage=stage))
+    elif not db.session.get(DraftBatch, batch_id):
+        raise click.ClickException(f'No draft batch {batch_id}.')
+    else:
+        run_write(lambda: db.session.execute(update(DraftBatch).where(DraftBatch.id==batch_id).values(status='queued', finished_at=None))) # Resuming a cancelled batch picks it up again
+    backend = AI_BACKENDS[current_app.config['AI_BACKEND']](timeout=current_app.config['AI_TIMEOUT'])
+    start = time.perf_counter()
+    status = run_draft_batch(batch_id, backend, *draft_batch_options())
+    batch = db.session.get(DraftBatch, batch_id)
+    print(f'Batch {batch_id} {status}: {batch.ready_count} ready, {batch.failed_count} failed of {batch.total} in {time.perf_counter() - start:.1f}s.')
+
+@commands_bp.cli.command('bench-drafts')
+@click.option('--contacts', default=200, show_default=True, help='Drafts in the batch.')
+@click.option('--delay', default=0.2, show_default=True, help='Seconds the stub model takes per draft.')
+@click.option('--concurrency', default=16, show_default=True)
+@click.option('--rate', default=50.0, show_default=True, help='Model calls started per second.')
+@click.option('--burst', default=10, show_default=True)
+@click.option('--serial-sample', default=20, show_default=True, help='Contacts drafted one at a time for the baseline.')
+@click.option('--yes', is_flag=True, help='Do not ask before writing test data.')
+def bench_drafts_command(contacts, delay, concurrency, rate, burst, serial_sample, yes):
+    # Always uses the stub model, so no AI quota is spent. Compares one-at-a-time drafting, as compose_email does it, with a batch.
+    if not yes: click.confirm(f"This adds a draft batch to {current_app.config['SQLALCHEMY_DATABASE_URI']}. Continue?", abort=True)
+    user_id = get_stress_user().id
+    backend = StubBackend(timeout=current_app.config['AI_TIMEOUT'], delay=delay)
+    contact_ids = [contact_id for (contact_id,) in db.session.query(Contact.id).filter_by(user_id=user_id).order_by(Contact.id).limit(serial_sample)]
+    start = time.perf_counter()
+    for contact_id in contact_ids:
+        contact = db.session.get(Contact, contact_id)
+        backend.generate(draft_prompt(contact.name, contact.title, contact.organization.name, 'Benchmark', 'Point one'))
+    serial_rate = len(contact_ids) / (time.perf_counter() - start)
+    start = time.perf_counter()
+    batch_id = run_write(lambda: create_draft_batch(user_id, 'Benchmark', 'Point one', max_contacts=contacts))
+    run_draft_batch(batch_id, backend, concurrency, rate, burst, current_app.config['AI_TIMEOUT'])
+    elapsed = time.perf_counter() - start
+    batch = db.session.get(DraftBatch, batch_id)
+    batch_rate = batch.ready_count / elapsed
+    print(f"{'mode':<8}{'drafts':>8}{'drafts/s':>10}")
+    print(f"{'serial':<8}{len(contact_ids):>8}{serial_rate:>10.1f}")
+    print(f"{'batch':<8}{batch.ready_count:>8}{batch_rate:>10.1f}  (limit {min(rate, concurrency / delay) if delay else rate:.1f}/s, {batch.failed_count} failed)")
+    if serial_rate: print(f"\nbatch vs serial: {batch_rate / serial_rate:.1f}x drafts/s")
+
+@commands_bp.cli.command('db-upgrade')
+def db_upgrade_command():
+    applied = upgrade_schema()
+    for number, name in applied:
+        print(f'Applied migration {number}: {name}')
+    print(f'Database is at schema version {current_schema_version()}.')
+
+@commands_bp.cli.command('explain-queries')
+@click.option('--user', 'username', default='hamish', help='User whose data the routes are run against.')
+def explain_queries_command(username):
+    user = User.query.filter_by(username=username).first()
+    if not user: raise click.ClickException(f'No user named {username}.')
+    org = Organization.query.filter_by(user_id=user.id).first()
+    contact = Contact.query.filter_by(user_id=user.id).first()
+    deal = Deal.query.filter_by(user_id=user.id).first()
+    stage = PipelineStage.query.filter_by(user_id=user.id).first()
+    event_row = Event.query.first()
+    routes = ['/dashboard', '/reporting', '/pipeline', '/api/pipeline/summary', '/organizations', '/events', '/search?q=bank']
+    if org: routes.append(f'/org/{org.id}')
+    if contact: routes += [f'/contact/{contact.id}', f'/api/contact/{contact.id}/timeline']
+    if deal: routes.append(f'/deal/{deal.id}')
+    if stage: routes.append(f'/api/pipeline/stage/{stage.id}/deals')
+    if event_row: routes.append(f'/event/{event_row.id}')
+    current = None
+    for route, statement, plan in explain_route_queries(user, routes):
+        if route != current:
+            current = route
+            print(f'\n=== {route}')
+        print('  ' + ' '.join(statement.split())[:160])
+        for line in plan:
+            # A SCAN of a real table without an index is a full table scan
+            words = line.split()
+            flag = '!!' if words[0] == 'SCAN' and words[1] in db.metadata.tables and 'INDEX' not in line else '  '
+            print(f'    {flag} {line}')
+
+@commands_bp.cli.command('seed-synthetic')
+@click.option('--users', default=3, show_default=True)
+@click.option('--orgs', 'orgs_per_user', default=1000, show_default=True, help='Organizations per user.')
+@click.option('--contacts-per-org', default=3, show_default=True)
+@click.option('--deals-per-org', default=2, show_default=True)
+@click.option('--interactions-per-contact', default=5, show_default=True)
+@click.option('--tasks-per-contact', default=2, show_default=True)
+@click.option('--events', default=5, show_default=True)
+@click.option('--attendees-per-event', default=50, show_default=True, help='Attending orgs per event for each user.')
+@click.option('--seed', default=1, show_default=True)
+def seed_synthetic_command(**options):
+    db.create_all()
+    start = time.perf_counter()
+    totals = seed_synthetic(**options, progress=lambda n, totals: print(f'user {n}: ' + ', '.join(f'{count} {kind}' for kind, count in sorted(totals.items()))))
+    print(f"Seeded {', '.join(f'{count} {kind}' for kind, count in sorted(totals.items()))} in {time.perf_counter() - start:.1f}s.")
+    print(f'Log in as synth1@example.com / {SYNTHETIC_PASSWORD}.')
+
+@commands_bp.cli.command('bench-user-loads')
+@click.option('--requests', 'requests_per_route', default=500, show_default=True, help='Requests per route and mode.')
+@click.option('--yes', is_flag=True, help='Do not ask before writing test data.')
+def bench_user_loads_command(requests_per_route, yes):
+    # Queries per request with the user loaded from the database every time, from the cache, and from the session cookie
+    if not yes: click.confirm(f"This moves test deals in {current_app.config['SQLALCHEMY_DATABASE_URI']}. Continue?", abort=True)
+    user_id = get_stress_user().id
+    print(f"{'mode':<10}{'route':<18}{'queries':>9}{'user queries':>14}{'p50 ms':>9}")
+    for mode in USER_LOAD_MODES:
+        for name, stats in bench_user_loads(user_id, mode, requests_per_route, random.Random(1)).items():
+            print(f"{mode:<10}{name:<18}{stats['queries']:>9}{stats['user_queries']:>14}{stats['p50_ms']:>9}")
+
+@commands_bp.cli.command('stress-writes')
+@click.option('--processes', default=4, show_default=True, help='Worker processes, like gunicorn workers.')
+@click.option('--threads', default=4, show_default=True, help='Concurrent clients per process; keep within the connection pool size.')
+@click.option('--writes', default=2000, show_default=True, help='Total writes per mode.')
+@click.option('--mode', 'modes', type=click.Choice(['direct', 'batched']), multiple=True, help='Write modes to compare (default: both).')
+@click.option('--yes', is_flag=True, help='Do not ask before writing test data.')
+def stress_writes_command(processes, threads, writes, modes, yes):
+    if not yes: click.confirm(f"This writes test interactions and stage changes to {current_app.config['SQLALCHEMY_DATABASE_URI']}. Continue?", abort=True)
+    user = get_stress_user()
+    # Failed requests are counted below; their tracebacks would drown the report
+    log_level = current_app.logger.level
+    current_app.logger.setLevel('CRITICAL')
+    try:
+        results = [run_write_stress(user.id, mode, processes, threads, writes) for mode in modes or ('direct', 'batched')]
+    finally:
+        current_app.logger.setLevel(log_level)
+    print(f"{'mode':<10}{'writes/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'failed':>8}")
+    for result in results:
+        print(f"{result['mode']:<10}{result['writes_per_s']:>10}{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}{result['failed']:>8}"
+              + (f"  {result['failures']}" if result['failures'] else ''))
+    if len(results) == 2 and results[0]['writes_per_s']:
+        print(f"\nbatched vs direct: {results[1]['writes_per_s'] / results[0]['writes_per_s']:.2f}x throughput")
+
+@commands_bp.cli.command('bench')
+@click.option('--sizes', default='100,1000,5000', show_default=True, help='Organizations owned by the benchmark user at each step.')
+@click.option('--requests', 'requests_per_route', default=30, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the results as a JSON baseline.')
+@click.option('--compare', 'baseline_path', type=click.Path(exists=True, dir_okay=False), help='Baseline JSON to compare against.')
+@click.option('--yes', is_flag=True, help='Do not ask before writing synthetic data.')
+def bench_command(sizes, requests_per_route, output, baseline_path, yes):
+    # Data is only ever added, so each size tops the benchmark user up to that many organizations
+    if not yes: click.confirm(f"This adds synthetic data to {current_app.config['SQLALCHEMY_DATABASE_URI']}. Continue?", abort=True)
+    db.create_all()
+    upgrade_schema(mark_only=not current_schema_version())
+    rng = random.Random(1)
+    password_hash = generate_password_hash(SYNTHETIC_PASSWORD)
+    user = User.query.filter_by(username='bench').first()
+    if not user:
+        user = User(username='bench', email='bench@example.com', password_hash=password_hash)
+        db.session.add(user); db.session.commit()
+    report = {'meta': {'created_at': datetime.datetime.utcnow().isoformat(), 'requests_per_route': requests_per_route,
+                       'database': current_app.config['SQLALCHEMY_DATABASE_URI']}, 'results': {}}
+    for size in sorted(int(size) for size in sizes.split(',')):
+        existing = Organization.query.filter_by(user_id=user.id).count()
+        if existing < size:
+            seed_user_data(user, rng, size - existing, contacts_per_org=3, deals_per_org=2, interactions_per_contact=5, tasks_per_contact=2)
+            rebuild_rollups()
+        results = bench_routes(user, requests_per_route, rng)
+        report['results'][str(size)] = results
+        print(f'\n=== {size} organizations')
+        print(f"{'route':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>10}")
+        for name, stats in results.items():
+            print(f"{name:<16}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['queries']:>10}")
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nSaved results to {output}.')
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        print(f'\nCompared with {baseline_path}:')
+        for size, route, metric, old, new, change in compare_bench(baseline, report):
+            print(f'  {size:>7} {route:<16}{metric:<9}{old:>10} -> {new:<10} ({change:+.1f}%)')
+
+@commands_bp.cli.command('run-automations')
+def run_automations_command():
+    # For cron: fires automations for tasks that have become overdue since the last scan
+    fired = get_automation_dispatcher().scan_overdue_tasks()
+    print(f'Processed {fired} newly overdue tasks.')
+
+@commands_bp.cli.command('bench-startup')
+@click.option('--runs', default=5, show_default=True, help='Fresh interpreters started per mode.')
+def bench_startup_command(runs):
+    # Import time, first request latency and resident memory of a cold process, lazy vs preloaded heavy modules
+    print(f"{'mode':<8}{'import ms':>12}{'first req ms':>14}{'rss MB':>10}{'rss + heavy MB':>16}  heavy loaded")
+    for mode, preload in (('lazy', False), ('eager', True)):
+        probes = [probe_startup(preload) for _ in range(runs)]
+        median = lambda key: round(statistics.median(probe[key] for probe in probes), 1)
+        print(f"{mode:<8}{median('import_ms'):>12}{median('first_request_ms'):>14}{median('rss_mb'):>10}{median('rss_with_heavy_mb'):>16}  {', '.join(probes[0]['heavy_loaded']) or '-'}")
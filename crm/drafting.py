@@ -0,0 +1,278 @@
+import asyncio
+import datetime
+import hashlib
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy import bindparam, select, update, literal
+from crm.extensions import app_service, db
+from crm.models import Attendee, Contact, Deal, DraftBatch, DraftJob, EmailDraft, Event, Organization
+from crm.caching import TTLCache
+from crm.writes import run_write
+
+# --- AI DRAFTING ---
+# Drafts run on a bounded thread pool off the request path and the compose page polls
+# for the result. Jobs are DraftJob rows, so any worker can answer a poll; every status
+# change is a guarded UPDATE, so a job that timed out is never started or overwritten.
+# Finished drafts are cached by prompt hash so repeats are instant.
+class DraftBlocked(Exception): pass
+class DraftQueueFull(Exception): pass
+
+GEMINI_MODEL = 'gemini-2.5-pro'
+
+class GeminiBackend:
+    def __init__(self, timeout):
+        import google.generativeai as genai # Slow to import, so only processes that draft pay for it
+        genai.configure(api_key=os.environ.get('GOOGLE_API_KEY'))
+        self.model = genai.GenerativeModel(GEMINI_MODEL)
+        self.timeout = timeout
+
+    def generate(self, prompt):
+        return self._text(self.model.generate_content(prompt, request_options={'timeout': self.timeout}))
+
+    async def agenerate(self, prompt):
+        return self._text(await self.model.generate_content_async(prompt, request_options={'timeout': self.timeout}))
+
+    def _text(self, response):
+        if not response.parts:
+            raise DraftBlocked('AI could not generate a draft. The prompt may have been blocked by safety filters. Please try rephrasing.')
+        return response.text
+
+class StubBackend:
+    # Deterministic local model for tests and benchmarks; AI_STUB_DELAY simulates model latency
+    def __init__(self, timeout, delay=None):
+        self.delay = float(os.environ.get('AI_STUB_DELAY', 0)) if delay is None else delay
+
+    def generate(self, prompt):
+        if self.delay: time.sleep(self.delay)
+        return self._draft(prompt)
+
+    async def agenerate(self, prompt):
+        if self.delay: await asyncio.sleep(self.delay)
+        return self._draft(prompt)
+
+    def _draft(self, prompt):
+        return f"[stub draft {hashlib.sha256(prompt.encode()).hexdigest()[:8]}]\n\n{prompt.strip()}"
+
+AI_BACKENDS = {'gemini': GeminiBackend, 'stub': StubBackend}
+
+class DraftQueue:
+    JOB_RETENTION = datetime.timedelta(minutes=10) # How long a finished job stays pollable
+    TIMED_OUT = 'The AI draft timed out. Please try again.'
+
+    def __init__(self, backend, max_workers, max_pending, timeout, cache):
+        self.backend, self.timeout, self.cache = backend, timeout, cache
+        self.app = current_app._get_current_object() # Worker threads push their own app context
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ai-draft')
+        self._slots = threading.BoundedSemaphore(max_pending) # Queued + running jobs in this process, released when _run returns
+
+    def submit(self, prompt, user_id):
+        key = hashlib.sha256(prompt.encode()).hexdigest()
+        cached = self.cache.get(key)
+        if cached is not None: return DraftJob(status='done', draft=cached) # Nothing polls for it, so no row is written
+        if not self._slots.acquire(blocking=False):
+            raise DraftQueueFull('AI drafting is busy right now. Please try again in a moment.')
+        now = datetime.datetime.utcnow()
+        values = {'id': uuid.uuid4().hex, 'status': 'queued', 'created_at': now, 'deadline': now + datetime.timedelta(seconds=self.timeout), 'user_id': user_id}
+        def add_job():
+            db.session.execute(DraftJob.__table__.delete().where(DraftJob.status.in_(('done', 'error')), DraftJob.finished_at < now - self.JOB_RETENTION))
+            db.session.execute(DraftJob.__table__.insert().values(**values))
+        try:
+            run_write(add_job)
+            self._executor.submit(self._run, values['id'], prompt, key)
+        except BaseException:
+            self._slots.release(); raise
+        return DraftJob(**values)
+
+    def get(self, job_id, user_id):
+        job = DraftJob.query.filter_by(id=job_id, user_id=user_id).first()
+        if job is None or job.status in ('done', 'error') or job.deadline > datetime.datetime.utcnow(): return job
+        # The worker thread cannot be interrupted, but the guarded updates in _run leave this status alone
+        self._finish(job_id, ('queued', 'running'), status='error', error=self.TIMED_OUT)
+        db.session.expire(job)
+        return job
+
+    def _finish(self, job_id, from_statuses, **values):
+        run_write(lambda: db.session.execute(update(DraftJob).where(DraftJob.id==job_id, DraftJob.status.in_(from_statuses)).values(
+            finished_at=datetime.datetime.utcnow(), **values)))
+
+    def _run(self, job_id, prompt, key):
+        try:
+            with self.app.app_context():
+                try:
+                    self._generate(job_id, prompt, key)
+                except Exception:
+                    db.session.rollback()
+                    current_app.logger.exception('AI draft %s failed', job_id)
+        finally:
+            self._slots.release()
+
+    def _generate(self, job_id, prompt, key):
+        claimed = []
+        def claim():
+            # Jobs that waited past their deadline are skipped rather than sent to the model
+            claimed.append(db.session.execute(update(DraftJob).where(DraftJob.id==job_id, DraftJob.status=='queued',
+                DraftJob.deadline > datetime.datetime.utcnow()).values(status='running')).rowcount)
+        run_write(claim)
+        if not claimed[-1]:
+            self._finish(job_id, ('queued',), status='error', error=self.TIMED_OUT); return
+        try:
+            draft = self.backend.generate(prompt)
+        except Exception as e:
+            self._finish(job_id, ('running',), status='error', error=str(e)); return
+        self.cache.set(key, draft)
+        self._finish(job_id, ('running',), status='done', draft=draft)
+
+def get_draft_queue():
+    return app_service('draft_queue', lambda config: DraftQueue(AI_BACKENDS[config['AI_BACKEND']](timeout=config['AI_TIMEOUT']), config['AI_MAX_WORKERS'],
+                                                                config['AI_MAX_PENDING'], config['AI_TIMEOUT'], TTLCache(config['AI_CACHE_TTL'], config['AI_CACHE_SIZE'])))
+
+def draft_prompt(contact_name, contact_title, org_name, purpose, key_points):
+    # --- Simplified and more direct prompt ---
+    return f"""
+        Draft a professional sales email from Hamish Harrison of Currency Research to {contact_name}, the {contact_title} at {org_name}.
+
+        The subject of the email is: {purpose}.
+
+        Incorporate these key points:
+        {key_points}
+
+        The tone should be confident and professional. Use an active voice and keep sentances under 20 words 
+        """
+
+# --- BATCH DRAFTING ---
+# A batch drafts one email per contact in a set: an event's attendee orgs, an org filter,
+# or the orgs with deals in a pipeline stage. Its drafts are created up front with one
+# INSERT ... SELECT and their prompt context is read back in one query. Model calls then
+# run on an asyncio loop, at most AI_BATCH_CONCURRENCY at a time and started no faster
+# than the token bucket allows, and results are saved every DRAFT_SAVE_EVERY calls so the
+# review page fills in as the batch runs. Pending drafts survive a restart; re-running
+# the batch (`flask draft-batch --resume`) only drafts those.
+DRAFT_SAVE_EVERY = 20
+DRAFT_REVIEW_PAGE_SIZE = 25
+
+class TokenBucket:
+    # `rate` acquisitions per second on average, in bursts of up to `burst`; for use on one event loop
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.updated = float(burst), time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1; return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def create_draft_batch(user_id, purpose, key_points, event_id=None, country=None, sponsorship_potential=None, stage=None, max_contacts=None):
+    # Creates the batch and a pending draft for every matching contact with an email; call inside run_write. Returns the batch id.
+    contacts = select(Contact.id).join(Organization, Organization.id==Contact.org_id).where(Contact.user_id==user_id, Contact.email.isnot(None), Contact.email != '')
+    audience = []
+    if event_id:
+        contacts = contacts.where(Organization.id.in_(select(Attendee.organization_id).where(Attendee.event_id==event_id)))
+        audience.append(f"attendees of {db.session.query(Event.name).filter_by(id=event_id).scalar()}")
+    if country:
+        contacts = contacts.where(Organization.country==country); audience.append(country)
+    if sponsorship_potential:
+        contacts = contacts.where(Organization.sponsorship_potential==sponsorship_potential); audience.append(sponsorship_potential)
+    if stage:
+        contacts = contacts.where(Organization.id.in_(select(Deal.organization_id).where(Deal.user_id==user_id, Deal.stage==stage)))
+        audience.append(f'deals in {stage}')
+    contacts = contacts.order_by(Contact.id).limit(max_contacts or current_app.config['AI_BATCH_MAX_CONTACTS']).subquery()
+    batch = DraftBatch(name=purpose, key_points=key_points, audience=', '.join(audience) or 'all contacts', user_id=user_id)
+    db.session.add(batch); db.session.flush()
+    columns = ['batch_id', 'contact_id', 'user_id', 'subject', 'status', 'created_at']
+    total = db.session.execute(EmailDraft.__table__.insert().from_select(columns, select(
+        literal(batch.id), contacts.c.id, literal(user_id), literal(purpose), literal('pending'), literal(datetime.datetime.utcnow())))).rowcount
+    batch.total = total
+    return batch.id
+
+def _save_drafts(batch_id, results):
+    # One executemany UPDATE for the drafts and one for the batch counts; returns the batch status so a run can stop when cancelled
+    table = EmailDraft.__table__
+    db.session.execute(update(table).where(table.c.id==bindparam('draft_id')).values(
+        body=bindparam('draft_body'), error=bindparam('draft_error'), status=bindparam('draft_status')),
+        [{'draft_id': draft_id, 'draft_body': body, 'draft_error': error, 'draft_status': 'failed' if error else 'ready'} for draft_id, body, error in results])
+    ready = sum(1 for *_, error in results if not error)
+    db.session.execute(update(DraftBatch).where(DraftBatch.id==batch_id).values(
+        ready_count=DraftBatch.ready_count + ready, failed_count=DraftBatch.failed_count + len(results) - ready).execution_options(synchronize_session=False))
+    return db.session.query(DraftBatch.status).filter_by(id=batch_id).scalar()
+
+async def _draft_prompts(prompts, backend, concurrency, rate, burst, timeout, save):
+    # prompts are (draft id, prompt); save(results) is called with every DRAFT_SAVE_EVERY results and returns False to stop
+    bucket, slots = TokenBucket(rate, burst), asyncio.Semaphore(concurrency)
+    async def draft(draft_id, prompt):
+        async with slots:
+            await bucket.acquire()
+            try:
+                return draft_id, await asyncio.wait_for(backend.agenerate(prompt), timeout), None
+            except Exception as e:
+                return draft_id, None, str(e) or type(e).__name__
+    tasks = [asyncio.ensure_future(draft(draft_id, prompt)) for draft_id, prompt in prompts]
+    results = []
+    try:
+        for finished in asyncio.as_completed(tasks):
+            results.append(await finished)
+            if len(results) >= DRAFT_SAVE_EVERY:
+                # Saves are short synchronous writes; calls in flight carry on when the loop resumes
+                keep_going, results = save(results), []
+                if not keep_going: break
+        if results: save(results)
+    finally:
+        for task in tasks: task.cancel()
+
+def run_draft_batch(batch_id, backend, concurrency, rate, burst, timeout):
+    # Drafts every pending email in the batch and returns the batch status; re-running resumes it
+    batch = db.session.get(DraftBatch, batch_id)
+    if batch is None or batch.status == 'cancelled': return batch and batch.status
+    purpose, key_points = batch.name, batch.key_points or ''
+    rows = db.session.query(EmailDraft.id, Contact.name, Contact.title, Organization.name).join(Contact, Contact.id==EmailDraft.contact_id).join(
+        Organization, Organization.id==Contact.org_id).filter(EmailDraft.batch_id==batch_id, EmailDraft.status=='pending').order_by(EmailDraft.id).all()
+    prompts = [(draft_id, draft_prompt(name, title, org_name, purpose, key_points)) for draft_id, name, title, org_name in rows]
+    run_write(lambda: db.session.execute(update(DraftBatch).where(DraftBatch.id==batch_id, DraftBatch.status!='cancelled').values(status='running')))
+    def save(results):
+        return run_write(lambda: _save_drafts(batch_id, results)) != 'cancelled'
+    asyncio.run(_draft_prompts(prompts, backend, concurrency, rate, burst, timeout, save))
+    def finish():
+        db.session.execute(update(DraftBatch).where(DraftBatch.id==batch_id, DraftBatch.status!='cancelled').values(
+            status='done', finished_at=datetime.datetime.utcnow()))
+        return db.session.query(DraftBatch.status).filter_by(id=batch_id).scalar()
+    return run_write(finish)
+
+def draft_batch_options():
+    # (concurrency, rate, burst, timeout) from the app config
+    config = current_app.config
+    return config['AI_BATCH_CONCURRENCY'], config['AI_BATCH_RATE'], config['AI_BATCH_BURST'], config['AI_TIMEOUT']
+
+class DraftBatchRunner:
+    # Runs submitted batches one at a time on a background thread, each on its own event loop
+    def __init__(self, backend, options):
+        self.backend, self.options = backend, options
+        self.app = current_app._get_current_object() # The worker thread pushes its own app context
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='draft-batches', daemon=True)
+        self._thread.start()
+
+    def submit(self, batch_id):
+        self._queue.put(batch_id)
+
+    def _run(self):
+        while True:
+            batch_id = self._queue.get()
+            with self.app.app_context():
+                try:
+                    run_draft_batch(batch_id, self.backend, *self.options)
+                except Exception:
+                    db.session.rollback()
+                    current_app.logger.exception('Draft batch %s failed', batch_id)
+                    run_write(lambda: db.session.execute(update(DraftBatch).where(DraftBatch.id==batch_id).values(
+                        status='failed', finished_at=datetime.datetime.utcnow())))
+
+def get_draft_batch_runner():
+    return app_service('draft_batch_runner', lambda config: DraftBatchRunner(AI_BACKENDS[config['AI_BACKEND']](timeout=config['AI_TIMEOUT']), draft_batch_options()))
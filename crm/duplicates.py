@@ -0,0 +1,242 @@
+import datetime
+import re
+import unicodedata
+from sqlalchemy import func, event, inspect, and_, or_, select, update, literal
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session as OrmSession
+from crm.extensions import db
+from crm.models import (
+    Attendee, Contact, CustomField, Deal, deal_contact_association, DedupeKey, DuplicateCandidate, EmailDraft, File, Interaction, Organization,
+    OutboundEmail, Task)
+from crm.caching import mark_changed, VERSIONED_MODELS
+from crm.forecast import mark_deals_changed
+from crm.changes import CHANGE_LOGGED_TABLES, log_changes
+
+# --- DUPLICATE DETECTION ---
+# Organizations and contacts are filed under blocking keys in dedupe_key whenever they are
+# written (ORM flushes and insert_logged alike): an org under "country|word" for each
+# distinctive word of its normalized name, a contact under its email and under
+# "org<id>|word" for each word of its name. A new or renamed record is only scored against
+# records sharing one of its blocks, so the cost follows block sizes, not the size of the
+# book. Pairs above the threshold wait in duplicate_candidate for review and merge.
+DEDUPE_KINDS = {'Organization': 'organization', 'Contact': 'contact'}
+DEDUPE_FIELDS = {'organization': ('name', 'country'), 'contact': ('name', 'email', 'org_id')} # Changes to these re-key a record
+DEDUPE_THRESHOLDS = {'organization': 0.75, 'contact': 0.8}
+DEDUPE_MAX_BLOCK = 200 # A block shared by more records than this is too common to say anything; it is not scored
+DEDUPE_BATCH_SIZE = 2000
+DUPLICATE_PAGE_SIZE = 50
+NAME_NOISE_WORDS = {'the', 'ltd', 'limited', 'plc', 'inc', 'incorporated', 'llc', 'llp', 'gmbh', 'ag', 'sa', 'sarl', 'bv', 'nv', 'spa', 'srl',
+                    'co', 'corp', 'corporation', 'company'}
+BLOCK_STOPWORDS = {'and', 'of', 'for', 'de', 'del', 'la', 'le', 'du', 'des', 'der', 'di', 'bank', 'central', 'national', 'royal'}
+
+def normalize_name(name):
+    # ASCII words without case, accents, punctuation or legal forms: "Bank of X Ltd." -> "bank of x"
+    text = unicodedata.normalize('NFKD', name or '').encode('ascii', 'ignore').decode().lower().replace('&', ' and ')
+    return ' '.join(word for word in re.findall(r'[a-z0-9]+', text) if word not in NAME_NOISE_WORDS)
+
+def _trigrams(text):
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def name_similarity(a, b):
+    # Jaccard similarity of the character trigrams of two normalized names, from 0 to 1
+    if not a or not b: return 0.0
+    a, b = _trigrams(a), _trigrams(b)
+    return len(a & b) / len(a | b)
+
+def _dedupe_records(conn, kind, ids):
+    if kind == 'organization':
+        rows = conn.execute(select(Organization.id, Organization.user_id, Organization.name, Organization.country).where(Organization.id.in_(ids)))
+        return {row_id: {'user_id': user_id, 'name': normalize_name(name), 'country': normalize_name(country)} for row_id, user_id, name, country in rows}
+    rows = conn.execute(select(Contact.id, Contact.user_id, Contact.name, Contact.email, Contact.org_id).where(Contact.id.in_(ids)))
+    return {row_id: {'user_id': user_id, 'name': normalize_name(name), 'email': (email or '').strip().lower(), 'org_id': org_id}
+            for row_id, user_id, name, email, org_id in rows}
+
+def dedupe_blocks(kind, record):
+    words = [word for word in record['name'].split() if len(word) > 1 and word not in BLOCK_STOPWORDS]
+    if kind == 'organization':
+        # A name made only of stopwords is blocked on the whole name
+        return {f"{record['country']}|{word}" for word in words or [record['name']]}
+    blocks = {f"org{record['org_id']}|{word}" for word in words}
+    if record['email']: blocks.add(f"email|{record['email']}")
+    return blocks
+
+def dedupe_score(kind, a, b):
+    if kind == 'contact':
+        if a['email'] and a['email'] == b['email']: return 1.0
+        if a['org_id'] != b['org_id']: return 0.0
+    elif a['country'] != b['country'] or re.findall(r'\d+', a['name']) != re.findall(r'\d+', b['name']):
+        return 0.0 # Numbered names ("Fund 1", "Fund 2") are different organizations
+    return name_similarity(a['name'], b['name'])
+
+def forget_dedupe(conn, kind, ids):
+    # For deleted records: drops their keys and every candidate pair they are part of
+    conn.execute(DedupeKey.__table__.delete().where(DedupeKey.kind==kind, DedupeKey.record_id.in_(ids)))
+    conn.execute(DuplicateCandidate.__table__.delete().where(DuplicateCandidate.kind==kind, or_(
+        DuplicateCandidate.record_id.in_(ids), DuplicateCandidate.duplicate_id.in_(ids))))
+
+def index_for_dedupe(conn, kind, ids):
+    # Files the records under their current blocks and queues their likely duplicates; returns the number of pairs found.
+    # Open pairs are re-scored from scratch, dismissed ones stay dismissed.
+    ids = list(ids)
+    if not ids: return 0
+    conn.execute(DedupeKey.__table__.delete().where(DedupeKey.kind==kind, DedupeKey.record_id.in_(ids)))
+    conn.execute(DuplicateCandidate.__table__.delete().where(DuplicateCandidate.kind==kind, DuplicateCandidate.status=='open', or_(
+        DuplicateCandidate.record_id.in_(ids), DuplicateCandidate.duplicate_id.in_(ids))))
+    records = _dedupe_records(conn, kind, ids)
+    keys = [{'kind': kind, 'record_id': record_id, 'block': block, 'user_id': record['user_id']}
+            for record_id, record in records.items() for block in dedupe_blocks(kind, record)]
+    if keys: conn.execute(DedupeKey.__table__.insert(), keys)
+    return find_candidates(conn, kind, records)
+
+def find_candidates(conn, kind, records):
+    # Pairs the records with everyone sharing one of their blocks of at most DEDUPE_MAX_BLOCK members, then scores
+    # the pairs here. Every lookup is a range on ix_dedupe_key_block.
+    keys = DedupeKey.__table__
+    blocks = {}
+    for record in records.values(): blocks.setdefault(record['user_id'], set()).update(dedupe_blocks(kind, record))
+    pairs = set()
+    for user_id, user_blocks in blocks.items():
+        user_blocks = sorted(user_blocks)
+        for start in range(0, len(user_blocks), DEDUPE_BATCH_SIZE):
+            in_blocks = and_(keys.c.kind==kind, keys.c.user_id==user_id, keys.c.block.in_(user_blocks[start:start + DEDUPE_BATCH_SIZE]))
+            small = select(keys.c.block).where(in_blocks).group_by(keys.c.block).having(func.count() <= DEDUPE_MAX_BLOCK)
+            members = {}
+            for block, record_id in conn.execute(select(keys.c.block, keys.c.record_id).where(in_blocks, keys.c.block.in_(small))):
+                members.setdefault(block, []).append(record_id)
+            for block_members in members.values():
+                pairs.update((min(a, b), max(a, b)) for a in block_members if a in records for b in block_members if b != a)
+    if not pairs: return 0
+    others = {record_id for pair in pairs for record_id in pair} - records.keys()
+    if others: records = {**records, **_dedupe_records(conn, kind, others)}
+    now = datetime.datetime.utcnow()
+    found = []
+    for a, b in sorted(pairs):
+        if a not in records or b not in records: continue # Keys left by a row deleted outside the session
+        score = dedupe_score(kind, records[a], records[b])
+        if score >= DEDUPE_THRESHOLDS[kind]:
+            found.append({'kind': kind, 'record_id': a, 'duplicate_id': b, 'score': round(score, 3), 'status': 'open', 'created_at': now,
+                          'user_id': records[a]['user_id']})
+    if found:
+        conn.execute(sqlite_insert(DuplicateCandidate).on_conflict_do_nothing(index_elements=['kind', 'record_id', 'duplicate_id']), found)
+    return len(found)
+
+@event.listens_for(OrmSession, 'after_flush')
+def _index_orm_dedupe(orm_session, flush_context):
+    changed, deleted = {}, {}
+    for obj in (*orm_session.new, *orm_session.dirty, *orm_session.deleted):
+        kind = DEDUPE_KINDS.get(type(obj).__name__)
+        if not kind: continue
+        if obj in orm_session.deleted: deleted.setdefault(kind, set()).add(obj.id)
+        elif obj in orm_session.new or any(inspect(obj).attrs[field].history.has_changes() for field in DEDUPE_FIELDS[kind]):
+            changed.setdefault(kind, set()).add(obj.id)
+    for kind, ids in deleted.items(): forget_dedupe(orm_session.connection(), kind, ids)
+    for kind, ids in changed.items(): index_for_dedupe(orm_session.connection(), kind, ids)
+
+def find_all_duplicates(user_id=None, kinds=('organization', 'contact'), progress=None):
+    # Re-keys and re-scores every record in batches of DEDUPE_BATCH_SIZE, committing each; returns {kind: open pairs}
+    models = {kind: model for model, kind in ((Organization, 'organization'), (Contact, 'contact'))}
+    for kind in kinds:
+        model, last_id = models[kind], 0
+        while True:
+            batch = select(model.id).where(model.id > last_id).order_by(model.id).limit(DEDUPE_BATCH_SIZE)
+            if user_id: batch = batch.where(model.user_id==user_id)
+            ids = db.session.execute(batch).scalars().all()
+            if not ids: break
+            index_for_dedupe(db.session.connection(), kind, ids)
+            db.session.commit()
+            last_id = ids[-1]
+            if progress: progress(kind, last_id)
+    open_pairs = db.session.query(DuplicateCandidate.kind, func.count()).filter(DuplicateCandidate.status=='open')
+    if user_id: open_pairs = open_pairs.filter(DuplicateCandidate.user_id==user_id)
+    return dict(open_pairs.group_by(DuplicateCandidate.kind).all())
+
+def open_duplicate_count(kind, record_id):
+    return db.session.query(DuplicateCandidate.id).filter(DuplicateCandidate.kind==kind, DuplicateCandidate.status=='open', or_(
+        DuplicateCandidate.record_id==record_id, DuplicateCandidate.duplicate_id==record_id)).count()
+
+def _repoint(user_id, targets, merge_ids, keep_id, now):
+    # One UPDATE per (model, column); returns {table name: [moved ids]} and logs every moved row
+    moved = {}
+    for model, column in targets:
+        ids = db.session.execute(select(model.id).where(column.in_(merge_ids))).scalars().all()
+        if not ids: continue
+        values = {column.key: keep_id}
+        if 'updated_at' in model.__table__.c: values['updated_at'] = now
+        db.session.execute(update(model).where(column.in_(merge_ids)).values(values).execution_options(synchronize_session=False))
+        if model.__tablename__ in CHANGE_LOGGED_TABLES: log_changes(model.__table__, 'upsert', [(user_id, row_id) for row_id in ids])
+        if model.__name__ in VERSIONED_MODELS: mark_changed(user_id, VERSIONED_MODELS[model.__name__])
+        moved[model.__tablename__] = ids
+    return moved
+
+def _merge_targets(model, user_id, keep_id, merge_ids, columns):
+    # Loads the kept and merged rows of one user; None unless every id is theirs
+    merge_ids = sorted(set(merge_ids) - {keep_id})
+    rows = {row.id: row for row in db.session.query(model.id, *columns).filter(model.user_id==user_id, model.id.in_([keep_id, *merge_ids]))}
+    if not merge_ids or len(rows) != len(merge_ids) + 1: return None, None, None
+    return rows[keep_id], [rows[row_id] for row_id in merge_ids], merge_ids
+
+def merge_organizations(user_id, keep_id, merge_ids):
+    # Moves everything the merged organizations own onto keep_id with one UPDATE per table, then deletes them.
+    # Call inside run_write. Returns {table name: [moved ids]}, or None if any organization is not the user's.
+    keep, merged, merge_ids = _merge_targets(Organization, user_id, keep_id, merge_ids, (Organization.country, Organization.strategic_notes))
+    if keep is None: return None
+    now = datetime.datetime.utcnow()
+    # Blanks on the kept record are filled from the merged ones; notes are kept from all of them
+    country = keep.country or next((row.country for row in merged if row.country), None)
+    notes = '\n\n'.join(row.strategic_notes for row in (keep, *merged) if row.strategic_notes) or None
+    db.session.execute(update(Organization).where(Organization.id==keep_id).values(country=country, strategic_notes=notes).execution_options(synchronize_session=False))
+    moved = _repoint(user_id, ((Contact, Contact.org_id), (Deal, Deal.organization_id), (File, File.organization_id),
+                               (Attendee, Attendee.organization_id), (CustomField, CustomField.organization_id)), merge_ids, keep_id, now)
+    if 'attendee' in moved:
+        # Both may have attended the same event; the earliest registration stays
+        first = select(func.min(Attendee.id)).where(Attendee.organization_id==keep_id).group_by(Attendee.event_id)
+        extra = db.session.execute(select(Attendee.id).where(Attendee.organization_id==keep_id, Attendee.id.notin_(first))).scalars().all()
+        if extra:
+            db.session.execute(Attendee.__table__.delete().where(Attendee.id.in_(extra)))
+            log_changes(Attendee.__table__, 'delete', [(user_id, row_id) for row_id in extra])
+            moved['attendee'] = [row_id for row_id in moved['attendee'] if row_id not in set(extra)]
+    db.session.execute(Organization.__table__.delete().where(Organization.id.in_(merge_ids)))
+    log_changes(Organization.__table__, 'delete', [(user_id, org_id) for org_id in merge_ids])
+    log_changes(Organization.__table__, 'upsert', [(user_id, keep_id)])
+    mark_changed(user_id, 'organizations')
+    if moved.get('deal') or country != keep.country: mark_deals_changed(user_id) # The forecast groups by org country
+    conn = db.session.connection()
+    forget_dedupe(conn, 'organization', merge_ids)
+    index_for_dedupe(conn, 'organization', [keep_id])
+    # Contacts now share an org with their possible twins
+    if moved.get('contact'): index_for_dedupe(conn, 'contact', moved['contact'])
+    return moved
+
+def merge_contacts(user_id, keep_id, merge_ids):
+    # Moves the merged contacts' activity, queued mail and deal links onto keep_id, then deletes them.
+    # Call inside run_write. Returns {table name: [moved ids]}, or None if any contact is not the user's.
+    keep, merged, merge_ids = _merge_targets(Contact, user_id, keep_id, merge_ids, (Contact.title, Contact.email))
+    if keep is None: return None
+    now = datetime.datetime.utcnow()
+    db.session.execute(update(Contact).where(Contact.id==keep_id).values(
+        title=keep.title or next((row.title for row in merged if row.title), None),
+        email=keep.email or next((row.email for row in merged if row.email), None)).execution_options(synchronize_session=False))
+    moved = _repoint(user_id, ((Interaction, Interaction.contact_id), (Task, Task.contact_id), (OutboundEmail, OutboundEmail.contact_id),
+                               (EmailDraft, EmailDraft.contact_id)), merge_ids, keep_id, now)
+    links = db.session.query(deal_contact_association.c.deal_id, deal_contact_association.c.contact_id).filter(
+        deal_contact_association.c.contact_id.in_(merge_ids)).all()
+    if links:
+        # Links move with their role, unless the kept contact is already on the deal
+        db.session.execute(deal_contact_association.insert().prefix_with('OR IGNORE').from_select(['deal_id', 'contact_id', 'role'], select(
+            deal_contact_association.c.deal_id, literal(keep_id), deal_contact_association.c.role).where(deal_contact_association.c.contact_id.in_(merge_ids))))
+        db.session.execute(deal_contact_association.delete().where(deal_contact_association.c.contact_id.in_(merge_ids)))
+        deal_ids = sorted({deal_id for deal_id, _ in links})
+        log_changes(deal_contact_association, 'delete', [(user_id, f'{deal_id}:{contact_id}') for deal_id, contact_id in links])
+        log_changes(deal_contact_association, 'upsert', [(user_id, f'{deal_id}:{keep_id}') for deal_id in deal_ids])
+        moved['deal_contact_association'] = deal_ids
+    db.session.execute(Contact.__table__.delete().where(Contact.id.in_(merge_ids)))
+    log_changes(Contact.__table__, 'delete', [(user_id, contact_id) for contact_id in merge_ids])
+    log_changes(Contact.__table__, 'upsert', [(user_id, keep_id)])
+    mark_changed(user_id, 'contacts')
+    conn = db.session.connection()
+    forget_dedupe(conn, 'contact', merge_ids)
+    index_for_dedupe(conn, 'contact', [keep_id])
+    return moved
+
+MERGERS = {'organization': merge_organizations, 'contact': merge_contacts}
@@ -0,0 +1,119 @@
+import csv
+import datetime
+import io
+import json
+from sqlalchemy import select
+from crm.extensions import db
+from crm.models import Attendee, Contact, Deal, Event, Interaction, Organization
+
+# --- DATA EXPORT ---
+# Exports stream rows from a server-side cursor in chunks of EXPORT_CHUNK_SIZE and
+# hand each chunk to a writer, so memory stays flat however large the table is.
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_KINDS = {
+    # kind: (columns, date column for --since/--until)
+    'organizations': ([Organization.id, Organization.name, Organization.country, Organization.sponsorship_potential, Organization.strategic_notes,
+                       Organization.user_id], None),
+    'contacts': ([Contact.id, Contact.name, Contact.title, Contact.email, Contact.org_id, Organization.name.label('organization'), Contact.user_id], None),
+    'deals': ([Deal.id, Deal.name, Deal.value, Deal.stage, Deal.closing_date, Deal.created_at, Deal.updated_at, Deal.organization_id,
+               Organization.name.label('organization'), Deal.user_id], Deal.closing_date),
+    'interactions': ([Interaction.id, Interaction.interaction_type, Interaction.date, Interaction.notes, Interaction.contact_id,
+                      Contact.name.label('contact'), Interaction.user_id], Interaction.date),
+    'attendees': ([Attendee.id, Attendee.event_id, Event.name.label('event'), Event.date.label('event_date'), Attendee.organization_id,
+                   Organization.name.label('organization'), Attendee.registration_type, Attendee.value, Attendee.user_id], Event.date),
+}
+EXPORT_JOINS = {
+    'contacts': lambda stmt: stmt.join(Organization, Organization.id==Contact.org_id),
+    'deals': lambda stmt: stmt.join(Organization, Organization.id==Deal.organization_id),
+    'interactions': lambda stmt: stmt.join(Contact, Contact.id==Interaction.contact_id),
+    'attendees': lambda stmt: stmt.join(Event, Event.id==Attendee.event_id).join(Organization, Organization.id==Attendee.organization_id),
+}
+
+def export_statement(kind, user_id=None, since=None, until=None, stage=None, updated_since=None):
+    columns, date_column = EXPORT_KINDS[kind]
+    model = columns[0].class_
+    stmt = select(*columns).select_from(model)
+    if kind in EXPORT_JOINS: stmt = EXPORT_JOINS[kind](stmt)
+    if user_id is not None: stmt = stmt.where(model.user_id==user_id)
+    if since or until:
+        if date_column is None: raise ValueError(f'{kind} have no date to filter on.')
+        if since: stmt = stmt.where(date_column >= since)
+        if until: stmt = stmt.where(date_column <= until)
+    if stage or updated_since:
+        if kind != 'deals': raise ValueError('Stage and updated-since filters only apply to deals.')
+        if stage: stmt = stmt.where(Deal.stage==stage)
+        if updated_since:
+            # Incremental export: everything changed after the last watermark, oldest first
+            return stmt.where(Deal.updated_at > updated_since).order_by(Deal.updated_at, Deal.id)
+    return stmt.order_by(model.id)
+
+def export_chunks(stmt, chunk_size=EXPORT_CHUNK_SIZE):
+    result = db.session.execute(stmt.execution_options(yield_per=chunk_size))
+    for rows in result.partitions():
+        yield rows
+
+def export_value(value):
+    return value.isoformat() if isinstance(value, (datetime.date, datetime.datetime)) else value
+
+def write_csv(stmt, chunk_size=EXPORT_CHUNK_SIZE):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(stmt.selected_columns.keys())
+    for rows in export_chunks(stmt, chunk_size):
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0); buffer.truncate()
+    if buffer.tell(): yield buffer.getvalue().encode()
+
+def write_ndjson(stmt, chunk_size=EXPORT_CHUNK_SIZE):
+    keys = list(stmt.selected_columns.keys())
+    for rows in export_chunks(stmt, chunk_size):
+        yield ''.join(json.dumps({key: export_value(value) for key, value in zip(keys, row)}) + '\n' for row in rows).encode()
+
+class _ChunkSink(io.RawIOBase):
+    # Write-only file that lets pyarrow's output be drained after every row group
+    def __init__(self):
+        self.chunks, self.position = [], 0
+    def writable(self): return True
+    def write(self, data):
+        self.chunks.append(bytes(data)); self.position += len(data)
+        return len(data)
+    def tell(self): return self.position
+    def drain(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+def _arrow_schema(stmt):
+    import pyarrow as pa
+    types = []
+    for column in stmt.selected_columns:
+        if isinstance(column.type, db.Integer): types.append(pa.int64())
+        elif isinstance(column.type, db.DateTime): types.append(pa.timestamp('us'))
+        elif isinstance(column.type, db.Date): types.append(pa.date32())
+        elif isinstance(column.type, db.Boolean): types.append(pa.bool_())
+        else: types.append(pa.string())
+    return pa.schema(list(zip(stmt.selected_columns.keys(), types)))
+
+def write_parquet(stmt, chunk_size=EXPORT_CHUNK_SIZE):
+    # Imported here so pyarrow is only needed by deployments that export Parquet
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = _arrow_schema(stmt)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for rows in export_chunks(stmt, chunk_size):
+        writer.write_table(pa.Table.from_pydict({name: [row[i] for row in rows] for i, name in enumerate(schema.names)}, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+EXPORT_FORMATS = {
+    # format: (writer, mimetype, file extension)
+    'csv': (write_csv, 'text/csv', 'csv'),
+    'ndjson': (write_ndjson, 'application/x-ndjson', 'ndjson'),
+    'parquet': (write_parquet, 'application/vnd.apache.parquet', 'parquet'),
+}
+
+def parse_export_filters(since=None, until=None, updated_since=None):
+    parse_date = lambda value: datetime.datetime.strptime(value, '%Y-%m-%d').date() if value else None
+    return parse_date(since), parse_date(until), datetime.datetime.fromisoformat(updated_since) if updated_since else None
@@ -0,0 +1,38 @@
+import sqlite3
+import threading
+from flask import current_app
+from flask_sqlalchemy import SQLAlchemy
+from flask_login import LoginManager
+
+# --- EXTENSIONS ---
+# Extensions are created here and bound to an app by create_app() in app.py, which also
+# registers the blueprints from crm.blueprints. pandas and the Gemini SDK are imported where
+# they are used, so workers and CLI commands that never import or draft do not pay for them.
+db = SQLAlchemy()
+login_manager = LoginManager()
+login_manager.login_view = 'auth.login'
+
+# Caches, pools and background workers belong to an app: app_service() builds each one on
+# first use from that app's config and keeps it in app.extensions, so every create_app()
+# gets its own and forked workers build theirs after the fork.
+_app_service_lock = threading.RLock()
+
+def app_service(name, build):
+    extensions = current_app.extensions
+    if name not in extensions:
+        with _app_service_lock:
+            if name not in extensions: extensions[name] = build(current_app.config)
+    return extensions[name]
+
+def sqlite_pragma_listener(pragmas):
+    # Registered on the app's engine by create_app(), with the pragmas bound then, so connections opened
+    # outside an app context (pool refills on background threads) get them too
+    def set_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection): return
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+    return set_pragmas
+
+HEAVY_MODULES = ('pandas', 'google.generativeai') # Imported on first use unless PRELOAD_HEAVY_MODULES is set
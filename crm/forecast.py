@@ -0,0 +1,128 @@
+import datetime
+import threading
+import time
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
+from crm.extensions import app_service, db
+from crm.models import Deal, PipelineStage, ReportingRollup, User
+from crm.caching import mark_changed
+
+# --- FORECASTING ---
+# Deals are read once into columnar arrays and every projection is a vectorised group-by
+# over them. Results are cached per user and dropped when that user's deals or stages are
+# committed; FORECAST_TTL bounds how stale a forecast can be after writes in other workers.
+FORECAST_TTL = 300 # Seconds
+FORECAST_HORIZON_MONTHS = 12
+
+class ForecastCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            cached = self._items.get(key)
+            return cached[1] if cached and cached[0] > time.monotonic() else None
+
+    def set(self, key, value):
+        with self._lock: self._items[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            for key in [key for key in self._items if key[0] in user_ids or key[0] is None]: del self._items[key]
+
+def get_forecast_cache():
+    return app_service('forecast_cache', lambda config: ForecastCache(FORECAST_TTL))
+
+def mark_deals_changed(user_id):
+    # For Core statements that bypass the ORM; the cache is invalidated when the session commits
+    db.session.info.setdefault('forecast_users', set()).add(user_id)
+    mark_changed(user_id, 'deals')
+
+@event.listens_for(OrmSession, 'after_flush')
+def _track_forecast_changes(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, (Deal, PipelineStage)): session.info.setdefault('forecast_users', set()).add(obj.user_id)
+
+@event.listens_for(OrmSession, 'after_commit')
+def _invalidate_forecasts(session):
+    user_ids = session.info.pop('forecast_users', None)
+    forecast_cache = current_app.extensions.get('forecast_cache')
+    if user_ids and forecast_cache is not None: forecast_cache.invalidate(user_ids)
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_forecast_changes(session):
+    session.info.pop('forecast_users', None)
+
+def stage_probabilities(user_id=None):
+    # Configured percentages by stage id, plus each user's smoothed win rate for stages left unset
+    stages = db.session.query(PipelineStage.id, PipelineStage.name, PipelineStage.win_probability, PipelineStage.user_id)
+    rollups = db.session.query(ReportingRollup.user_id, ReportingRollup.won_count, ReportingRollup.lost_count)
+    if user_id is not None:
+        stages, rollups = stages.filter(PipelineStage.user_id==user_id), rollups.filter(ReportingRollup.user_id==user_id)
+    learned = {owner: (won + 1) / (won + lost + 2) for owner, won, lost in rollups}
+    configured = {}
+    for stage_id, name, probability, owner in stages:
+        if name == 'Closed-Won': configured[stage_id] = 1.0
+        elif name == 'Closed-Lost': configured[stage_id] = 0.0
+        elif probability is not None: configured[stage_id] = probability / 100
+    return configured, learned
+
+FORECAST_COLUMNS = ['user_id', 'stage_id', 'stage', 'value', 'closing_date', 'country']
+
+def load_deal_frame(user_id=None):
+    # Open and won deals as columns. Plain driver rows skip per-row result processing,
+    # which is most of the cost at 100k deals; dates stay ISO strings for pandas to parse in bulk.
+    sql = ("SELECT deal.user_id, deal.stage_id, deal.stage, coalesce(deal.value, 0), deal.closing_date, coalesce(organization.country, 'Unknown') "
+           "FROM deal JOIN organization ON organization.id = deal.organization_id WHERE deal.stage != 'Closed-Lost'")
+    import pandas as pd
+    cursor = db.session.connection().connection.cursor()
+    try:
+        rows = cursor.execute(sql + ' AND deal.user_id = ?', (user_id,)) if user_id is not None else cursor.execute(sql)
+        return pd.DataFrame(rows.fetchall(), columns=FORECAST_COLUMNS)
+    finally:
+        cursor.close()
+
+def _forecast_table(frame, key):
+    grouped = frame.groupby(key, sort=True).agg(deals=('value', 'size'), pipeline=('open_value', 'sum'), won=('won_value', 'sum'), weighted=('weighted', 'sum'))
+    return [{'key': str(index), 'deals': int(row.deals), 'pipeline': int(row.pipeline), 'won': int(row.won), 'weighted': round(float(row.weighted))}
+            for index, row in grouped.iterrows()]
+
+def compute_forecast(user_id=None, horizon_months=FORECAST_HORIZON_MONTHS, today=None):
+    # user_id=None forecasts every owner together
+    import pandas as pd
+    configured, learned = stage_probabilities(user_id)
+    this_month = pd.Period(today or datetime.date.today(), 'M')
+    forecast = {'generated_at': datetime.datetime.utcnow().isoformat(), 'start': str(this_month), 'horizon_months': horizon_months,
+                'learned_win_rate': round(learned.get(user_id, 0.5), 3) if user_id is not None else {str(owner): round(rate, 3) for owner, rate in learned.items()},
+                'totals': {'deals': 0, 'pipeline': 0, 'won': 0, 'weighted': 0}, 'monthly': [], 'quarterly': [], 'by_country': [], 'by_owner': []}
+    frame = load_deal_frame(user_id)
+    if frame.empty: return forecast
+    month = pd.to_datetime(frame['closing_date'], format='ISO8601').dt.to_period('M')
+    won = frame['stage'] == 'Closed-Won'
+    # Open deals whose closing date has passed are still expected, so they land in the current month
+    month = month.where(won | (month >= this_month), this_month)
+    probability = frame['stage_id'].map(configured).fillna(frame['user_id'].map(learned)).fillna(0.5)
+    probability[won] = 1.0
+    frame = frame.assign(month=month, open_value=frame['value'].where(~won, 0), won_value=frame['value'].where(won, 0))
+    frame['weighted'] = frame['open_value'] * probability + frame['won_value']
+    frame = frame[(frame['month'] >= this_month) & (frame['month'] < this_month + horizon_months)]
+    if frame.empty: return forecast
+    frame = frame.assign(quarter=frame['month'].dt.asfreq('Q'))
+    owners = dict(db.session.query(User.id, User.username).filter(User.id.in_([int(owner) for owner in frame['user_id'].unique()])).all())
+    forecast.update(
+        totals={'deals': int(len(frame)), 'pipeline': int(frame['open_value'].sum()), 'won': int(frame['won_value'].sum()), 'weighted': round(float(frame['weighted'].sum()))},
+        monthly=_forecast_table(frame, 'month'), quarterly=_forecast_table(frame, 'quarter'), by_country=_forecast_table(frame, 'country'),
+        by_owner=[dict(row, key=owners.get(int(row['key']), row['key'])) for row in _forecast_table(frame, 'user_id')])
+    return forecast
+
+def get_forecast(user_id, horizon_months=FORECAST_HORIZON_MONTHS):
+    key = (user_id, horizon_months, datetime.date.today())
+    forecast_cache = get_forecast_cache()
+    forecast = forecast_cache.get(key)
+    if forecast is None:
+        forecast = compute_forecast(user_id, horizon_months)
+        forecast_cache.set(key, forecast)
+    return forecast
@@ -0,0 +1,141 @@
+import datetime
+from flask import current_app
+from crm.extensions import db
+from crm.models import Contact, Deal, DuplicateCandidate, Organization
+from crm.rollups import rollup_snapshot, update_rollups
+from crm.stages import first_stage_name, resolve_stage_ids
+from crm.forecast import mark_deals_changed
+from crm.writes import insert_logged, run_write
+
+# --- BULK IMPORT ENGINE ---
+# CSVs are read in chunks and each chunk is deduplicated against the database with
+# one set-based lookup, then written with a single executemany insert.
+IMPORT_CHUNK_SIZE = 5000
+IMPORT_KINDS = {
+    # kind: (required columns, optional columns)
+    'organizations': (['Org', 'Country', 'Sponsorship Potential'], []),
+    'contacts': (['Org', 'Name'], ['Title', 'Email']),
+    'deals': (['Org', 'Deal', 'Value', 'Closing Date'], ['Stage']),
+}
+
+def _clean(value):
+    import pandas as pd
+    if value is None or pd.isna(value): return None
+    value = str(value).strip()
+    return value or None
+
+def _resolve_org_ids(names, user_id, create_missing=True):
+    # Map org names to ids in one query, bulk-creating any names we have not seen yet
+    names = set(names)
+    if not names: return {}
+    org_ids = dict(db.session.query(Organization.name, Organization.id).filter(Organization.user_id==user_id, Organization.name.in_(names)).all())
+    missing = names - org_ids.keys()
+    if missing and create_missing:
+        insert_logged(Organization, [{'name': name, 'user_id': user_id} for name in missing])
+        org_ids.update(db.session.query(Organization.name, Organization.id).filter(Organization.user_id==user_id, Organization.name.in_(missing)).all())
+    return org_ids
+
+def _import_organizations(chunk, user_id, counts, context):
+    rows = {}
+    for name, country, potential in zip(chunk['Org'], chunk['Country'], chunk['Sponsorship Potential']):
+        name = _clean(name)
+        if not name:
+            counts['errors'] += 1; continue
+        if name in rows:
+            counts['skipped'] += 1; continue
+        rows[name] = {'name': name, 'country': _clean(country), 'sponsorship_potential': _clean(potential), 'user_id': user_id}
+    existing = {name for (name,) in db.session.query(Organization.name).filter(Organization.user_id==user_id, Organization.name.in_(rows.keys()))}
+    new_rows = [row for name, row in rows.items() if name not in existing]
+    counts['skipped'] += len(rows) - len(new_rows)
+    insert_logged(Organization, new_rows)
+    counts['inserted'] += len(new_rows)
+
+def _import_contacts(chunk, user_id, counts, context):
+    titles = chunk['Title'] if 'Title' in chunk else [None] * len(chunk)
+    emails = chunk['Email'] if 'Email' in chunk else [None] * len(chunk)
+    parsed = []
+    for org_name, name, title, email in zip(chunk['Org'], chunk['Name'], titles, emails):
+        org_name, name = _clean(org_name), _clean(name)
+        if not org_name or not name:
+            counts['errors'] += 1; continue
+        parsed.append((org_name, name, _clean(title), _clean(email)))
+    org_ids = _resolve_org_ids([row[0] for row in parsed], user_id)
+    # A contact is a duplicate if its org already has someone with the same email (or name, when there is no email)
+    seen = set()
+    for org_id, name, email in db.session.query(Contact.org_id, Contact.name, Contact.email).filter(Contact.user_id==user_id, Contact.org_id.in_(org_ids.values())):
+        seen.add((org_id, (email or name).lower()))
+    new_rows = []
+    for org_name, name, title, email in parsed:
+        key = (org_ids[org_name], (email or name).lower())
+        if key in seen:
+            counts['skipped'] += 1; continue
+        seen.add(key)
+        new_rows.append({'name': name, 'title': title, 'email': email, 'org_id': key[0], 'user_id': user_id})
+    insert_logged(Contact, new_rows)
+    counts['inserted'] += len(new_rows)
+
+def _import_deals(chunk, user_id, counts, context):
+    import pandas as pd
+    values = pd.to_numeric(chunk['Value'], errors='coerce')
+    closing_dates = pd.to_datetime(chunk['Closing Date'], errors='coerce')
+    stages = chunk['Stage'] if 'Stage' in chunk else [None] * len(chunk)
+    parsed = []
+    for org_name, name, value, closing_date, stage in zip(chunk['Org'], chunk['Deal'], values, closing_dates, stages):
+        org_name, name = _clean(org_name), _clean(name)
+        if not org_name or not name or pd.isna(value) or pd.isna(closing_date):
+            counts['errors'] += 1; continue
+        parsed.append((org_name, name, int(value), closing_date.date(), _clean(stage)))
+    # Rows without a stage start in the user's first stage; a stage the user does not have, and that is not one of DEAL_STAGES, is an error.
+    # Resolved per chunk, inside its write, so a stage created for a chunk that rolls back is not reused.
+    default = first_stage_name(user_id)
+    stage_ids = resolve_stage_ids(user_id, {row[4] or default for row in parsed})
+    parsed = [row[:4] + (row[4] or default,) for row in parsed]
+    counts['errors'] += sum(row[4] not in stage_ids for row in parsed)
+    parsed = [row for row in parsed if row[4] in stage_ids]
+    org_ids = _resolve_org_ids([row[0] for row in parsed], user_id)
+    seen = set(db.session.query(Deal.organization_id, Deal.name).filter(Deal.user_id==user_id, Deal.organization_id.in_(org_ids.values())).all())
+    now = datetime.datetime.utcnow()
+    new_rows = []
+    for org_name, name, value, closing_date, stage in parsed:
+        key = (org_ids[org_name], name)
+        if key in seen:
+            counts['skipped'] += 1; continue
+        seen.add(key)
+        new_rows.append({'name': name, 'value': value, 'stage': stage, 'stage_id': stage_ids[stage], 'closing_date': closing_date,
+                         'created_at': now, 'updated_at': now, 'stage_entered_at': now, 'organization_id': key[0], 'user_id': user_id})
+    if new_rows:
+        insert_logged(Deal, new_rows)
+        update_rollups(user_id, added=[rollup_snapshot(row) for row in new_rows])
+        mark_deals_changed(user_id)
+    counts['inserted'] += len(new_rows)
+
+IMPORTERS = {'organizations': _import_organizations, 'contacts': _import_contacts, 'deals': _import_deals}
+
+def import_csv(stream, kind, user_id, chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+    # Returns a dict of row counts. Each chunk is committed on its own so a bad chunk
+    # only loses its own rows; progress(counts) is called after every chunk.
+    required, optional = IMPORT_KINDS[kind]
+    importer = IMPORTERS[kind]
+    counts = {'rows': 0, 'inserted': 0, 'skipped': 0, 'errors': 0, 'chunks': 0, 'duplicates': 0}
+    context = {}
+    started = datetime.datetime.utcnow()
+    import pandas as pd
+    for chunk in pd.read_csv(stream, chunksize=chunk_size, usecols=lambda col: col in required or col in optional):
+        if counts['chunks'] == 0:
+            missing = [col for col in required if col not in chunk.columns]
+            if missing: raise ValueError(f'CSV is missing columns: {", ".join(missing)}')
+        counts['chunks'] += 1
+        counts['rows'] += len(chunk)
+        before = dict(counts)
+        try:
+            run_write(lambda: importer(chunk, user_id, counts, context))
+        except Exception:
+            current_app.logger.exception('Import chunk %s failed', counts['chunks'])
+            counts.update(before)
+            counts['errors'] += len(chunk)
+            context.clear()
+        if progress: progress(counts)
+    # New rows were scored against their blocks as they went in; report the likely duplicates they raised
+    counts['duplicates'] = db.session.query(DuplicateCandidate.id).filter(DuplicateCandidate.user_id==user_id, DuplicateCandidate.status=='open',
+                                                                          DuplicateCandidate.created_at >= started).count()
+    return counts
@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import Counter
+from flask import current_app, request, g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# --- PERFORMANCE INSTRUMENTATION ---
+# Every request records its query count, SQL time, template time and wall time per
+# endpoint into Prometheus-style histograms served at /metrics. Statements repeated
+# within one request are counted as N+1 patterns. Metrics are per process.
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name, self.help_text, self.buckets = name, help_text, buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, value):
+        with self._lock:
+            counts, totals = self._series.setdefault(endpoint, ([0] * len(self.buckets), [0.0, 0]))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: counts[i] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for endpoint, (counts, (total, count)) in sorted(self._series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {count}')
+                lines.append(f'{self.name}_sum{{endpoint="{endpoint}"}} {total:.6f}')
+                lines.append(f'{self.name}_count{{endpoint="{endpoint}"}} {count}')
+        return lines
+
+class CounterMetric:
+    def __init__(self, name, help_text, label='endpoint'):
+        self.name, self.help_text, self.label = name, help_text, label
+        self._values = Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, key, amount=1):
+        with self._lock: self._values[key] += amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            lines += [f'{self.name}{{{self.label}="{key}"}} {value}' for key, value in sorted(self._values.items())]
+        return lines
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250, 1000)
+METRICS = {
+    'wall': Histogram('crm_request_duration_seconds', 'Wall time per request.', SECONDS_BUCKETS),
+    'sql': Histogram('crm_request_sql_seconds', 'Time spent executing SQL per request.', SECONDS_BUCKETS),
+    'template': Histogram('crm_request_template_seconds', 'Time spent rendering templates per request.', SECONDS_BUCKETS),
+    'queries': Histogram('crm_request_queries', 'SQL statements executed per request.', QUERY_BUCKETS),
+    'n_plus_one': CounterMetric('crm_n_plus_one_total', 'Requests that repeated one SQL statement past the N+1 threshold.'),
+    'page_cache': CounterMetric('crm_page_cache_total', 'Cached page views by outcome: not_modified, memory, disk or rendered.', label='result'),
+    'user_loads': CounterMetric('crm_user_loads_total', 'Logged-in user loads by source; session and cache are hits, database is a miss.', label='source'),
+}
+
+def _request_stats():
+    if not has_request_context(): return None
+    return g.get('perf')
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _request_stats() is not None: conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _request_stats()
+    if stats is None or not conn.info.get('query_start'): return
+    stats['sql'] += time.perf_counter() - conn.info['query_start'].pop()
+    stats['queries'] += 1
+    stats['statements'][statement] += 1
+
+# Request hooks and template signals are connected to each app by create_app()
+def before_render(sender, template, context, **extra):
+    stats = _request_stats()
+    if stats is not None: stats['template_start'].append(time.perf_counter())
+
+def after_render(sender, template, context, **extra):
+    stats = _request_stats()
+    if stats is not None and stats['template_start']:
+        start = stats['template_start'].pop()
+        # Only the outermost render counts; includes are already inside its time
+        if not stats['template_start']: stats['template'] += time.perf_counter() - start
+
+def start_request_timer():
+    g.perf = {'start': time.perf_counter(), 'queries': 0, 'sql': 0.0, 'template': 0.0, 'template_start': [], 'statements': Counter()}
+
+def record_request_metrics(response):
+    stats = g.pop('perf', None)
+    if stats is None or request.endpoint == 'main.metrics': return response
+    endpoint = request.endpoint or 'unmatched'
+    wall = time.perf_counter() - stats['start']
+    METRICS['wall'].observe(endpoint, wall)
+    METRICS['sql'].observe(endpoint, stats['sql'])
+    METRICS['template'].observe(endpoint, stats['template'])
+    METRICS['queries'].observe(endpoint, stats['queries'])
+    repeated = {statement: count for statement, count in stats['statements'].items() if count >= current_app.config['N_PLUS_ONE_THRESHOLD']}
+    if repeated: METRICS['n_plus_one'].inc(endpoint)
+    response.headers['Server-Timing'] = f"sql;dur={stats['sql'] * 1000:.1f}, tpl;dur={stats['template'] * 1000:.1f}, total;dur={wall * 1000:.1f}"
+    slow_ms = current_app.config['SLOW_REQUEST_MS']
+    if slow_ms is not None and wall * 1000 >= slow_ms:
+        current_app.logger.warning('Slow request %s %s (%s): %.0f ms, %d queries, %.0f ms SQL, %.0f ms templates%s', request.method, request.path, endpoint,
+                           wall * 1000, stats['queries'], stats['sql'] * 1000, stats['template'] * 1000,
+                           ''.join(f'\n  N+1 x{count}: {statement[:200]}' for statement, count in repeated.items()))
+    return response
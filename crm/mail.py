@@ -0,0 +1,157 @@
+import datetime
+import queue
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import smtplib
+from email.mime.text import MIMEText
+from flask import current_app
+from sqlalchemy import and_, or_, select, update
+from crm.extensions import app_service, db
+from crm.models import Interaction, OutboundEmail
+from crm.writes import insert_logged
+
+# --- OUTBOUND MAIL ---
+# Messages are written to the outbound_email table and delivered by a background
+# dispatcher over pooled, already-authenticated SMTP connections. Failed sends are
+# retried with exponential backoff and delivered mail is logged as Interactions in bulk.
+class SMTPPool:
+    CHECK_IDLE_AFTER = 30 # Seconds; connections idle for longer get a NOOP before reuse, busy ones are trusted
+
+    def __init__(self, host, port, use_ssl, username, password, size, timeout=30):
+        self.host, self.port, self.use_ssl, self.username, self.password, self.timeout = host, port, use_ssl, username, password, timeout
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue() # (connection, time it was returned)
+
+    def _connect(self):
+        smtp = (smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP)(self.host, self.port, timeout=self.timeout)
+        if self.password: smtp.login(self.username, self.password)
+        return smtp
+
+    def _checkout(self):
+        while True:
+            try:
+                smtp, returned_at = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - returned_at < self.CHECK_IDLE_AFTER: return smtp
+            try:
+                if smtp.noop()[0] == 250: return smtp
+            except smtplib.SMTPException:
+                pass
+            self._discard(smtp)
+
+    def _discard(self, smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            smtp.close()
+
+    @contextmanager
+    def connection(self):
+        with self._slots:
+            smtp = self._checkout()
+            try:
+                yield smtp
+            except smtplib.SMTPResponseException:
+                # The server rejected this message but the session is still usable
+                self._idle.put((smtp, time.monotonic())); raise
+            except Exception:
+                self._discard(smtp); raise
+            else:
+                self._idle.put((smtp, time.monotonic()))
+
+    def close(self):
+        while not self._idle.empty():
+            self._discard(self._idle.get_nowait()[0])
+
+def mail_configured():
+    return bool(current_app.config['EMAIL_ADDRESS'] and current_app.config['EMAIL_SMTP_SERVER'])
+
+def enqueue_emails(rows):
+    # rows are dicts with recipient, subject, body, contact_id, user_id and optionally campaign
+    if not rows: return
+    now = datetime.datetime.utcnow()
+    db.session.execute(OutboundEmail.__table__.insert(), [{'campaign': None, **row, 'status': 'queued', 'attempts': 0, 'next_attempt_at': now, 'created_at': now} for row in rows])
+
+class MailDispatcher:
+    STALE_CLAIM = datetime.timedelta(minutes=10) # Reclaim 'sending' rows left behind by a crashed worker
+
+    def __init__(self, pool, batch_size, max_attempts, backoff, poll_interval=15):
+        self.pool, self.batch_size, self.max_attempts, self.backoff, self.poll_interval = pool, batch_size, max_attempts, backoff, poll_interval
+        self.app = current_app._get_current_object() # The worker thread pushes its own app context
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def wake(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='mail-dispatcher', daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            with self.app.app_context():
+                try:
+                    while self.dispatch_once(): pass
+                except Exception:
+                    db.session.rollback()
+                    current_app.logger.exception('Mail dispatch failed')
+
+    def _claim(self):
+        # Claim a batch with one UPDATE so several workers never send the same row
+        token, now = uuid.uuid4().hex, datetime.datetime.utcnow()
+        due = select(OutboundEmail.id).where(or_(
+            and_(OutboundEmail.status=='queued', OutboundEmail.next_attempt_at <= now),
+            and_(OutboundEmail.status=='sending', OutboundEmail.claimed_at < now - self.STALE_CLAIM),
+        )).order_by(OutboundEmail.next_attempt_at).limit(self.batch_size)
+        db.session.execute(update(OutboundEmail).where(OutboundEmail.id.in_(due)).values(status='sending', claim_token=token, claimed_at=now)
+                           .execution_options(synchronize_session=False))
+        db.session.commit()
+        return OutboundEmail.query.filter_by(claim_token=token, status='sending').all()
+
+    def dispatch_once(self):
+        # Sends one batch and returns how many messages were attempted
+        emails = self._claim()
+        sent = []
+        for email in emails:
+            msg = MIMEText(email.body)
+            msg['Subject'] = email.subject
+            msg['From'] = current_app.config['EMAIL_ADDRESS']
+            msg['To'] = email.recipient
+            try:
+                with self.pool.connection() as smtp:
+                    smtp.send_message(msg)
+            except Exception as e:
+                email.attempts += 1
+                email.last_error = str(e)
+                email.status = 'failed' if email.attempts >= self.max_attempts else 'queued'
+                email.next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.backoff * 2 ** (email.attempts - 1))
+            else:
+                email.attempts += 1
+                email.status, email.sent_at = 'sent', datetime.datetime.utcnow()
+                sent.append(email)
+        if sent:
+            # Log the email as an interaction
+            insert_logged(Interaction, [
+                {'interaction_type': 'Email Sent', 'notes': f"Subject: {email.subject}\n\n{email.body}", 'date': email.sent_at,
+                 'contact_id': email.contact_id, 'user_id': email.user_id} for email in sent])
+        db.session.commit()
+        return len(emails)
+
+def get_mail_dispatcher():
+    def build(config):
+        pool = SMTPPool(config['EMAIL_SMTP_SERVER'], config['EMAIL_SMTP_PORT'], config['EMAIL_USE_SSL'], config['EMAIL_ADDRESS'], config['EMAIL_PASSWORD'],
+                        config['MAIL_POOL_SIZE'])
+        return MailDispatcher(pool, config['MAIL_BATCH_SIZE'], config['MAIL_MAX_ATTEMPTS'], config['MAIL_RETRY_BACKOFF'])
+    return app_service('mail_dispatcher', build)
+
+def render_mail_template(template, values):
+    # Fills {name}-style placeholders; unknown placeholders are left as written
+    return re.sub(r'\{(\w+)\}', lambda m: str(values.get(m.group(1)) or '') if m.group(1) in values else m.group(0), template)
@@ -0,0 +1,96 @@
+import datetime
+from sqlalchemy import text
+from crm.extensions import db
+from crm.search import rebuild_search_index
+from crm.rollups import rebuild_rollups
+from crm.stages import backfill_stage_history, realign_deal_stages, rebuild_stage_analytics
+from crm.changes import backfill_change_log
+from crm.duplicates import find_all_duplicates
+
+# --- SCHEMA MIGRATIONS ---
+# Schema changes are numbered steps recorded in schema_migrations and applied in order
+# by `flask db-upgrade`. A step is a list of SQL strings or callables; each must be safe
+# to re-run, since a fresh database gets the current schema from create_all first.
+def _create_missing_tables():
+    db.create_all()
+
+def _add_column(table, column, ddl):
+    def step():
+        columns = {row[1] for row in db.session.execute(text(f'PRAGMA table_info("{table}")'))}
+        if column not in columns: db.session.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {ddl}'))
+    return step
+
+MIGRATIONS = [
+    (1, 'Create tables added since the first release', [_create_missing_tables]),
+    (2, 'Index timeline, mail queue and per-user query shapes', [
+        'CREATE INDEX IF NOT EXISTS ix_interaction_contact_date ON interaction (contact_id, date)',
+        'CREATE INDEX IF NOT EXISTS ix_task_contact_due_date ON task (contact_id, due_date)',
+        'CREATE INDEX IF NOT EXISTS ix_outbound_email_due ON outbound_email (status, next_attempt_at)',
+        'CREATE INDEX IF NOT EXISTS ix_organization_user_name ON organization (user_id, name)',
+        'CREATE INDEX IF NOT EXISTS ix_contact_org_id ON contact (org_id)',
+        'CREATE INDEX IF NOT EXISTS ix_contact_user_org ON contact (user_id, org_id)',
+        'CREATE INDEX IF NOT EXISTS ix_event_date ON event (date)',
+        'CREATE INDEX IF NOT EXISTS ix_attendee_event_id ON attendee (event_id)',
+        'CREATE INDEX IF NOT EXISTS ix_attendee_organization_id ON attendee (organization_id)',
+        'CREATE INDEX IF NOT EXISTS ix_deal_user_stage ON deal (user_id, stage)',
+        'CREATE INDEX IF NOT EXISTS ix_deal_user_stage_id ON deal (user_id, stage_id)',
+        'CREATE INDEX IF NOT EXISTS ix_deal_organization_id ON deal (organization_id)',
+        'CREATE INDEX IF NOT EXISTS ix_pipeline_stage_user_order ON pipeline_stage (user_id, "order")',
+        'CREATE INDEX IF NOT EXISTS ix_file_organization_id ON file (organization_id)',
+        'CREATE INDEX IF NOT EXISTS ix_custom_field_organization_id ON custom_field (organization_id)',
+        'CREATE INDEX IF NOT EXISTS ix_deal_contact_association_contact_id ON deal_contact_association (contact_id)',
+    ]),
+    (3, 'Backfill the search index and reporting rollups', [lambda: rebuild_search_index(), lambda: rebuild_rollups()]),
+    (4, 'Content-addressed file storage', [_create_missing_tables, _add_column('file', 'blob_sha256', 'blob_sha256 VARCHAR(64) REFERENCES stored_blob (sha256)'),
+                                           _add_column('file', 'size', 'size INTEGER'), _add_column('file', 'content_type', 'content_type VARCHAR(100)')]),
+    (5, 'Automation rules and overdue task scanning', [_create_missing_tables, _add_column('task', 'overdue_fired', 'overdue_fired BOOLEAN NOT NULL DEFAULT 0'),
+                                                       'CREATE INDEX IF NOT EXISTS ix_task_overdue_scan ON task (status, overdue_fired, due_date)']),
+    (6, 'Organization typeahead and attendee anti-join indexes', [
+        'CREATE INDEX IF NOT EXISTS ix_organization_user_lower_name ON organization (user_id, lower(name))',
+        'CREATE INDEX IF NOT EXISTS ix_attendee_event_org ON attendee (event_id, organization_id)',
+        'DROP INDEX IF EXISTS ix_attendee_event_id',
+    ]),
+    (7, 'Incremental deal exports', ['CREATE INDEX IF NOT EXISTS ix_deal_user_updated ON deal (user_id, updated_at)']),
+    (8, 'Per-stage win probabilities', [_add_column('pipeline_stage', 'win_probability', 'win_probability INTEGER')]),
+    (9, 'Data versions for page caching', [_create_missing_tables]),
+    (10, 'Change feed for incremental sync', [_create_missing_tables, lambda: backfill_change_log()]),
+    (11, 'Pub/sub table for live pipeline updates', [_create_missing_tables]),
+    (12, 'Duplicate detection index', [_create_missing_tables, lambda: find_all_duplicates()]),
+    (13, 'Deal stage history and dwell-time analytics', [_create_missing_tables, _add_column('deal', 'stage_entered_at', 'stage_entered_at DATETIME'),
+                                                          'CREATE INDEX IF NOT EXISTS ix_deal_user_stage_entered ON deal (user_id, stage, stage_entered_at)',
+                                                          lambda: backfill_stage_history(), lambda: rebuild_stage_analytics()]),
+    (14, 'Batch AI drafting', [_create_missing_tables]),
+    (15, 'Sync deal stage names with stage ids', [lambda: realign_deal_stages(), 'UPDATE deal SET stage = (SELECT name FROM pipeline_stage WHERE pipeline_stage.id = deal.stage_id) '
+                                                  'WHERE stage_id IN (SELECT id FROM pipeline_stage) AND stage IS NOT (SELECT name FROM pipeline_stage WHERE pipeline_stage.id = deal.stage_id)',
+                                                  lambda: rebuild_rollups()]),
+    (16, 'Recount stored blob references', ['UPDATE stored_blob SET ref_count = (SELECT count(*) FROM file WHERE file.blob_sha256 = stored_blob.sha256)',
+                                            'DELETE FROM stored_blob WHERE ref_count <= 0']), # `flask gc-blobs` then removes their bytes
+    (17, 'Persist interactive AI draft jobs', [_create_missing_tables]),
+]
+
+def _ensure_migrations_table():
+    db.session.execute(text('CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, name VARCHAR(200) NOT NULL, applied_at DATETIME NOT NULL)'))
+    db.session.commit()
+
+def current_schema_version():
+    _ensure_migrations_table()
+    return db.session.execute(text('SELECT coalesce(max(version), 0) FROM schema_migrations')).scalar()
+
+def upgrade_schema(mark_only=False):
+    # Applies pending migrations in order and returns the ones applied; mark_only records them without running
+    applied = []
+    version = current_schema_version()
+    for number, name, steps in MIGRATIONS:
+        if number <= version: continue
+        try:
+            if not mark_only:
+                for step in steps:
+                    if callable(step): step()
+                    else: db.session.execute(text(step))
+            db.session.execute(text('INSERT INTO schema_migrations (version, name, applied_at) VALUES (:version, :name, :now)'),
+                               {'version': number, 'name': name, 'now': datetime.datetime.utcnow()})
+            db.session.commit()
+        except Exception:
+            db.session.rollback(); raise
+        applied.append((number, name))
+    return applied
@@ -0,0 +1,311 @@
+import datetime
+from werkzeug.security import generate_password_hash, check_password_hash
+from flask_login import UserMixin
+from sqlalchemy import func
+from crm.extensions import db
+
+# --- Association Tables ---
+deal_contact_association = db.Table('deal_contact_association',
+    db.Column('deal_id', db.Integer, db.ForeignKey('deal.id'), primary_key=True),
+    db.Column('contact_id', db.Integer, db.ForeignKey('contact.id'), primary_key=True),
+    db.Column('role', db.String(100))
+)
+
+# --- DATABASE MODELS ---
+class User(UserMixin, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), unique=True, nullable=False)
+    email = db.Column(db.String(120), unique=True, nullable=False)
+    password_hash = db.Column(db.String(256), nullable=False)
+    organizations = db.relationship('Organization', backref='owner', lazy=True)
+    deals = db.relationship('Deal', backref='owner', lazy=True)
+    
+    def set_password(self, password): self.password_hash = generate_password_hash(password)
+    def check_password(self, password): return check_password_hash(self.password_hash, password)
+
+class Organization(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    country = db.Column(db.String(100))
+    sponsorship_potential = db.Column(db.String(50), default='High (Sponsor Target)')
+    strategic_notes = db.Column(db.Text)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    contacts = db.relationship('Contact', backref='organization', lazy='dynamic', cascade="all, delete-orphan")
+    deals = db.relationship('Deal', backref='organization', lazy='dynamic', cascade="all, delete-orphan")
+    files = db.relationship('File', backref='organization', lazy='dynamic', cascade="all, delete-orphan")
+    event_attendances = db.relationship('Attendee', backref='organization', lazy='dynamic', cascade="all, delete-orphan")
+    custom_fields = db.relationship('CustomField', backref='organization', lazy=True, cascade="all, delete-orphan")
+    files = db.relationship('File', backref='organization', lazy='dynamic', cascade="all, delete-orphan")
+    __table_args__ = (db.Index('ix_organization_user_name', 'user_id', 'name'),)
+
+# Case-insensitive prefix lookups for the organization typeahead range-scan this index
+db.Index('ix_organization_user_lower_name', Organization.user_id, func.lower(Organization.name))
+
+class Contact(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(150), nullable=False)
+    title = db.Column(db.String(200))
+    email = db.Column(db.String(150))
+    org_id = db.Column(db.Integer, db.ForeignKey('organization.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    interactions = db.relationship('Interaction', backref='contact', lazy='dynamic', cascade="all, delete-orphan")
+    tasks = db.relationship('Task', backref='contact', lazy='dynamic', cascade="all, delete-orphan")
+    deals = db.relationship('Deal', secondary=deal_contact_association, back_populates='contacts')
+    __table_args__ = (db.Index('ix_contact_org_id', 'org_id'), db.Index('ix_contact_user_org', 'user_id', 'org_id'))
+
+class Interaction(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    interaction_type = db.Column(db.String(50), nullable=False)
+    date = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    notes = db.Column(db.Text, nullable=False)
+    contact_id = db.Column(db.Integer, db.ForeignKey('contact.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    __table_args__ = (db.Index('ix_interaction_contact_date', 'contact_id', 'date'),)
+
+class Task(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(200), nullable=False)
+    due_date = db.Column(db.DateTime, nullable=False)
+    status = db.Column(db.String(50), nullable=False, default='Pending')
+    overdue_fired = db.Column(db.Boolean, nullable=False, default=False) # Set once the task_overdue automations have run for it
+    contact_id = db.Column(db.Integer, db.ForeignKey('contact.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    __table_args__ = (db.Index('ix_task_contact_due_date', 'contact_id', 'due_date'), db.Index('ix_task_overdue_scan', 'status', 'overdue_fired', 'due_date'))
+
+class Event(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    location = db.Column(db.String(100))
+    attendees = db.relationship('Attendee', backref='event', lazy='dynamic', cascade="all, delete-orphan")
+    __table_args__ = (db.Index('ix_event_date', 'date'),)
+
+class Attendee(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    registration_type = db.Column(db.String(50), nullable=False)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    event_id = db.Column(db.Integer, db.ForeignKey('event.id'), nullable=False)
+    organization_id = db.Column(db.Integer, db.ForeignKey('organization.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    __table_args__ = (db.Index('ix_attendee_event_org', 'event_id', 'organization_id'), db.Index('ix_attendee_organization_id', 'organization_id'))
+
+class Deal(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    value = db.Column(db.Integer, default=0)
+    stage = db.Column(db.String(50), nullable=False, default='Lead')
+    stage_id = db.Column(db.Integer, db.ForeignKey('pipeline_stage.id'))
+    closing_date = db.Column(db.Date, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    stage_entered_at = db.Column(db.DateTime, default=datetime.datetime.utcnow) # When the deal moved into its current stage
+    organization_id = db.Column(db.Integer, db.ForeignKey('organization.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    contacts = db.relationship('Contact', secondary=deal_contact_association, back_populates='deals')
+    __table_args__ = (db.Index('ix_deal_user_stage', 'user_id', 'stage'), db.Index('ix_deal_user_stage_id', 'user_id', 'stage_id'),
+                      db.Index('ix_deal_organization_id', 'organization_id'), db.Index('ix_deal_user_updated', 'user_id', 'updated_at'),
+                      db.Index('ix_deal_user_stage_entered', 'user_id', 'stage', 'stage_entered_at'))
+
+class PipelineStage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    order = db.Column(db.Integer, nullable=False) # To control the display order
+    win_probability = db.Column(db.Integer) # Percent used by the forecast; null means learned from the user's win rate
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    __table_args__ = (db.Index('ix_pipeline_stage_user_order', 'user_id', 'order'),)
+
+class StoredBlob(db.Model):
+    # One row per distinct file content on disk; ref_count is the number of File rows using it
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+class File(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(200), nullable=False)
+    uploaded_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    blob_sha256 = db.Column(db.String(64), db.ForeignKey('stored_blob.sha256')) # Null for files saved before content-addressed storage
+    size = db.Column(db.Integer)
+    content_type = db.Column(db.String(100))
+    organization_id = db.Column(db.Integer, db.ForeignKey('organization.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    __table_args__ = (db.Index('ix_file_organization_id', 'organization_id'),)
+
+class ReportingRollup(db.Model):
+    # Running per-user totals for closed deals, maintained by update_rollups()
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    won_count = db.Column(db.Integer, nullable=False, default=0)
+    lost_count = db.Column(db.Integer, nullable=False, default=0)
+    won_value = db.Column(db.Integer, nullable=False, default=0)
+    cycle_days_sum = db.Column(db.Integer, nullable=False, default=0) # Days from created_at to closing_date, won deals only
+    cycle_count = db.Column(db.Integer, nullable=False, default=0)
+
+class ReportingYearRollup(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True) # Year of closing_date
+    won_count = db.Column(db.Integer, nullable=False, default=0)
+    lost_count = db.Column(db.Integer, nullable=False, default=0)
+
+class DealStageChange(db.Model):
+    # Append-only stage history, one row per transition; from_stage is null for the stage a deal was created in
+    id = db.Column(db.Integer, primary_key=True)
+    deal_id = db.Column(db.Integer, nullable=False) # Not a foreign key: history outlives deleted deals
+    from_stage = db.Column(db.String(50))
+    to_stage = db.Column(db.String(50), nullable=False)
+    dwell_seconds = db.Column(db.Integer) # Time spent in from_stage
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    user_id = db.Column(db.Integer, nullable=False)
+    __table_args__ = (db.Index('ix_deal_stage_change_deal', 'deal_id', 'to_stage'),)
+
+class StageDwellStat(db.Model):
+    # Running per-stage totals, adjusted on every transition by record_stage_changes()
+    user_id = db.Column(db.Integer, primary_key=True)
+    stage = db.Column(db.String(50), primary_key=True)
+    reached = db.Column(db.Integer, nullable=False, default=0) # Deals that entered the stage at least once
+    exits = db.Column(db.Integer, nullable=False, default=0) # Transitions out of the stage; the dwell samples
+    dwell_seconds_sum = db.Column(db.Integer, nullable=False, default=0)
+
+class StageDwellBucket(db.Model):
+    # Log-spaced histogram of dwell times per stage: the quantile sketch behind p50/p90
+    user_id = db.Column(db.Integer, primary_key=True)
+    stage = db.Column(db.String(50), primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True) # See dwell_bucket()
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class OutboundEmail(db.Model):
+    # Durable send queue drained by MailDispatcher
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(150), nullable=False)
+    subject = db.Column(db.String(300), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    campaign = db.Column(db.String(200))
+    status = db.Column(db.String(20), nullable=False, default='queued') # queued, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    claim_token = db.Column(db.String(32))
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    contact_id = db.Column(db.Integer, db.ForeignKey('contact.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    __table_args__ = (db.Index('ix_outbound_email_due', 'status', 'next_attempt_at'),)
+
+class DraftBatch(db.Model):
+    # AI drafts prepared together for one contact set; the counts are kept current while it runs
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(300), nullable=False) # Purpose of the email, also the draft subject
+    key_points = db.Column(db.Text)
+    audience = db.Column(db.String(300)) # Description of the contact set
+    status = db.Column(db.String(20), nullable=False, default='queued') # queued, running, done, failed, cancelled
+    total = db.Column(db.Integer, nullable=False, default=0)
+    ready_count = db.Column(db.Integer, nullable=False, default=0)
+    failed_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    __table_args__ = (db.Index('ix_draft_batch_user_created', 'user_id', 'created_at'),)
+
+class EmailDraft(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(300), nullable=False)
+    body = db.Column(db.Text)
+    status = db.Column(db.String(20), nullable=False, default='pending') # pending, ready, failed, sent, discarded
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    batch_id = db.Column(db.Integer, db.ForeignKey('draft_batch.id'), nullable=False)
+    contact_id = db.Column(db.Integer, db.ForeignKey('contact.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    contact = db.relationship('Contact')
+    __table_args__ = (db.Index('ix_email_draft_batch_status', 'batch_id', 'status'),)
+
+class DraftJob(db.Model):
+    # One interactive AI draft; any worker can answer the compose page's polls from this row
+    id = db.Column(db.String(32), primary_key=True) # uuid4 hex, so job ids cannot be guessed
+    status = db.Column(db.String(20), nullable=False, default='queued') # queued, running, done, error
+    draft = db.Column(db.Text)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    deadline = db.Column(db.DateTime, nullable=False) # Not started by then, or not finished, and the job has timed out
+    finished_at = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    __table_args__ = (db.Index('ix_draft_job_status_finished', 'status', 'finished_at'),)
+
+class AutomationRule(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    trigger = db.Column(db.String(30), nullable=False) # A key of AUTOMATION_TRIGGERS
+    condition = db.Column(db.String(100)) # Stage or interaction type to match; empty matches any
+    action = db.Column(db.String(30), nullable=False) # A key of AUTOMATION_ACTIONS
+    delay_days = db.Column(db.Integer, nullable=False, default=0)
+    title = db.Column(db.String(300), nullable=False) # Task title or email subject, with {placeholders}
+    body = db.Column(db.Text) # Email body, with {placeholders}
+    enabled = db.Column(db.Boolean, nullable=False, default=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    __table_args__ = (db.Index('ix_automation_rule_user_trigger', 'user_id', 'trigger'),)
+
+class CustomField(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    field_name = db.Column(db.String(100), nullable=False)
+    field_value = db.Column(db.String(500))
+    organization_id = db.Column(db.Integer, db.ForeignKey('organization.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    __table_args__ = (db.Index('ix_custom_field_organization_id', 'organization_id'),)
+
+db.Index('ix_deal_contact_association_contact_id', deal_contact_association.c.contact_id)
+
+class ChangeLog(db.Model):
+    # Append-only feed of row changes served by /api/changes; id is the sync cursor and never reused
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False) # 0 for rows shared by all users
+    entity = db.Column(db.String(40), nullable=False) # Table name
+    row_key = db.Column(db.String(40), nullable=False) # Row id, or "deal_id:contact_id" for deal_contact_association
+    op = db.Column(db.String(6), nullable=False) # upsert or delete
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    __table_args__ = (db.Index('ix_change_log_user_id', 'user_id', 'id'), db.Index('ix_change_log_entity_row', 'entity', 'row_key', 'id'),
+                      {'sqlite_autoincrement': True})
+
+class ChangeLogPurge(db.Model):
+    # One row per retention run; cursors below purged_through may have missed deletes
+    id = db.Column(db.Integer, primary_key=True)
+    purged_through = db.Column(db.Integer, nullable=False)
+    purged_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+class BrokerMessage(db.Model):
+    # Transport for the sqlite pub/sub backend; every worker polls it and old rows are pruned
+    id = db.Column(db.Integer, primary_key=True)
+    channel = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    __table_args__ = ({'sqlite_autoincrement': True},)
+
+class DataVersion(db.Model):
+    # Bumped in the same transaction as every write to an entity; cached pages are keyed by it
+    user_id = db.Column(db.Integer, primary_key=True) # 0 for entities shared by all users
+    entity = db.Column(db.String(30), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class DedupeKey(db.Model):
+    # Blocking index for duplicate detection: a record is only compared with records sharing one of its blocks
+    kind = db.Column(db.String(20), primary_key=True) # organization or contact
+    record_id = db.Column(db.Integer, primary_key=True)
+    block = db.Column(db.String(300), primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    __table_args__ = (db.Index('ix_dedupe_key_block', 'kind', 'user_id', 'block', 'record_id'),)
+
+class DuplicateCandidate(db.Model):
+    # A likely duplicate pair awaiting review; record_id is always the lower id of the two
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    record_id = db.Column(db.Integer, nullable=False)
+    duplicate_id = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='open') # open or dismissed
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    user_id = db.Column(db.Integer, nullable=False)
+    __table_args__ = (db.UniqueConstraint('kind', 'record_id', 'duplicate_id'), db.Index('ix_duplicate_candidate_user', 'user_id', 'kind', 'status', 'score'),
+                      db.Index('ix_duplicate_candidate_duplicate', 'kind', 'duplicate_id'))
+
+DEAL_STAGES = ['Lead', 'Contacted', 'Proposal Sent', 'Negotiation', 'Closed-Won', 'Closed-Lost']
+CLOSED_STAGES = ('Closed-Won', 'Closed-Lost')
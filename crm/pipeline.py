@@ -0,0 +1,216 @@
+import datetime
+import json
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy import func, and_, case, select, update
+from crm.extensions import app_service, db
+from crm.models import BrokerMessage, Deal, deal_contact_association, Organization
+from crm.rollups import rollup_snapshot, update_rollups
+from crm.stages import dwell_seconds, record_stage_changes
+from crm.forecast import mark_deals_changed
+from crm.changes import log_changes
+from crm.writes import run_write
+
+# --- PIPELINE EVENTS ---
+# Deal writes publish small JSON patches to the owner's channel, and each open pipeline
+# board holds a server-sent events stream on it. Publishers never block: a subscription
+# keeps only the latest patch per deal, and a stream that falls too far behind is told to
+# reload instead. The local broker reaches streams in this process only; the sqlite broker
+# is a cross-worker stand-in that relays through a table, with the interface a Redis
+# backend would implement.
+class Subscription:
+    def __init__(self, max_pending):
+        self.max_pending = max_pending
+        self._patches = OrderedDict() # deal id -> latest patch
+        self._summary = None
+        self._reload = False
+        self._ready = threading.Condition()
+
+    def offer(self, message):
+        with self._ready:
+            for patch in message.get('patches', ()):
+                self._patches.pop(patch['id'], None)
+                self._patches[patch['id']] = patch
+            if message.get('reload') or len(self._patches) > self.max_pending:
+                self._patches.clear(); self._reload = True
+            if message.get('summary') is not None: self._summary = message['summary']
+            self._ready.notify()
+
+    def wait(self, timeout):
+        with self._ready:
+            return self._ready.wait_for(lambda: self._patches or self._reload or self._summary is not None, timeout)
+
+    def drain(self):
+        with self._ready:
+            batch = {'reload': True} if self._reload else {'patches': list(self._patches.values()), 'summary': self._summary}
+            self._patches, self._summary, self._reload = OrderedDict(), None, False
+            return batch
+
+class LocalBroker:
+    def __init__(self, max_pending):
+        self.max_pending = max_pending
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        subscription = Subscription(self.max_pending)
+        with self._lock: self._channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, channel, subscription):
+        with self._lock:
+            subscriptions = self._channels.get(channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions: self._channels.pop(channel, None)
+
+    def subscriber_count(self):
+        with self._lock: return sum(len(subscriptions) for subscriptions in self._channels.values())
+
+    def has_subscribers(self, channel):
+        return channel in self._channels
+
+    def publish(self, channel, message):
+        self.deliver(channel, message)
+
+    def deliver(self, channel, message):
+        with self._lock: subscriptions = list(self._channels.get(channel, ()))
+        for subscription in subscriptions: subscription.offer(message)
+
+class SQLiteBroker(LocalBroker):
+    MESSAGE_TTL = 60 # Seconds a relayed message is kept for workers to pick up
+
+    def __init__(self, max_pending, poll_interval):
+        super().__init__(max_pending)
+        self.poll_interval = poll_interval
+        self.app = current_app._get_current_object()
+        self._thread = None
+        self._last_id = None
+
+    def has_subscribers(self, channel):
+        return True # Streams in other workers are not visible from here
+
+    def publish(self, channel, message):
+        payload = json.dumps(message)
+        run_write(lambda: db.session.execute(BrokerMessage.__table__.insert().values(channel=channel, payload=payload, created_at=datetime.datetime.utcnow())))
+
+    def subscribe(self, channel):
+        with self._lock:
+            if self._thread is None:
+                self._last_id = db.session.query(func.max(BrokerMessage.id)).scalar() or 0
+                self._thread = threading.Thread(target=self._run, name='pipeline-events', daemon=True)
+                self._thread.start()
+        return super().subscribe(channel)
+
+    def _run(self):
+        polls = 0
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                with self.app.app_context():
+                    rows = db.session.query(BrokerMessage.id, BrokerMessage.channel, BrokerMessage.payload).filter(BrokerMessage.id > self._last_id).order_by(BrokerMessage.id).all()
+                    for message_id, channel, payload in rows:
+                        self._last_id = message_id
+                        if super().has_subscribers(channel): self.deliver(channel, json.loads(payload))
+                    polls += 1
+                    if polls % 100 == 0:
+                        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.MESSAGE_TTL)
+                        db.session.execute(BrokerMessage.__table__.delete().where(BrokerMessage.created_at < cutoff)); db.session.commit()
+            except Exception:
+                self.app.logger.exception('Pipeline event relay failed')
+
+PIPELINE_BROKERS = {'local': LocalBroker, 'sqlite': SQLiteBroker}
+
+def get_pipeline_broker():
+    def build(config):
+        backend, max_pending = config['PIPELINE_EVENTS_BACKEND'], config['PIPELINE_EVENTS_MAX_PENDING']
+        return SQLiteBroker(max_pending, config['PIPELINE_EVENTS_POLL_INTERVAL']) if backend == 'sqlite' else PIPELINE_BROKERS[backend](max_pending)
+    return app_service('pipeline_broker', build)
+
+def pipeline_channel(user_id):
+    return f'pipeline:{user_id}'
+
+def publish_deal_changes(user_id, changed=(), deleted=(), reload=False):
+    # Call after the write has committed. Changed deals that no longer exist are sent as deletes.
+    broker = get_pipeline_broker()
+    channel = pipeline_channel(user_id)
+    if not broker.has_subscribers(channel): return
+    if reload:
+        broker.publish(channel, {'reload': True}); return
+    cards = {card['id']: card for card in pipeline_cards(user_id, changed)} if changed else {}
+    patches = [{'id': deal_id, 'op': 'upsert', 'deal': cards[deal_id]} if deal_id in cards else {'id': deal_id, 'op': 'delete'} for deal_id in changed]
+    patches += [{'id': deal_id, 'op': 'delete'} for deal_id in deleted]
+    # Totals ride along so boards never have to work them out from cards they may not have loaded
+    summary = {str(stage_id): totals for stage_id, totals in pipeline_summary(user_id).items() if stage_id is not None}
+    broker.publish(channel, {'patches': patches, 'summary': summary})
+
+# --- PIPELINE BOARD ---
+# Stage totals, paged board cards and bulk deal actions shared by the pipeline routes and the dashboard.
+PIPELINE_PAGE_SIZE = 50
+STALE_DEAL_DAYS = 14
+
+def pipeline_summary(user_id):
+    # Deal count and value per stage from one grouped query
+    rows = db.session.query(Deal.stage_id, func.count(Deal.id), func.coalesce(func.sum(Deal.value), 0)).filter(Deal.user_id==user_id).group_by(Deal.stage_id).all()
+    return {stage_id: {'count': count, 'value': value} for stage_id, count, value in rows}
+
+def _pipeline_card_query(user_id):
+    return db.session.query(Deal.id, Deal.name, Deal.value, Deal.updated_at, Deal.stage_id, Organization.name, Organization.sponsorship_potential).join(
+        Organization, Deal.organization_id==Organization.id).filter(Deal.user_id==user_id)
+
+def _pipeline_cards(rows):
+    now = datetime.datetime.utcnow()
+    return [{'id': deal_id, 'name': name, 'value': value or 0, 'stage_id': stage_id, 'org_name': org_name,
+             'stale': bool(updated_at and (now - updated_at).days > STALE_DEAL_DAYS),
+             'sponsor_target': potential == 'High (Sponsor Target)'}
+            for deal_id, name, value, updated_at, stage_id, org_name, potential in rows]
+
+def pipeline_cards(user_id, deal_ids):
+    return _pipeline_cards(_pipeline_card_query(user_id).filter(Deal.id.in_(deal_ids)).all())
+
+def pipeline_stage_page(user_id, stage_id, before_id=None, limit=PIPELINE_PAGE_SIZE):
+    # Keyset pagination on deal id (newest first) with the org columns joined in, so a page is one query
+    query = _pipeline_card_query(user_id).filter(Deal.stage_id==stage_id)
+    if before_id: query = query.filter(Deal.id < before_id)
+    rows = query.order_by(Deal.id.desc()).limit(limit + 1).all()
+    deals = _pipeline_cards(rows[:limit])
+    next_cursor = deals[-1]['id'] if len(rows) > limit else None
+    return deals, next_cursor
+
+BULK_DEAL_ACTIONS = ('move', 'revalue', 'delete')
+BULK_DEAL_LIMIT = 10000 # Deal ids per request; stays under SQLite's bound parameter limit
+
+def bulk_update_deals(user_id, action, deal_ids=None, from_stage_id=None, stage_id=None, stage_name=None, value=None, value_percent=None):
+    # One SELECT for the rollup and automation deltas, then one UPDATE or DELETE for every selected deal.
+    # Deals are picked by id or by their current stage; call it inside run_write. Returns (deals affected, automation events).
+    selected = and_(Deal.user_id==user_id, Deal.id.in_(deal_ids) if deal_ids is not None else Deal.stage_id==from_stage_id)
+    rows = db.session.query(Deal.id, Deal.name, Deal.stage, Deal.value, Deal.closing_date, Deal.created_at, Deal.organization_id, Deal.stage_entered_at).filter(selected).all()
+    if not rows: return 0, []
+    before = [rollup_snapshot(row._asdict()) for row in rows]
+    now = datetime.datetime.utcnow()
+    mark_deals_changed(user_id)
+    if action == 'delete':
+        links = db.session.query(deal_contact_association.c.deal_id, deal_contact_association.c.contact_id).filter(
+            deal_contact_association.c.deal_id.in_(select(Deal.id).where(selected))).all()
+        log_changes(deal_contact_association, 'delete', [(user_id, f'{deal_id}:{contact_id}') for deal_id, contact_id in links])
+        log_changes(Deal.__table__, 'delete', [(user_id, row.id) for row in rows])
+        db.session.execute(deal_contact_association.delete().where(deal_contact_association.c.deal_id.in_(select(Deal.id).where(selected))))
+        db.session.execute(Deal.__table__.delete().where(selected))
+        update_rollups(user_id, removed=before)
+        return len(rows), []
+    log_changes(Deal.__table__, 'upsert', [(user_id, row.id) for row in rows])
+    if action == 'move':
+        db.session.execute(update(Deal).where(selected).values(stage=stage_name, stage_id=stage_id, updated_at=now, stage_entered_at=case(
+            (Deal.stage!=stage_name, now), else_=Deal.stage_entered_at)).execution_options(synchronize_session=False))
+        record_stage_changes(db.session.connection(), [(user_id, row.id, row.stage, stage_name, dwell_seconds(row.stage_entered_at, now), now)
+                                                       for row in rows if row.stage != stage_name])
+        update_rollups(user_id, before, [(stage_name,) + snapshot[1:] for snapshot in before])
+        return len(rows), [{'trigger': 'stage_change', 'user_id': user_id, 'condition': stage_name, 'values': {'deal': row.name, 'stage': stage_name},
+                            'organization_id': row.organization_id} for row in rows if row.stage != stage_name]
+    # revalue: a fixed value, or a whole-number percentage change rounded in SQL
+    new_value = value if value is not None else (func.coalesce(Deal.value, 0) * (100 + value_percent) + 50) // 100
+    db.session.execute(update(Deal).where(selected).values(value=new_value, updated_at=now).execution_options(synchronize_session=False))
+    after = db.session.query(Deal.stage, Deal.value, Deal.closing_date, Deal.created_at).filter(selected).order_by(Deal.id).all()
+    update_rollups(user_id, before, [tuple(row) for row in after])
+    return len(rows), []
@@ -0,0 +1,59 @@
+from sqlalchemy import text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from crm.extensions import db
+from crm.models import CLOSED_STAGES, ReportingRollup, ReportingYearRollup
+
+# --- REPORTING ROLLUPS ---
+# Win/loss totals are kept per user and per closing year and adjusted by deltas
+# whenever a deal enters or leaves a closed stage, so /reporting never scans deals.
+def rollup_snapshot(deal):
+    # The part of a deal the rollups depend on; pass the before and after snapshots to update_rollups()
+    if isinstance(deal, dict):
+        return (deal['stage'], deal.get('value') or 0, deal['closing_date'], deal.get('created_at'))
+    return (deal.stage, deal.value or 0, deal.closing_date, deal.created_at)
+
+def update_rollups(user_id, removed=(), added=()):
+    totals = {'won_count': 0, 'lost_count': 0, 'won_value': 0, 'cycle_days_sum': 0, 'cycle_count': 0}
+    years = {}
+    for sign, snapshots in ((-1, removed), (1, added)):
+        for stage, value, closing_date, created_at in snapshots:
+            if stage not in CLOSED_STAGES: continue
+            won = stage == 'Closed-Won'
+            column = 'won_count' if won else 'lost_count'
+            totals[column] += sign
+            year = years.setdefault(closing_date.year, {'won_count': 0, 'lost_count': 0})
+            year[column] += sign
+            if won:
+                totals['won_value'] += sign * value
+                if created_at:
+                    totals['cycle_days_sum'] += sign * (closing_date - created_at.date()).days
+                    totals['cycle_count'] += sign
+    if any(totals.values()):
+        _upsert_rollup(ReportingRollup, {'user_id': user_id}, totals)
+    for year, counts in years.items():
+        if any(counts.values()):
+            _upsert_rollup(ReportingYearRollup, {'user_id': user_id, 'year': year}, counts)
+
+def _upsert_rollup(model, key, deltas):
+    # INSERT ... ON CONFLICT DO UPDATE adds the deltas without reading the row first
+    table = model.__table__
+    statement = sqlite_insert(table).values(**key, **deltas)
+    statement = statement.on_conflict_do_update(index_elements=list(key), set_={column: table.c[column] + statement.excluded[column] for column in deltas})
+    db.session.execute(statement)
+
+def rebuild_rollups():
+    db.session.execute(ReportingRollup.__table__.delete())
+    db.session.execute(ReportingYearRollup.__table__.delete())
+    db.session.execute(text("""
+        INSERT INTO reporting_rollup (user_id, won_count, lost_count, won_value, cycle_days_sum, cycle_count)
+        SELECT user_id,
+               sum(stage = 'Closed-Won'), sum(stage = 'Closed-Lost'),
+               coalesce(sum(CASE WHEN stage = 'Closed-Won' THEN value END), 0),
+               coalesce(sum(CASE WHEN stage = 'Closed-Won' AND created_at IS NOT NULL THEN CAST(julianday(closing_date) - julianday(date(created_at)) AS INTEGER) END), 0),
+               sum(stage = 'Closed-Won' AND created_at IS NOT NULL)
+        FROM deal WHERE stage IN ('Closed-Won', 'Closed-Lost') GROUP BY user_id"""))
+    db.session.execute(text("""
+        INSERT INTO reporting_year_rollup (user_id, year, won_count, lost_count)
+        SELECT user_id, CAST(strftime('%Y', closing_date) AS INTEGER), sum(stage = 'Closed-Won'), sum(stage = 'Closed-Lost')
+        FROM deal WHERE stage IN ('Closed-Won', 'Closed-Lost') GROUP BY 1, 2"""))
+    db.session.commit()
@@ -0,0 +1,72 @@
+import re
+from sqlalchemy import event, text, DDL
+from crm.extensions import db
+from crm.models import Contact, Deal, Interaction, Organization
+
+# --- FULL-TEXT SEARCH INDEX ---
+# One FTS5 table covers every searchable record. SQLite triggers keep it in sync, so
+# ORM writes, cascades and the bulk importer's Core inserts are all indexed. The
+# rowid encodes the record (id * 4 + kind code) and the owner column holds a
+# 'u<user_id>' token so the per-user filter is answered by the index itself.
+SEARCH_SOURCES = {
+    # kind: (code, table, title expression, body expression, columns that trigger a reindex)
+    'organization': (0, 'organization', "{r}.name", "coalesce({r}.country, '') || ' ' || coalesce({r}.strategic_notes, '')", 'name, country, strategic_notes'),
+    'contact': (1, 'contact', "{r}.name", "coalesce({r}.title, '') || ' ' || coalesce({r}.email, '')", 'name, title, email'),
+    'deal': (2, 'deal', "{r}.name", "{r}.stage", 'name, stage'),
+    'interaction': (3, 'interaction', "{r}.interaction_type", "{r}.notes", 'interaction_type, notes'),
+}
+SEARCH_KIND_BY_CODE = {code: kind for kind, (code, *_) in SEARCH_SOURCES.items()}
+SEARCH_PAGE_SIZE = 25
+
+def _search_index_ddl():
+    statements = ["CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(owner, title, body, tokenize='unicode61 remove_diacritics 2')"]
+    for kind, (code, table, title, body, columns) in SEARCH_SOURCES.items():
+        insert = f"INSERT INTO search_index(rowid, owner, title, body) VALUES (new.id * 4 + {code}, 'u' || new.user_id, {title.format(r='new')}, {body.format(r='new')});"
+        delete = f"DELETE FROM search_index WHERE rowid = old.id * 4 + {code};"
+        statements += [
+            f"CREATE TRIGGER IF NOT EXISTS search_{table}_ai AFTER INSERT ON {table} BEGIN {insert} END",
+            f"CREATE TRIGGER IF NOT EXISTS search_{table}_au AFTER UPDATE OF {columns}, user_id ON {table} BEGIN {delete} {insert} END",
+            f"CREATE TRIGGER IF NOT EXISTS search_{table}_ad AFTER DELETE ON {table} BEGIN {delete} END",
+        ]
+    # Rank title matches well above body matches; the owner column never contributes to the score
+    statements.append("INSERT INTO search_index(search_index, rank) VALUES ('rank', 'bm25(0.0, 10.0, 1.0)')")
+    return statements
+
+for _statement in _search_index_ddl():
+    event.listen(db.metadata, 'after_create', DDL(_statement).execute_if(dialect='sqlite'))
+
+def rebuild_search_index():
+    db.session.execute(text("DROP TABLE IF EXISTS search_index"))
+    for table in {source[1] for source in SEARCH_SOURCES.values()}:
+        for suffix in ('ai', 'au', 'ad'):
+            db.session.execute(text(f"DROP TRIGGER IF EXISTS search_{table}_{suffix}"))
+    for statement in _search_index_ddl():
+        db.session.execute(text(statement))
+    for kind, (code, table, title, body, columns) in SEARCH_SOURCES.items():
+        db.session.execute(text(f"INSERT INTO search_index(rowid, owner, title, body) "
+                                f"SELECT id * 4 + {code}, 'u' || user_id, {title.format(r=table)}, {body.format(r=table)} FROM {table}"))
+    db.session.execute(text("INSERT INTO search_index(search_index) VALUES ('optimize')"))
+    db.session.commit()
+
+def _fts_query(query):
+    # Quote every word so user input can never be parsed as FTS syntax; the trailing * makes it a prefix match
+    terms = re.findall(r'\w+', query)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+def search_records(query, user_id, page=1, per_page=SEARCH_PAGE_SIZE):
+    # Returns ({kind: [model, ...]}, has_next) ordered by bm25 rank within each kind
+    results = {kind: [] for kind in SEARCH_SOURCES}
+    terms = _fts_query(query)
+    if not terms: return results, False
+    rowids = [row[0] for row in db.session.execute(
+        text("SELECT rowid FROM search_index WHERE search_index MATCH :match ORDER BY rank LIMIT :limit OFFSET :offset"),
+        {'match': f'owner:u{int(user_id)} AND ({terms})', 'limit': per_page + 1, 'offset': (page - 1) * per_page})]
+    has_next = len(rowids) > per_page
+    hits = [(SEARCH_KIND_BY_CODE[rowid % 4], rowid // 4) for rowid in rowids[:per_page]]
+    models = {'organization': Organization, 'contact': Contact, 'deal': Deal, 'interaction': Interaction}
+    for kind, model in models.items():
+        ids = [record_id for hit_kind, record_id in hits if hit_kind == kind]
+        if not ids: continue
+        by_id = {record.id: record for record in model.query.filter(model.id.in_(ids), model.user_id==user_id)}
+        results[kind] = [by_id[record_id] for record_id in ids if record_id in by_id]
+    return results, has_next
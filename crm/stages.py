@@ -0,0 +1,212 @@
+import datetime
+import itertools
+import math
+from collections import Counter
+from sqlalchemy import func, event, inspect, text, and_, or_, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session as OrmSession
+from crm.extensions import db
+from crm.models import CLOSED_STAGES, Deal, DEAL_STAGES, DealStageChange, Organization, PipelineStage, StageDwellBucket, StageDwellStat
+from crm.export import EXPORT_CHUNK_SIZE
+
+# --- STAGE ANALYTICS ---
+# Every stage change appends to deal_stage_change and, in the same transaction, adjusts
+# running per-stage aggregates: how many deals reached the stage, and the count, sum and
+# a quantile sketch of how long deals stayed in it. The sketch is a log-spaced histogram
+# with one row per bucket (relative error DWELL_SKETCH_ACCURACY), so it is updated with
+# upserts and read back in one small query. Funnels and stuck deals never scan history.
+# ORM stage changes are picked up by flush events; Core paths call record_stage_changes().
+DWELL_SKETCH_ACCURACY = 0.02
+DWELL_GAMMA = (1 + DWELL_SKETCH_ACCURACY) / (1 - DWELL_SKETCH_ACCURACY)
+STUCK_MIN_SAMPLES = 20 # Exits a stage needs before its own p90 is trusted
+STUCK_DEFAULT_DAYS = 30 # Threshold for stages with fewer samples
+STUCK_DEALS_LIMIT = 50
+
+def dwell_bucket(seconds):
+    return math.ceil(math.log(max(seconds, 1), DWELL_GAMMA))
+
+def sketch_quantile(buckets, q):
+    # buckets is [(bucket, count)] in bucket order; returns seconds, or None for an empty sketch
+    total = sum(count for _, count in buckets)
+    if not total: return None
+    rank, seen = q * (total - 1), 0
+    for bucket, count in buckets:
+        seen += count
+        if seen > rank: return 2 * DWELL_GAMMA ** bucket / (DWELL_GAMMA + 1)
+
+def dwell_seconds(entered_at, now):
+    return max(int((now - entered_at).total_seconds()), 0) if entered_at else None
+
+def _upsert_counts(conn, model, keys, rows):
+    # Executemany form of _upsert_rollup: adds every non-key column of each row to the stored totals
+    table = model.__table__
+    statement = sqlite_insert(table)
+    columns = [column for column in rows[0] if column not in keys]
+    conn.execute(statement.on_conflict_do_update(index_elements=keys, set_={column: table.c[column] + statement.excluded[column] for column in columns}), rows)
+
+def record_stage_changes(conn, changes):
+    # changes are (user_id, deal_id, from_stage, to_stage, dwell seconds, changed_at); from_stage is None for new deals
+    if not changes: return
+    # A stage counts once per deal in the funnel, however often the deal comes back to it
+    seen = set(conn.execute(select(DealStageChange.deal_id, DealStageChange.to_stage).where(DealStageChange.deal_id.in_({change[1] for change in changes}))))
+    stats, buckets = {}, Counter()
+    for user_id, deal_id, from_stage, to_stage, dwell, changed_at in changes:
+        if (deal_id, to_stage) not in seen:
+            seen.add((deal_id, to_stage))
+            stats.setdefault((user_id, to_stage), Counter())['reached'] += 1
+        if from_stage is not None and dwell is not None:
+            stat = stats.setdefault((user_id, from_stage), Counter())
+            stat['exits'] += 1; stat['dwell_seconds_sum'] += dwell
+            buckets[(user_id, from_stage, dwell_bucket(dwell))] += 1
+    conn.execute(DealStageChange.__table__.insert(), [{'deal_id': deal_id, 'from_stage': from_stage, 'to_stage': to_stage, 'dwell_seconds': dwell,
+                                                       'changed_at': changed_at, 'user_id': user_id}
+                                                      for user_id, deal_id, from_stage, to_stage, dwell, changed_at in changes])
+    if stats:
+        _upsert_counts(conn, StageDwellStat, ['user_id', 'stage'], [{'user_id': user_id, 'stage': stage, 'reached': stat['reached'], 'exits': stat['exits'],
+                                                                     'dwell_seconds_sum': stat['dwell_seconds_sum']} for (user_id, stage), stat in stats.items()])
+    if buckets:
+        _upsert_counts(conn, StageDwellBucket, ['user_id', 'stage', 'bucket'], [{'user_id': user_id, 'stage': stage, 'bucket': bucket, 'count': count}
+                                                                              for (user_id, stage, bucket), count in buckets.items()])
+
+@event.listens_for(OrmSession, 'before_flush')
+def _sync_deal_stage(orm_session, flush_context, instances):
+    # The board and bulk moves key on Deal.stage_id while history, rollups and reports key on the stage name. ORM writes set
+    # stage_id and the name is derived from it here; a write that only sets the name gets the user's stage of that name.
+    # Registered before _stamp_stage_changes, which reads the derived name.
+    by_id, by_name = [], []
+    for obj in itertools.chain(orm_session.new, orm_session.dirty):
+        if not isinstance(obj, Deal): continue
+        attrs = inspect(obj).attrs
+        if obj.stage_id is not None and (attrs.stage_id.history.added or obj in orm_session.new): by_id.append(obj)
+        elif attrs.stage.history.added and obj.stage is not None: by_name.append(obj)
+    if not by_id and not by_name: return
+    with orm_session.no_autoflush:
+        if by_id:
+            names = dict(orm_session.execute(select(PipelineStage.id, PipelineStage.name).where(PipelineStage.id.in_({int(deal.stage_id) for deal in by_id}))).all())
+            for deal in by_id:
+                if int(deal.stage_id) in names: deal.stage = names[int(deal.stage_id)]
+        if by_name:
+            stage_ids = {(user_id, name): stage_id for stage_id, user_id, name in orm_session.execute(
+                select(func.min(PipelineStage.id), PipelineStage.user_id, PipelineStage.name).where(
+                    PipelineStage.user_id.in_({deal.user_id for deal in by_name}), PipelineStage.name.in_({deal.stage for deal in by_name})).group_by(
+                    PipelineStage.user_id, PipelineStage.name))}
+            for deal in by_name: deal.stage_id = stage_ids.get((deal.user_id, deal.stage))
+
+def resolve_stage_ids(user_id, names):
+    # {name: stage id} for the user's stages with these names. A DEAL_STAGES name the user has no stage for gets one at the
+    # end of their pipeline, so clients written against the fixed stages keep working; any other unknown name is left out.
+    names = set(names)
+    stage_ids = dict(db.session.query(PipelineStage.name, func.min(PipelineStage.id)).filter(
+        PipelineStage.user_id==user_id, PipelineStage.name.in_(names)).group_by(PipelineStage.name).all())
+    missing = [name for name in DEAL_STAGES if name in names and name not in stage_ids]
+    if missing:
+        last_order = db.session.query(func.max(PipelineStage.order)).filter_by(user_id=user_id).scalar() or 0
+        stages = [PipelineStage(name=name, order=last_order + n, user_id=user_id) for n, name in enumerate(missing, 1)]
+        db.session.add_all(stages); db.session.flush()
+        stage_ids.update((stage.name, stage.id) for stage in stages)
+    return stage_ids
+
+def first_stage_name(user_id):
+    # Where deals without a stage start
+    return db.session.query(PipelineStage.name).filter_by(user_id=user_id).order_by(PipelineStage.order, PipelineStage.id).limit(1).scalar() or DEAL_STAGES[0]
+
+def realign_deal_stages():
+    # Deals whose stage_id is missing or points at no stage get the user's stage of their name (created for DEAL_STAGES
+    # names), or else the user's first stage. Core UPDATEs, so run rebuild_rollups afterwards.
+    orphaned = or_(Deal.stage_id.is_(None), ~select(PipelineStage.id).where(PipelineStage.id==Deal.stage_id).exists())
+    names_by_user = {}
+    for user_id, name in db.session.query(Deal.user_id, Deal.stage).filter(orphaned).distinct():
+        names_by_user.setdefault(user_id, set()).add(name)
+    for user_id, names in names_by_user.items():
+        default = first_stage_name(user_id)
+        stage_ids = resolve_stage_ids(user_id, names | {default})
+        for name in names:
+            target = name if name in stage_ids else default
+            db.session.execute(update(Deal).where(Deal.user_id==user_id, Deal.stage==name, orphaned).values(stage=target, stage_id=stage_ids[target]))
+
+@event.listens_for(OrmSession, 'before_flush')
+def _stamp_stage_changes(orm_session, flush_context, instances):
+    # Runs before the UPDATE so the new stage_entered_at goes out with it
+    now = datetime.datetime.utcnow()
+    for obj in orm_session.dirty:
+        if not isinstance(obj, Deal): continue
+        history = inspect(obj).attrs.stage.history
+        if not history.deleted or history.deleted[0] in (None, obj.stage): continue
+        orm_session.info.setdefault('stage_changes', []).append(
+            (obj.user_id, obj.id, history.deleted[0], obj.stage, dwell_seconds(obj.stage_entered_at, now), now))
+        obj.stage_entered_at = now
+
+@event.listens_for(OrmSession, 'after_flush')
+def _record_orm_stage_changes(orm_session, flush_context):
+    changes = orm_session.info.pop('stage_changes', [])
+    changes += [(obj.user_id, obj.id, None, obj.stage, None, obj.stage_entered_at) for obj in orm_session.new if isinstance(obj, Deal)]
+    record_stage_changes(orm_session.connection(), changes)
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_stage_changes(orm_session):
+    orm_session.info.pop('stage_changes', None)
+
+def rebuild_stage_analytics():
+    # Recomputes the aggregates from the full history; for migrations and `flask rebuild-stage-analytics`
+    db.session.execute(StageDwellStat.__table__.delete())
+    db.session.execute(StageDwellBucket.__table__.delete())
+    db.session.execute(text("""
+        INSERT INTO stage_dwell_stat (user_id, stage, reached, exits, dwell_seconds_sum)
+        SELECT user_id, stage, sum(reached), sum(exits), sum(dwell) FROM (
+            SELECT user_id, to_stage AS stage, count(DISTINCT deal_id) AS reached, 0 AS exits, 0 AS dwell FROM deal_stage_change GROUP BY 1, 2
+            UNION ALL
+            SELECT user_id, from_stage, 0, count(*), sum(dwell_seconds) FROM deal_stage_change WHERE dwell_seconds IS NOT NULL GROUP BY 1, 2)
+        GROUP BY 1, 2"""))
+    # SQLite has no log() in every build, so the buckets are counted here from the distinct dwell values
+    buckets = Counter()
+    for user_id, stage, dwell, count in db.session.query(DealStageChange.user_id, DealStageChange.from_stage, DealStageChange.dwell_seconds, func.count()).filter(
+            DealStageChange.dwell_seconds.isnot(None)).group_by(DealStageChange.user_id, DealStageChange.from_stage, DealStageChange.dwell_seconds).yield_per(EXPORT_CHUNK_SIZE):
+        buckets[(user_id, stage, dwell_bucket(dwell))] += count
+    if buckets:
+        db.session.execute(StageDwellBucket.__table__.insert(), [{'user_id': user_id, 'stage': stage, 'bucket': bucket, 'count': count}
+                                                                 for (user_id, stage, bucket), count in buckets.items()])
+    db.session.commit()
+
+def backfill_stage_history():
+    # Deals from before stage tracking enter the history once, in their current stage
+    db.session.execute(text("UPDATE deal SET stage_entered_at = coalesce(updated_at, created_at) WHERE stage_entered_at IS NULL"))
+    if db.session.query(DealStageChange.id).first(): return
+    db.session.execute(text("INSERT INTO deal_stage_change (deal_id, from_stage, to_stage, changed_at, user_id) "
+                            "SELECT id, NULL, stage, coalesce(stage_entered_at, CURRENT_TIMESTAMP), user_id FROM deal"))
+
+def stage_analytics(user_id):
+    # Per stage, in pipeline order: deals that reached it, conversion from the previous funnel step and dwell times in days
+    stats = {row.stage: row for row in StageDwellStat.query.filter_by(user_id=user_id)}
+    sketches = {}
+    for stage, bucket, count in db.session.query(StageDwellBucket.stage, StageDwellBucket.bucket, StageDwellBucket.count).filter(
+            StageDwellBucket.user_id==user_id).order_by(StageDwellBucket.stage, StageDwellBucket.bucket):
+        sketches.setdefault(stage, []).append((bucket, count))
+    order = [name for (name,) in db.session.query(PipelineStage.name).filter_by(user_id=user_id).order_by(PipelineStage.order)]
+    stages, previous = [], None
+    for name in order + sorted(stats.keys() - set(order)):
+        stat = stats.get(name)
+        reached, exits = (stat.reached, stat.exits) if stat else (0, 0)
+        p50, p90 = (sketch_quantile(sketches.get(name, []), q) for q in (0.5, 0.9))
+        entry = {'stage': name, 'reached': reached, 'exits': exits, 'avg_days': round(stat.dwell_seconds_sum / exits / 86400, 1) if exits else None,
+                 'p50_days': round(p50 / 86400, 1) if p50 is not None else None, 'p90_days': round(p90 / 86400, 1) if p90 is not None else None,
+                 'conversion': None}
+        # Closed-Lost is an exit from the funnel, not a step in it
+        if name != 'Closed-Lost':
+            if previous is not None: entry['conversion'] = round(reached / previous * 100, 1) if previous else None
+            previous = reached
+        stages.append(entry)
+    return stages
+
+def stuck_deals(user_id, analytics=None, limit=STUCK_DEALS_LIMIT):
+    # Open deals that have been in their stage longer than its p90 dwell time; one query on ix_deal_user_stage_entered
+    now = datetime.datetime.utcnow()
+    conditions, thresholds = [], {}
+    for stage in analytics if analytics is not None else stage_analytics(user_id):
+        if stage['stage'] in CLOSED_STAGES or not stage['reached']: continue
+        days = stage['p90_days'] if stage['exits'] >= STUCK_MIN_SAMPLES and stage['p90_days'] else STUCK_DEFAULT_DAYS
+        thresholds[stage['stage']] = days
+        conditions.append(and_(Deal.stage==stage['stage'], Deal.stage_entered_at < now - datetime.timedelta(days=days)))
+    if not conditions: return []
+    rows = db.session.query(Deal.id, Deal.name, Deal.stage, Deal.value, Deal.stage_entered_at, Organization.name.label('organization')).join(
+        Organization, Organization.id==Deal.organization_id).filter(Deal.user_id==user_id, or_(*conditions)).order_by(Deal.stage_entered_at).limit(limit)
+    return [dict(row._asdict(), days_in_stage=(now - row.stage_entered_at).days, threshold_days=thresholds[row.stage]) for row in rows]
@@ -0,0 +1,102 @@
+import datetime
+import hashlib
+import os
+import tempfile
+from flask import current_app
+from sqlalchemy import func, event, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session as OrmSession, object_session
+from crm.extensions import db
+from crm.models import File, StoredBlob
+
+# --- FILE STORAGE ---
+# Uploads are streamed to a temp file in chunks while being hashed, then stored once per
+# distinct content under UPLOAD_FOLDER/objects/<sha[:2]>/<sha>. File rows point at the
+# blob and StoredBlob.ref_count tracks how many do; mapper hooks keep the count, so ORM
+# cascade deletes release their blobs too. Blobs are linked inside the write transaction
+# that adds their File row and only unlinked after a commit, on a separate connection
+# holding the write lock, once no StoredBlob row is left. The two cannot interleave, so a
+# delete never removes bytes a concurrent upload of the same content has just committed.
+class QuotaExceeded(Exception): pass
+
+def blob_path(sha256):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'objects', sha256[:2], sha256)
+
+def storage_used(user_id):
+    return db.session.query(func.coalesce(func.sum(File.size), 0)).filter(File.user_id==user_id).scalar()
+
+def store_upload(stream, user_id):
+    # Returns (temp path, sha256, size); pass the temp path to link_blob once the File row is flushed
+    remaining = current_app.config['USER_STORAGE_QUOTA'] - storage_used(user_id)
+    tmp_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    digest, size = hashlib.sha256(), 0
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(current_app.config['UPLOAD_CHUNK_SIZE'])
+                if not chunk: break
+                size += len(chunk)
+                if size > remaining: raise QuotaExceeded('This upload would exceed your storage quota.')
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), size
+
+def link_blob(tmp_path, sha256):
+    # Call after flushing the File row, so the transaction holds the write lock. Replacing an existing blob
+    # with identical bytes is harmless, and a retried write finds the temp file already moved.
+    if not os.path.exists(tmp_path): return
+    final_path = blob_path(sha256)
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    os.replace(tmp_path, final_path)
+
+def discard_unused_blobs(sha256s):
+    # Unlinks the blobs no StoredBlob row references. The DELETE takes SQLite's write lock on this
+    # connection first, so no upload of the same content can commit between the check and the unlink.
+    table = StoredBlob.__table__
+    with db.engine.begin() as conn:
+        conn.execute(table.delete().where(table.c.sha256.in_(sha256s), table.c.ref_count <= 0))
+        live = set(conn.execute(select(table.c.sha256).where(table.c.sha256.in_(sha256s))).scalars())
+        for sha256 in set(sha256s) - live:
+            path = blob_path(sha256)
+            if os.path.exists(path): os.remove(path)
+            try:
+                os.rmdir(os.path.dirname(path)) # Drop the shard directory once its last blob is gone
+            except OSError:
+                pass # Other blobs still live there, or it was already removed
+
+@event.listens_for(File, 'after_insert')
+def _reference_blob(mapper, connection, target):
+    if not target.blob_sha256: return
+    statement = sqlite_insert(StoredBlob.__table__).values(sha256=target.blob_sha256, size=target.size or 0, ref_count=1, created_at=datetime.datetime.utcnow())
+    connection.execute(statement.on_conflict_do_update(index_elements=['sha256'], set_={'ref_count': StoredBlob.__table__.c.ref_count + 1}))
+
+@event.listens_for(File, 'after_delete')
+def _release_blob(mapper, connection, target):
+    if not target.blob_sha256: return
+    table = StoredBlob.__table__
+    connection.execute(table.update().where(table.c.sha256==target.blob_sha256).values(ref_count=table.c.ref_count - 1))
+    if connection.execute(table.delete().where(table.c.sha256==target.blob_sha256, table.c.ref_count <= 0)).rowcount:
+        object_session(target).info.setdefault('released_blobs', set()).add(target.blob_sha256)
+
+@event.listens_for(OrmSession, 'after_commit')
+def _unlink_released_blobs(orm_session):
+    released = orm_session.info.pop('released_blobs', None)
+    if released: discard_unused_blobs(released)
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _keep_released_blobs(orm_session):
+    orm_session.info.pop('released_blobs', None)
+
+def collect_unused_blobs():
+    # Removes blobs on disk with no StoredBlob row, e.g. left by a worker that died between linking and committing
+    root = os.path.join(current_app.config['UPLOAD_FOLDER'], 'objects')
+    names = [name for prefix in (os.listdir(root) if os.path.isdir(root) else ()) for name in os.listdir(os.path.join(root, prefix))]
+    live = {sha256 for (sha256,) in db.session.query(StoredBlob.sha256)}
+    unused = [name for name in names if name not in live]
+    for start in range(0, len(unused), 500): discard_unused_blobs(unused[start:start + 500])
+    return len(unused)
@@ -0,0 +1,40 @@
+import datetime
+from sqlalchemy import select, union_all, literal, tuple_
+from crm.extensions import db
+from crm.models import Interaction, Task
+
+# --- CONTACT TIMELINE ---
+# Interactions and tasks are merged in SQL: each branch reads at most one page from its
+# (contact_id, date) index and UNION ALL merges them. Pages are keyed on (date, type, id),
+# newest first, so "load more" never re-reads earlier rows.
+TIMELINE_PAGE_SIZE = 25
+
+def _timeline_branch(model, kind, date_column, contact_id, cursor, limit):
+    query = select(literal(kind).label('type'), model.id.label('id'), date_column.label('date')).where(model.contact_id==contact_id)
+    if cursor:
+        date, cursor_kind, cursor_id = cursor
+        if cursor_kind == kind: query = query.where(tuple_(date_column, model.id) < tuple_(date, cursor_id))
+        elif cursor_kind > kind: query = query.where(date_column <= date)
+        else: query = query.where(date_column < date)
+    return query.order_by(date_column.desc(), model.id.desc()).limit(limit).subquery()
+
+def contact_timeline(contact_id, cursor=None, limit=TIMELINE_PAGE_SIZE):
+    # Returns ([{'type', 'item', 'date'}, ...], next cursor string or None)
+    if cursor:
+        date, kind, item_id = cursor.split('|')
+        cursor = (datetime.datetime.fromisoformat(date), kind, int(item_id))
+    branches = [_timeline_branch(Interaction, 'Interaction', Interaction.date, contact_id, cursor, limit + 1),
+                _timeline_branch(Task, 'Task', Task.due_date, contact_id, cursor, limit + 1)]
+    merged = union_all(*[select(branch) for branch in branches]).subquery()
+    rows = db.session.execute(select(merged).order_by(merged.c.date.desc(), merged.c.type.desc(), merged.c.id.desc()).limit(limit + 1)).all()
+    page = rows[:limit]
+    items = {}
+    for kind, model in (('Interaction', Interaction), ('Task', Task)):
+        ids = [row.id for row in page if row.type == kind]
+        if ids: items.update({(kind, item.id): item for item in model.query.filter(model.id.in_(ids))})
+    timeline_items = [{'type': row.type, 'item': items[(row.type, row.id)], 'date': row.date} for row in page]
+    next_cursor = None
+    if len(rows) > limit:
+        last = page[-1]
+        next_cursor = f'{last.date.isoformat()}|{last.type}|{last.id}'
+    return timeline_items, next_cursor
@@ -0,0 +1,97 @@
+import threading
+import time
+from flask import current_app, has_request_context, session
+from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
+from crm.extensions import app_service, db
+from crm.models import DataVersion, User
+from crm.instrumentation import METRICS
+from crm.caching import TTLCache
+
+# --- USER LOADING ---
+# Flask-Login calls load_user on every authenticated request. The user's columns come from
+# the signed session cookie (USER_SESSION_PAYLOAD) or a per-process TTL/LRU cache, so most
+# requests run no user query. Both copies are stamped with the shared 'users' data version,
+# which every commit that changes or deletes a user bumps (Core writes to the user table must
+# call mark_changed(user_id, 'users')); each process re-reads it at most every
+# USER_VERSION_CHECK_INTERVAL seconds, so a deleted user stops authenticating everywhere within
+# that time. current_user is a SessionUser holding USER_FIELDS, which commits never expire.
+USER_FIELDS = ('id', 'username', 'email')
+
+class SessionUser(UserMixin):
+    # Anything beyond USER_FIELDS (password_hash, relationships) loads the User row on first use
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+    def __getattr__(self, name):
+        if name.startswith('_'): raise AttributeError(name)
+        user = db.session.get(User, self.id)
+        if user is None: raise AttributeError(name)
+        return getattr(user, name)
+
+class UsersVersion:
+    def __init__(self, interval):
+        self.interval = interval
+        self._version, self._checked = None, None
+        self._lock = threading.Lock()
+
+    def current(self):
+        with self._lock:
+            if self._checked is not None and time.monotonic() - self._checked < self.interval: return self._version
+        version = db.session.query(DataVersion.version).filter_by(user_id=0, entity='users').scalar() or 0
+        with self._lock: self._version, self._checked = version, time.monotonic()
+        return version
+
+    def expire(self):
+        with self._lock: self._checked = None
+
+def get_user_cache():
+    return app_service('user_cache', lambda config: TTLCache(config['USER_CACHE_TTL'], config['USER_CACHE_SIZE']))
+
+def get_users_version():
+    return app_service('users_version', lambda config: UsersVersion(config['USER_VERSION_CHECK_INTERVAL']))
+
+def load_user(user_id):
+    user_id = int(user_id)
+    version = get_users_version().current()
+    use_payload = current_app.config['USER_SESSION_PAYLOAD'] and has_request_context()
+    if use_payload:
+        payload = session.get('_user_fields') # [*USER_FIELDS, users version, issued at]
+        if payload and payload[0] == user_id and payload[-2] == version and time.time() - payload[-1] < current_app.config['USER_SESSION_MAX_AGE']:
+            METRICS['user_loads'].inc('session')
+            return SessionUser(dict(zip(USER_FIELDS, payload)))
+    cache = get_user_cache() if current_app.config['USER_CACHE_SIZE'] else None
+    cached = cache.get(user_id) if cache else None
+    if cached is not None and cached[1] == version:
+        METRICS['user_loads'].inc('cache')
+        fields = cached[0]
+    else:
+        METRICS['user_loads'].inc('database')
+        row = db.session.query(*(getattr(User, name) for name in USER_FIELDS)).filter(User.id==user_id).first()
+        if row is None: return None
+        fields = row._asdict()
+        if cache: cache.set(user_id, (fields, version))
+    if use_payload: session['_user_fields'] = [*(fields[name] for name in USER_FIELDS), version, time.time()]
+    return SessionUser(fields)
+
+@event.listens_for(OrmSession, 'after_flush')
+def _track_user_changes(orm_session, flush_context):
+    for obj in (*orm_session.dirty, *orm_session.deleted):
+        if isinstance(obj, User):
+            orm_session.info.setdefault('changed_users', set()).add(obj.id)
+            orm_session.info.setdefault('version_marks', set()).add((0, 'users'))
+
+@event.listens_for(OrmSession, 'after_commit')
+def _invalidate_users(orm_session):
+    user_ids = orm_session.info.pop('changed_users', None)
+    if not user_ids: return
+    user_cache, users_version = current_app.extensions.get('user_cache'), current_app.extensions.get('users_version')
+    if user_cache is not None:
+        for user_id in user_ids: user_cache.pop(user_id)
+    if users_version is not None: users_version.expire()
+    if has_request_context() and session.get('_user_fields', [None])[0] in user_ids: session.pop('_user_fields')
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_user_changes(orm_session):
+    orm_session.info.pop('changed_users', None)
@@ -0,0 +1,145 @@
+import datetime
+import fcntl
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from flask import current_app, request, redirect, url_for, flash, jsonify
+from sqlalchemy import text
+from crm.extensions import app_service, db
+from crm.models import Deal
+from crm.caching import mark_changed, VERSIONED_MODELS
+from crm.stages import record_stage_changes
+from crm.changes import log_changes
+from crm.duplicates import DEDUPE_KINDS, index_for_dedupe
+
+# --- WRITE COORDINATION ---
+# Mutations go through run_write(fn), where fn changes db.session without committing.
+# In 'direct' mode fn runs and commits on the request's own session. In 'batched' mode it is
+# handed to the process's writer thread, which holds an exclusive flock on a lock file next
+# to the database while it writes, so one writer runs at a time across all worker processes.
+# It takes SQLite's write lock once with BEGIN IMMEDIATE, runs a batch of writes each in its
+# own savepoint and commits them together. Writers waiting for the flock sleep in the kernel
+# instead of retrying on busy_timeout, and writes queued meanwhile join their next batch.
+# Reads never wait on it: they keep using the request's connection and WAL snapshots.
+class WriteUnavailable(Exception): pass
+
+class WriteCoordinator:
+    def __init__(self, queue_size, batch_size, batch_window, timeout, lock_path):
+        self.batch_size, self.batch_window, self.timeout, self.lock_path = batch_size, batch_window, timeout, lock_path
+        self.app = current_app._get_current_object()
+        self._writes = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.batches = self.committed = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, fn):
+        self.start()
+        future = Future()
+        try:
+            self._writes.put_nowait((fn, future))
+        except queue.Full:
+            raise WriteUnavailable('The server is busy saving other changes. Please try again.')
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # Only give up if the writer has not started on it yet; otherwise it is about to finish
+            if future.cancel(): raise WriteUnavailable('Saving took too long. Please try again.')
+            return future.result()
+
+    def _run(self):
+        # Opened here rather than in __init__, so a forked worker never shares its parent's lock
+        lock_file = open(self.lock_path, 'a') if self.lock_path else None
+        while True:
+            batch = [self._writes.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._writes.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if lock_file: fcntl.flock(lock_file, fcntl.LOCK_EX) # Released by the kernel too if this process dies
+            try:
+                while len(batch) < self.batch_size: # Writes that arrived while another process held the lock
+                    try:
+                        batch.append(self._writes.get_nowait())
+                    except queue.Empty:
+                        break
+                with self.app.app_context():
+                    self._commit_batch([(fn, future) for fn, future in batch if future.set_running_or_notify_cancel()])
+            finally:
+                if lock_file: fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _commit_batch(self, batch):
+        if not batch: return
+        done = []
+        try:
+            db.session.execute(text('BEGIN IMMEDIATE'))
+            for fn, future in batch:
+                try:
+                    with db.session.begin_nested():
+                        result = fn()
+                    done.append((future, result))
+                except Exception as e:
+                    future.set_exception(e)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.exception('Write batch of %s failed', len(batch))
+            for future, _ in done: future.set_exception(e)
+            for fn, future in batch:
+                if not future.done(): future.set_exception(e)
+            return
+        self.batches += 1
+        self.committed += len(done)
+        for future, result in done: future.set_result(result)
+
+def write_lock_path():
+    # Every process writing to the same database file shares the lock; an in-memory database has no other writers
+    database = db.engine.url.database
+    return f'{database}-writer.lock' if database and database != ':memory:' else None
+
+def get_write_coordinator():
+    return app_service('write_coordinator', lambda config: WriteCoordinator(config['WRITE_QUEUE_SIZE'], config['WRITE_BATCH_SIZE'],
+                                                                            config['WRITE_BATCH_WINDOW_MS'] / 1000, config['WRITE_TIMEOUT'], write_lock_path()))
+
+def run_write(fn):
+    # fn must only use plain values from the request (ids, form data), never ORM objects loaded by it
+    if current_app.config['SQLITE_WRITE_MODE'] == 'batched': return get_write_coordinator().submit(fn)
+    try:
+        result = fn()
+        db.session.commit()
+        return result
+    except Exception:
+        db.session.rollback()
+        raise
+
+def insert_logged(model, rows):
+    # Core bulk insert that logs the new rows and bumps their data version; returns the new ids in row order
+    if not rows: return []
+    table = model.__table__
+    ids = db.session.execute(table.insert().returning(table.c.id, sort_by_parameter_order=True), rows).scalars().all()
+    user_ids = [row.get('user_id', 0) for row in rows]
+    log_changes(table, 'upsert', zip(user_ids, ids))
+    entity = VERSIONED_MODELS.get(model.__name__)
+    if entity:
+        for user_id in set(user_ids): mark_changed(user_id, entity)
+    kind = DEDUPE_KINDS.get(model.__name__)
+    if kind: index_for_dedupe(db.session.connection(), kind, ids)
+    if model is Deal:
+        now = datetime.datetime.utcnow()
+        record_stage_changes(db.session.connection(), [(row['user_id'], deal_id, None, row.get('stage') or 'Lead', None, row.get('stage_entered_at') or now)
+                                                       for row, deal_id in zip(rows, ids)])
+    return ids
+
+# Registered for WriteUnavailable by create_app()
+def write_unavailable(e):
+    if request.is_json or request.path.startswith('/api/'): return jsonify({'success': False, 'error': str(e)}), 503
+    flash(str(e), 'danger')
+    return redirect(request.referrer or url_for('main.dashboard'))